@@ -0,0 +1,141 @@
+"""Synthetic blob corpora of controllable size, format mix and churn. The content of a blob is generated from
+its name and its edits on every download, so a large corpus does not sit in memory next to the indexer."""
+import hashlib
+import random
+import re
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, Optional
+
+SYLLABLES = ["ka", "lo", "mi", "ne", "ru", "sa", "ti", "vo", "ba", "de", "fi", "go", "hu", "ja", "pe", "zu"]
+WORDS = ["".join(random.Random(i).choices(SYLLABLES, k=random.Random(-i).randint(1, 4))) for i in range(2000)]
+PAGE = re.compile(rb"\d+ 0 obj << /Type /Page >>\nstream\n(.*?)\nendstream\n", re.DOTALL)
+
+
+@dataclass(slots=True)
+class CorpusBlob:
+    name: str
+    content_type: str
+    last_modified: datetime
+    etag: str = ""
+    md5: bytes = b""
+    size: int = 0
+    deleted: bool = False
+    # paragraph -> version, the paragraphs edited since the blob was created
+    edits: Dict[int, int] = field(default_factory=dict)
+    # name of the blob this one was copied from, the content is generated from that name
+    copy_of: str = ""
+
+
+class Corpus:
+    """documents blobs in folders, pdf_share of them PDFs of pages pages and docx_share Word documents,
+    the rest markdown. Every document has paragraphs paragraphs (per page for PDFs).
+    copy_share of the blobs are copies of another blob under a new name."""
+
+    def __init__(self, documents: int = 100, pdf_share: float = 0.3, docx_share: float = 0.1,
+                 paragraphs: int = 12, pages: int = 4, folders: int = 8, seed: int = 1, copy_share: float = 0.0):
+        self.pdf_share = pdf_share
+        self.docx_share = docx_share
+        self.copy_share = copy_share
+        self.paragraphs = paragraphs
+        self.pages = pages
+        self.folders = folders
+        self.rng = random.Random(seed)
+        self.blobs: Dict[str, CorpusBlob] = {}
+        self.created = 0
+        start = datetime.now(timezone.utc) - timedelta(days=30)
+        for _ in range(documents):
+            self.add(start + timedelta(seconds=self.rng.randrange(30 * 24 * 3600)))
+
+    def add(self, last_modified: datetime) -> CorpusBlob:
+        if self.copy_share and self.blobs and self.rng.random() < self.copy_share:
+            return self.copy(self.rng.choice(sorted(self.live())), last_modified)
+        draw = self.rng.random()
+        extension, content_type = (("pdf", "application/pdf") if draw < self.pdf_share else
+                                   ("docx", "application/vnd.openxmlformats-officedocument.wordprocessingml.document")
+                                   if draw < self.pdf_share + self.docx_share else ("md", "text/markdown"))
+        name = f"folder{self.created % self.folders}/document{self.created}.{extension}"
+        self.created += 1
+        blob = CorpusBlob(name=name, content_type=content_type, last_modified=last_modified)
+        self.blobs[name] = blob
+        self.refresh(blob)
+        return blob
+
+    def copy(self, name: str, last_modified: datetime) -> CorpusBlob:
+        source = self.blobs[name]
+        extension = name.rsplit(".", 1)[-1]
+        copy = CorpusBlob(name=f"folder{self.created % self.folders}/copy{self.created}.{extension}",
+                          content_type=source.content_type, last_modified=last_modified,
+                          edits=dict(source.edits), copy_of=source.copy_of or source.name)
+        self.created += 1
+        self.blobs[copy.name] = copy
+        self.refresh(copy)
+        return copy
+
+    def refresh(self, blob: CorpusBlob):
+        data = self.generate(blob)
+        blob.size = len(data)
+        blob.md5 = hashlib.md5(data).digest()
+        blob.etag = f'"0x{blob.md5.hex()[:16].upper()}"'
+
+    def churn(self, fraction: float) -> Dict[str, int]:
+        """Edits a paragraph of fraction of the live documents, soft deletes a quarter as many and adds as many"""
+        now = datetime.now(timezone.utc)
+        live = [blob for blob in self.blobs.values() if not blob.deleted]
+        modified = self.rng.sample(live, min(len(live), round(len(live) * fraction)))
+        for blob in modified:
+            paragraph = self.rng.randrange(self.paragraphs * (self.pages if blob.name.endswith(".pdf") else 1))
+            blob.edits[paragraph] = blob.edits.get(paragraph, 0) + 1
+            blob.last_modified = now
+            self.refresh(blob)
+        changed = {blob.name for blob in modified}
+        deleted = self.rng.sample([blob for blob in live if blob.name not in changed],
+                                  min(len(live) - len(changed), round(len(live) * fraction / 4)))
+        for blob in deleted:
+            blob.deleted = True
+            blob.last_modified = now
+        added = round(len(live) * fraction / 4)
+        for _ in range(added):
+            self.add(now)
+        return {"modified": len(modified), "deleted": len(deleted), "added": added}
+
+    def records(self) -> Iterator[CorpusBlob]:
+        for name in sorted(self.blobs):
+            yield self.blobs[name]
+
+    def record(self, name: str) -> Optional[CorpusBlob]:
+        return self.blobs.get(name)
+
+    def live(self) -> Dict[str, CorpusBlob]:
+        return {name: blob for name, blob in self.blobs.items() if not blob.deleted}
+
+    def content(self, name: str) -> Optional[bytes]:
+        blob = self.blobs.get(name)
+        if blob is None or blob.deleted:
+            return None
+        return self.generate(blob)
+
+    def generate(self, blob: CorpusBlob) -> bytes:
+        if blob.name.endswith(".pdf"):
+            pages = []
+            for page in range(self.pages):
+                text = "\n\n".join(self.paragraph(blob, page * self.paragraphs + i) for i in range(self.paragraphs))
+                pages.append(b"%d 0 obj << /Type /Page >>\nstream\n%s\nendstream\n" % (page + 2, text.encode()))
+            return b"%PDF-1.7\n1 0 obj << /Type /Pages /Count " + str(self.pages).encode() + b" >>\n" + \
+                b"".join(pages) + b"%%EOF\n"
+        title = f"# {(blob.copy_of or blob.name).rsplit('/', 1)[-1]}\n\n"
+        return (title + "\n\n".join(self.paragraph(blob, i) for i in range(self.paragraphs))).encode()
+
+    def paragraph(self, blob: CorpusBlob, number: int) -> str:
+        rng = random.Random(f"{blob.copy_of or blob.name}/{number}/{blob.edits.get(number, 0)}")
+        text = " ".join(rng.choices(WORDS, k=rng.randint(40, 120)))
+        # a heading now and then, for the markdown aware chunkers
+        return f"## {text[:40]}\n\n{text}" if number % 4 == 0 else text
+
+    @staticmethod
+    def pdf_pages(data: bytes) -> int:
+        return len(PAGE.findall(data))
+
+    @staticmethod
+    def pdf_page_markdown(data: bytes, page: int) -> str:
+        return PAGE.findall(data)[page - 1].decode()
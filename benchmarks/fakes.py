@@ -0,0 +1,241 @@
+"""In-process stand-ins for Blob Storage, Azure AI Search, Document Intelligence and the embedding model.
+Every fake answers after a configurable latency. Analysis, embedding and upload requests are throttled like
+the real services once their quota is used up, with a 429 carrying the Retry-After the client has to honor."""
+import hashlib
+import re
+import threading
+import time
+from collections import deque
+from types import SimpleNamespace
+from typing import Dict, List
+
+import httpx
+import openai
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+from azure.storage.blob import BlobPrefix, BlobProperties
+from langchain_core.embeddings import Embeddings
+
+from benchmarks.corpus import Corpus
+
+
+class FakeService:
+    """Latency and quota of one fake service. A request costs latency plus unit_latency per unit (page, token,
+    document) and is throttled when it would exceed requests_per_second or units_per_minute."""
+
+    def __init__(self, name: str, latency: float = 0.0, unit_latency: float = 0.0, requests_per_second: float = 0,
+                 units_per_minute: float = 0):
+        self.name = name
+        self.latency = latency
+        self.unit_latency = unit_latency
+        self.requests_per_second = requests_per_second
+        self.units_per_minute = units_per_minute
+        self.lock = threading.Lock()
+        self.recent_requests = deque()
+        self.recent_units = deque()
+        self.stats = {"requests": 0, "throttled": 0, "units": 0}
+
+    def request(self, units: int = 1, throttle=None):
+        """Waits out the latency of a request, or raises what throttle builds from the retry delay"""
+        with self.lock:
+            now = time.monotonic()
+            self.stats["requests"] += 1
+            while self.recent_requests and self.recent_requests[0] <= now - 1:
+                self.recent_requests.popleft()
+            while self.recent_units and self.recent_units[0][0] <= now - 60:
+                self.recent_units.popleft()
+            delay = 0.0
+            if self.requests_per_second and len(self.recent_requests) >= self.requests_per_second:
+                delay = self.recent_requests[0] + 1 - now
+            used = sum(amount for _, amount in self.recent_units)
+            if self.units_per_minute and self.recent_units and used + units > self.units_per_minute:
+                delay = max(delay, self.recent_units[0][0] + 60 - now)
+            if delay > 0 and throttle is not None:
+                self.stats["throttled"] += 1
+                raise throttle(delay)
+            self.recent_requests.append(now)
+            self.recent_units.append((now, units))
+            self.stats["units"] += units
+        time.sleep(self.latency + self.unit_latency * units)
+
+
+def azure_throttle(delay: float) -> HttpResponseError:
+    error = HttpResponseError(message="Too many requests")
+    error.status_code = 429
+    error.response = SimpleNamespace(status_code=429, headers={"retry-after-ms": str(int(delay * 1000) + 1)})
+    return error
+
+
+def openai_throttle(delay: float) -> openai.RateLimitError:
+    response = httpx.Response(429, headers={"retry-after-ms": str(int(delay * 1000) + 1)},
+                              request=httpx.Request("POST", "https://benchmark.openai.azure.com/embeddings"))
+    return openai.RateLimitError("Rate limit reached", response=response, body=None)
+
+
+class FakeBlobContainer:
+    """ContainerClient over a synthetic corpus, the content is generated on download"""
+
+    url = "https://benchmark.blob.core.windows.net/files"
+
+    def __init__(self, corpus: Corpus, service: FakeService):
+        self.corpus = corpus
+        self.service = service
+
+    def list_blobs(self, name_starts_with=None, include=None, results_per_page=5000):
+        listed = 0
+        for record in self.corpus.records():
+            if name_starts_with and not record.name.startswith(name_starts_with):
+                continue
+            # one request per page of results
+            if listed % results_per_page == 0:
+                self.service.request()
+            listed += 1
+            yield self.properties(record)
+
+    def walk_blobs(self, include=None, delimiter="/"):
+        self.service.request()
+        prefixes = set()
+        for record in self.corpus.records():
+            if delimiter in record.name:
+                prefixes.add(record.name.split(delimiter)[0] + delimiter)
+            else:
+                yield self.properties(record)
+        for prefix in sorted(prefixes):
+            yield BlobPrefix(prefix=prefix)
+
+    @staticmethod
+    def properties(record) -> BlobProperties:
+        blob = BlobProperties(name=record.name, **{"Last-Modified": record.last_modified, "ETag": record.etag,
+                                                   "Content-Length": record.size,
+                                                   "Content-Type": record.content_type,
+                                                   "Content-MD5": bytearray(record.md5)})
+        blob.deleted = record.deleted
+        return blob
+
+    def get_blob_client(self, name):
+        container = self
+
+        class Download:
+            def __init__(self, data: bytes):
+                self.size = len(data)
+                self.data = data
+
+            def readinto(self, stream):
+                stream.write(self.data)
+                return self.size
+
+        class Blob:
+            def download_blob(self, max_concurrency=1):
+                data = container.corpus.content(name)
+                if data is None:
+                    raise ResourceNotFoundError("The specified blob does not exist.")
+                container.service.request(units=max(1, len(data) // (1024 * 1024)))
+                return Download(data)
+
+            def get_blob_properties(self):
+                record = container.corpus.record(name)
+                if record is None or record.deleted:
+                    raise ResourceNotFoundError("The specified blob does not exist.")
+                return container.properties(record)
+
+        return Blob()
+
+
+class FakeSearchClient:
+    """SearchClient keeping the index in a dict. Understands the filters the indexer sends:
+    id gt '...', search.in(field, ...) and field eq '...' or ..."""
+
+    def __init__(self, service: FakeService):
+        self.service = service
+        self.documents: Dict[str, Dict] = {}
+        self.lock = threading.Lock()
+
+    def search(self, search_text="*", select=None, filter=None, order_by=None, top=None, **kwargs):
+        # queries are not throttled, only the uploads are
+        self.service.request()
+        with self.lock:
+            docs = [doc for doc in self.documents.values() if matches(doc, filter)]
+        if order_by:
+            docs.sort(key=lambda doc: doc["id"])
+        if top:
+            docs = docs[:top]
+        return iter([{field: doc.get(field) for field in select} if select else dict(doc) for doc in docs])
+
+    def get_document(self, key, selected_fields=None, **kwargs):
+        self.service.request()
+        with self.lock:
+            if key not in self.documents:
+                raise ResourceNotFoundError("Document not found")
+            doc = self.documents[key]
+        return {field: doc.get(field) for field in selected_fields} if selected_fields else dict(doc)
+
+    def index_documents(self, batch, **kwargs):
+        self.service.request(units=len(batch.actions), throttle=azure_throttle)
+        results = []
+        with self.lock:
+            for action in batch.actions:
+                doc = action.as_dict()
+                kind = doc.pop("@search.action")
+                if kind == "delete":
+                    self.documents.pop(doc["id"], None)
+                elif kind in ("merge", "mergeOrUpload"):
+                    self.documents.setdefault(doc["id"], {}).update(doc)
+                else:
+                    self.documents[doc["id"]] = doc
+                results.append(SimpleNamespace(key=doc["id"], succeeded=True, status_code=200, error_message=None))
+        return results
+
+
+def matches(doc: Dict, odata_filter: str) -> bool:
+    if not odata_filter:
+        return True
+    if m := re.fullmatch(r"id gt '(.*)'", odata_filter):
+        return doc["id"] > m.group(1).replace("''", "'")
+    if m := re.fullmatch(r"search\.in\((\w+), '(.*)', '(.)'\)", odata_filter, re.DOTALL):
+        return doc.get(m.group(1)) in {value.replace("''", "'") for value in m.group(2).split(m.group(3))}
+    values = re.findall(r"(\w+) eq '((?:[^']|'')*)'", odata_filter)
+    if values:
+        return any(doc.get(field) == value.replace("''", "'") for field, value in values)
+    raise ValueError(f"Filter not understood by the fake search client: {odata_filter}")
+
+
+class FakeDocumentIntelligenceClient:
+    """DocumentIntelligenceClient for the synthetic documents, the markdown of every PDF page is derived from
+    the bytes and the other formats are read as text"""
+
+    def __init__(self, service: FakeService):
+        self.service = service
+
+    def begin_analyze_document(self, model, document, pages=None, **kwargs):
+        data = document.read()
+        if not data.startswith(b"%PDF"):
+            self.service.request(units=1, throttle=azure_throttle)
+            result = SimpleNamespace(content=data.decode("utf-8", errors="ignore"), pages=[1])
+            return SimpleNamespace(result=lambda: result)
+        total = Corpus.pdf_pages(data)
+        first, last = (int(page) for page in pages.split("-")) if pages else (1, total)
+        if first > total:
+            raise HttpResponseError(message="Invalid page range")
+        numbers = range(first, min(last, total) + 1)
+        self.service.request(units=len(numbers), throttle=azure_throttle)
+        content = "\n\n<!-- PageBreak -->\n\n".join(Corpus.pdf_page_markdown(data, page) for page in numbers)
+        result = SimpleNamespace(content=content, pages=list(numbers))
+        return SimpleNamespace(result=lambda: result)
+
+
+class FakeEmbeddings(Embeddings):
+    """Deterministic vectors, one request per embed_documents call and units in estimated tokens"""
+
+    def __init__(self, service: FakeService, dimensions: int = 1536):
+        self.service = service
+        self.dimensions = dimensions
+
+    def embed_documents(self, texts: List[str], chunk_size: int = 0) -> List[List[float]]:
+        self.service.request(units=sum(len(text) // 4 + 1 for text in texts), throttle=openai_throttle)
+        return [self.vector(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    def vector(self, text: str) -> List[float]:
+        seed = hashlib.md5(text.encode("utf-8")).digest()
+        return [(seed[i % 16] - 128) / 128 for i in range(self.dimensions)]
@@ -0,0 +1,308 @@
+"""Offline benchmark of sync runs against the fakes in benchmarks.fakes, no Azure resources are used.
+
+    python -m benchmarks.run                                    # all scenarios, compared with the baselines
+    python -m benchmarks.run --scenario update --documents 2000 --churn 0.05
+    python -m benchmarks.run --save                             # stores the results as the new baselines
+
+Scenarios: initial indexes the corpus into an empty index, update indexes the churn of an indexed corpus and
+noop runs again over an indexed corpus that did not change. Reports docs/sec, chunks/sec, the requests sent to
+every service and the peak RSS while each stage of the run had work in flight."""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+from typing import Callable, Dict
+from unittest import mock
+
+from blob_sync import ratelimit
+from blob_sync.azure_ai_search import AzureAISearchIndexer
+from blob_sync.azure_document_intelligence import AzureDocumentIntelligenceMediaHandler
+from blob_sync.blob import BlobWrapper
+from blob_sync.config import get_config
+from blob_sync.local_index import LocalSearchClient, LocalVectorStore
+
+from benchmarks.corpus import Corpus
+from benchmarks.fakes import FakeBlobContainer, FakeDocumentIntelligenceClient, FakeEmbeddings, FakeSearchClient, \
+    FakeService
+
+SCENARIOS = ["initial", "update", "noop"]
+BASELINES_PATH = os.path.join(os.path.dirname(__file__), "baselines.json")
+# A base64 account key, the blob service client is never used to connect
+FAKE_ACCOUNT_KEY = "YmVuY2htYXJrYmVuY2htYXJrYmVuY2htYXJrYmVuY2htYXJr"
+
+
+def services(latency_scale: float = 1.0, throttle: bool = True) -> Dict[str, FakeService]:
+    """Latencies in the range of the real services from a nearby region, with their default quotas"""
+    return {"storage": FakeService("storage", latency=0.005 * latency_scale, unit_latency=0.01 * latency_scale),
+            "search": FakeService("search", latency=0.02 * latency_scale, unit_latency=0.0001 * latency_scale,
+                                  requests_per_second=50 if throttle else 0),
+            "document_intelligence": FakeService("document_intelligence", latency=0.05 * latency_scale,
+                                                 unit_latency=0.01 * latency_scale,
+                                                 requests_per_second=15 if throttle else 0),
+            "openai": FakeService("openai", latency=0.03 * latency_scale, unit_latency=0.000002 * latency_scale,
+                                  units_per_minute=1_000_000 if throttle else 0)}
+
+
+def benchmark_config(**overrides) -> Dict:
+    config = get_config()
+    config.update({"search_type": "AZURE_COGNITIVE_SEARCH",
+                   "azure_search_endpoint": "https://benchmark.search.windows.net",
+                   "azure_search_key": "benchmark",
+                   "azure_search_full_reindex": False,
+                   "account_name": "benchmark",
+                   "account_key": FAKE_ACCOUNT_KEY,
+                   "embedding_cache_path": "",
+                   "document_intelligence_cache_path": "",
+                   "journal_path": "",
+                   "incremental_mode": "off",
+                   "shard_count": 1})
+    config.update(overrides)
+    return config
+
+
+def build(config: Dict, corpus: Corpus, fakes: Dict[str, FakeService], search_client: FakeSearchClient):
+    """An indexer and a blob client wired to the fakes, as sync() would build them"""
+    # Limiters start from their configured concurrency in every run
+    ratelimit.scheduler.limiters.clear()
+    environment = {"OPENAI_API_KEY": "benchmark"}
+    with mock.patch.dict(os.environ, environment):
+        for variable in ("AZURE_OPENAI_ENDPOINT", "OPENAI_API_BASE"):
+            os.environ.pop(variable, None)
+        indexer = AzureAISearchIndexer(config)
+        indexer.batch_embedder.embedder = FakeEmbeddings(fakes["openai"])
+    indexer.client = search_client
+    indexer.writer.client = search_client
+    blob_client = BlobWrapper(config["account_name"], config["account_key"], config["container_name"],
+                              max_concurrency=config["download_max_concurrency"],
+                              spool_max_bytes=config["download_spool_max_mb"] * 1024 * 1024,
+                              prefixes=config["storage_prefixes"],
+                              list_workers=config["storage_list_workers"])
+    blob_client.container = FakeBlobContainer(corpus, fakes["storage"])
+    handler = AzureDocumentIntelligenceMediaHandler("https://benchmark.cognitiveservices.azure.com", "benchmark",
+                                                    page_range_size=config["document_intelligence_page_range"],
+                                                    range_concurrency=config[
+                                                        "document_intelligence_range_concurrency"],
+                                                    limiter=indexer.scheduler.limiter("document_intelligence"))
+    handler.client = FakeDocumentIntelligenceClient(fakes["document_intelligence"])
+    blob_client.media_handler = handler
+    indexer.blob_client = blob_client
+    return indexer, blob_client
+
+
+class RssSampler:
+    """Samples the resident set size and keeps the peak overall and per stage with work in flight"""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.active: Dict[str, int] = {}
+        self.calls: Dict[str, int] = {}
+        self.peaks: Dict[str, int] = {}
+        self.peak = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+
+    def track(self, stage: str, fn: Callable) -> Callable:
+        def tracked(*args, **kwargs):
+            with self.lock:
+                self.active[stage] = self.active.get(stage, 0) + 1
+                self.calls[stage] = self.calls.get(stage, 0) + 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.active[stage] -= 1
+
+        return tracked
+
+    def _sample(self):
+        while not self.stopped.wait(self.interval):
+            rss = current_rss()
+            with self.lock:
+                self.peak = max(self.peak, rss)
+                for stage, count in self.active.items():
+                    if count:
+                        self.peaks[stage] = max(self.peaks.get(stage, 0), rss)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stopped.set()
+        self.thread.join()
+
+
+def current_rss() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # peak instead of current outside of Linux, in KB on Linux and bytes on macOS
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return usage if sys.platform == "darwin" else usage * 1024
+
+
+def index_run(config: Dict, corpus: Corpus, fakes: Dict[str, FakeService], search_client: FakeSearchClient,
+              measure: bool = True) -> Dict:
+    """One sync run over the full listing, as sync() does it"""
+    indexer, blob_client = build(config, corpus, fakes, search_client)
+    for fake in fakes.values():
+        fake.stats = {"requests": 0, "throttled": 0, "units": 0}
+    sampler = RssSampler()
+    if measure:
+        # the plan stage lasts from the listing until the work is handed to the pipeline
+        apply = indexer.apply
+
+        def planned(*args, **kwargs):
+            with sampler.lock:
+                sampler.active["plan"] = 0
+            return apply(*args, **kwargs)
+
+        sampler.active["plan"] = 1
+        indexer.apply = planned
+        for stage in ("download", "analyze", "embed", "write"):
+            setattr(indexer, f"{stage}_job", sampler.track(stage, getattr(indexer, f"{stage}_job")))
+    start = time.perf_counter()
+    with sampler:
+        indexer.index(changeset={"blobs": blob_client.iter_blobs()})
+    seconds = time.perf_counter() - start
+    diagnostics = indexer.diagnostics
+    documents = sum(diagnostics["counts"][action] for action in ("create", "update", "remove"))
+    requests = {name: dict(fake.stats) for name, fake in fakes.items()}
+    indexed = {doc["document_id"] for doc in search_client.search(search_text="*", select=["document_id"])}
+    return {"seconds": round(seconds, 3),
+            "documents": documents,
+            "chunks": diagnostics["chunks"]["uploaded"],
+            "docs_per_second": round(documents / seconds, 2),
+            "chunks_per_second": round(diagnostics["chunks"]["uploaded"] / seconds, 2),
+            "requests": requests,
+            "stages": {stage: {"items": stats.get("items", sampler.calls.get(stage, 0)),
+                               "seconds": round(stats.get("seconds", 0), 3),
+                               "peak_rss_mb": round(sampler.peaks.get(stage, 0) / 2 ** 20, 1)}
+                       for stage, stats in [("plan", {})] + list(diagnostics["stages"].items()) + [("write", {})]},
+            "peak_rss_mb": round(sampler.peak / 2 ** 20, 1),
+            "dedup": dict(diagnostics["dedup"]),
+            "budget": diagnostics["budget"],
+            "consistent": indexed == set(corpus.live())}
+
+
+def run_scenario(scenario: str, args: argparse.Namespace) -> Dict:
+    config = benchmark_config(azure_search_snapshot=args.snapshot)
+    corpus = Corpus(documents=args.documents, pages=args.pages, seed=args.seed, copy_share=args.copies)
+    fakes = services(args.latency_scale, throttle=not args.no_throttle)
+    if args.search == "local":
+        # the search service out of the picture, the index is written to local files
+        index_path = tempfile.mkdtemp(prefix="benchmark-index-")
+        search_client = LocalSearchClient(LocalVectorStore(index_path, config["azure_search_vector_dimensions"] or 1536))
+    else:
+        search_client = FakeSearchClient(fakes["search"])
+    if scenario != "initial":
+        # indexing the corpus first is not measured and does not wait on the fakes
+        latencies = {name: (fake.latency, fake.unit_latency) for name, fake in fakes.items()}
+        for fake in fakes.values():
+            fake.latency = fake.unit_latency = 0
+        index_run(config, corpus, fakes, search_client, measure=False)
+        for name, fake in fakes.items():
+            fake.latency, fake.unit_latency = latencies[name]
+        if scenario == "update":
+            corpus.churn(args.churn)
+    try:
+        result = index_run(config, corpus, fakes, search_client)
+    finally:
+        if args.search == "local":
+            search_client.store.drop()
+    result["parameters"] = {"documents": args.documents, "pages": args.pages, "churn": args.churn,
+                            "snapshot": args.snapshot, "latency_scale": args.latency_scale,
+                            "throttle": not args.no_throttle, "seed": args.seed, "copies": args.copies,
+                            "search": args.search}
+    return result
+
+
+def regressions(result: Dict, baseline: Dict, tolerance: float) -> list:
+    """What got worse than the baseline by more than tolerance, only against a baseline of the same parameters"""
+    if not baseline or baseline.get("parameters") != result["parameters"]:
+        return []
+    found = []
+    for metric in ("docs_per_second", "chunks_per_second"):
+        if baseline[metric] and result[metric] < baseline[metric] * (1 - tolerance):
+            found.append(f"{metric} {result[metric]} < baseline {baseline[metric]}")
+    requests = sum(stats["requests"] for stats in result["requests"].values())
+    baseline_requests = sum(stats["requests"] for stats in baseline["requests"].values())
+    if requests > baseline_requests * (1 + tolerance):
+        found.append(f"requests {requests} > baseline {baseline_requests}")
+    # runs without work are measured by their duration, with some slack for the noise of short runs
+    if result["seconds"] > baseline["seconds"] * (1 + tolerance) + 0.1:
+        found.append(f"seconds {result['seconds']} > baseline {baseline['seconds']}")
+    if result["peak_rss_mb"] > baseline["peak_rss_mb"] * (1 + tolerance):
+        found.append(f"peak_rss_mb {result['peak_rss_mb']} > baseline {baseline['peak_rss_mb']}")
+    if not result["consistent"]:
+        found.append("the index does not match the corpus")
+    return found
+
+
+def report(scenario: str, result: Dict, found: list):
+    requests = ", ".join(f"{name} {stats['requests']}" + (f" ({stats['throttled']} throttled)"
+                                                           if stats["throttled"] else "")
+                         for name, stats in result["requests"].items())
+    print(f"{scenario}: {result['documents']} documents, {result['chunks']} chunks in {result['seconds']}s, "
+          f"{result['docs_per_second']} docs/s, {result['chunks_per_second']} chunks/s, "
+          f"peak RSS {result['peak_rss_mb']} MB")
+    print(f"  requests: {requests}")
+    for stage, stats in result["stages"].items():
+        print(f"  {stage}: {stats['items']} items, {stats['seconds']}s busy, peak RSS {stats['peak_rss_mb']} MB")
+    if not result["consistent"]:
+        print("  the index does not match the corpus")
+    for regression in found:
+        print(f"  REGRESSION {regression}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Offline benchmark of sync runs against fake services")
+    parser.add_argument("--scenario", choices=SCENARIOS, action="append")
+    parser.add_argument("--documents", type=int, default=200)
+    parser.add_argument("--pages", type=int, default=4, help="pages of every PDF")
+    parser.add_argument("--churn", type=float, default=0.1, help="share of the documents changed for update")
+    parser.add_argument("--snapshot", choices=["off", "memory", "disk"], default="memory")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="0 for no latency at all")
+    parser.add_argument("--no-throttle", action="store_true", help="no quotas on the fake services")
+    parser.add_argument("--search", choices=["fake", "local"], default="fake",
+                        help="the fake Azure AI Search, or the LOCAL index in a temporary directory")
+    parser.add_argument("--copies", type=float, default=0.0, help="share of the documents that copy another one")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--save", action="store_true", help="store the results as the baselines")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    try:
+        with open(BASELINES_PATH) as f:
+            baselines = json.load(f)
+    except FileNotFoundError:
+        baselines = {}
+    results = {}
+    failed = False
+    for scenario in args.scenario or SCENARIOS:
+        # a fresh process for every scenario, the peak RSS of one would carry over to the next
+        with multiprocessing.get_context("spawn").Pool(1) as pool:
+            results[scenario] = pool.apply(run_scenario, (scenario, args))
+        found = regressions(results[scenario], baselines.get(scenario), args.tolerance)
+        failed = failed or bool(found)
+        report(scenario, results[scenario], found)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.save:
+        baselines.update(results)
+        with open(BASELINES_PATH, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
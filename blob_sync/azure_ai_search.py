@@ -2,21 +2,46 @@ import base64
 import json
 import logging
 import os
+import re
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime, timezone
-from typing import List, Dict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
 import hashlib
+from itertools import chain
 
 
-import requests
 from azure.core.credentials import AzureKeyCredential
-from azure.identity import DefaultAzureCredential
 from azure.search.documents import SearchClient
 from azure.storage.blob import BlobProperties
-from langchain_openai import AzureOpenAIEmbeddings, OpenAIEmbeddings
+
+from blob_sync.blob import BlobRecord, as_record
+from blob_sync.budget import RunBudget, priority_key
+from blob_sync.cache import LocalCache
+from blob_sync.chunking import Chunk
+from blob_sync.embedding import BatchedEmbedder
+from blob_sync.index_writer import IndexWriter
+from blob_sync.journal import RunJournal
+from blob_sync.otel import telemetry
+from blob_sync.pipeline import Pipeline
+from blob_sync.ratelimit import scheduler_from_config
+from blob_sync.snapshot import IndexSnapshot
+from blob_sync.transport import AsyncTransport, transport_from_config
+from blob_sync.vectors import encode_vector, vector_schema
+
+# Aliases are only in the preview api versions
+ALIAS_API_VERSION = "2024-05-01-preview"
+REBUILD_MODES = {"off", "shadow", "rollback"}
 
 
 class AzureAISearchIndexer:
     datetime_format = '%Y-%m-%dT%H:%M:%S.%fZ'
+    snapshot_page_size = 1000
+    remove_lookup_batch_size = 100
+    # A new index is searchable after a short delay, its documents are counted again before the rebuild fails
+    rebuild_validation_attempts = 3
+    rebuild_validation_wait = 5
 
     def __init__(self, config):
         self.attachment_cache = {}
@@ -26,32 +51,433 @@ class AzureAISearchIndexer:
         self.endpoint = config["azure_search_endpoint"]
         self.index_name = config["azure_search_index"]
         self.full_reindex = config["azure_search_full_reindex"]
+        self.dedup = config["azure_search_dedup"]
+        self.snapshot_mode = config["azure_search_snapshot"]
+        # The name the applications query, switched to a new version of the index by a rebuild
+        self.alias = config["azure_search_alias"]
+        self.rebuild = config["azure_search_rebuild"]
+        if self.rebuild not in REBUILD_MODES:
+            raise ValueError(f"Unknown rebuild mode {self.rebuild}, one of {', '.join(sorted(REBUILD_MODES))}")
+        if self.rebuild != "off" and not self.alias:
+            raise ValueError("AZURE_SEARCH_REBUILD needs AZURE_SEARCH_ALIAS, the alias is what a rebuild switches")
+        self.rebuild_max_missing = config["azure_search_rebuild_max_missing"]
+        self.rebuild_keep = config["azure_search_rebuild_keep"]
+        # The index the alias pointed to when the rebuild started
+        self.live_index = None
+        self.pipeline_workers = {"download": config["pipeline_download_workers"],
+                                 "analyze": config["pipeline_analysis_workers"],
+                                 "embed": config["pipeline_embedding_workers"]}
+        self.pipeline_queue_size = config["pipeline_queue_size"]
+        self.api_version = config["azure_search_api_version"]
+        self.vector_dimensions = config["azure_search_vector_dimensions"] or 1536
+        self.vector_type = config["azure_search_vector_type"]
+        self.vector_compression = config["azure_search_vector_compression"]
+        self.vector_stored = config["azure_search_vector_stored"]
+        self.vector_oversampling = config["azure_search_vector_oversampling"]
+        # Fails on a bad setting before anything is embedded
+        vector_schema(self.vector_dimensions, self.vector_type, self.vector_compression, self.vector_stored,
+                      self.vector_oversampling, self.api_version)
+        # Shared with the Document Intelligence handler, all the calls of the run are paced together
+        self.scheduler = scheduler_from_config(config)
+        # Connections and credential shared with the blob and Document Intelligence clients
+        self.transport = transport_from_config(config)
+        # Order of the work of a run, and when to stop taking more of it
+        self.priority = priority_key(config["run_priority"])
+        self.budget = RunBudget(self.scheduler, seconds=config["run_budget_seconds"], calls=config["run_budget_calls"],
+                                tokens=config["run_budget_tokens"])
+        if self.budget.limited and self.rebuild == "shadow":
+            raise ValueError("A rebuild has to index every blob before the alias is switched, it cannot have a budget")
+        if self.budget.limited and not config["journal_path"] and self.snapshot_mode == "off":
+            # the lookup diff stops at the first blob indexed after its last change, the older deferred ones
+            # would never be reached
+            raise ValueError("Blobs deferred by the run budget are carried over by JOURNAL_PATH or found by the "
+                             "snapshot diff, a budget needs one of them")
+        self.embedding_cache = LocalCache(config["embedding_cache_path"],
+                                          max_bytes=config["embedding_cache_max_mb"] * 1024 * 1024) if config[
+            "embedding_cache_path"] else None
+        # Created on the first chunk to embed, a run without changes never loads langchain and openai
+        self.config = config
+        self._batch_embedder = None
+        self.embedder_lock = threading.Lock()
+        self.now = datetime.utcnow().strftime(self.datetime_format)
+        self.client = self.create_client(config)
+        # Shared by all items of a run, chunks are sent in bulk instead of one request per chunk
+        self.writer = IndexWriter(self.client,
+                                  max_documents=config["azure_search_upload_batch_size"],
+                                  max_bytes=config["azure_search_upload_batch_mb"] * 1024 * 1024,
+                                  on_flush=self.flushed,
+                                  limiter=self.scheduler.limiter("search"))
+        # Stage of every item of the run, for resuming a run that died halfway
+        self.journal = RunJournal(config["journal_path"]) if config["journal_path"] else None
+        # Items handed to the writer, by the stage they reach once the writer flushes
+        self.awaiting_flush = {}
+        # The item whose actions are being handed to the writer, a flush in between does not finish it
+        self.writing = None
+        # Blobs of the run by content md5, the copies of a blob wait for its chunks and vectors
+        self.copies = {}
+        self.copies_lock = threading.Lock()
+        # Documents already in the index by the content md5 of their blob
+        self.indexed_copies = {}
+        self.blob_client = None
+        self.snapshot = None
+        self.reset()
+
+    @property
+    def batch_embedder(self) -> BatchedEmbedder:
+        if self._batch_embedder is None:
+            with self.embedder_lock:
+                if self._batch_embedder is None:
+                    config = self.config
+                    self._batch_embedder = BatchedEmbedder(self.create_embedder(config),
+                                                           model=config["azure_search_embedding_model"],
+                                                           batch_size=config["embedding_batch_size"],
+                                                           batch_tokens=config["embedding_batch_tokens"],
+                                                           concurrency=config["embedding_concurrency"],
+                                                           cache=self.embedding_cache,
+                                                           dimensions=config["azure_search_vector_dimensions"] or None,
+                                                           limiter=self.scheduler.limiter("openai"))
+        return self._batch_embedder
+
+    def create_embedder(self, config):
+        from langchain_openai import AzureOpenAIEmbeddings, OpenAIEmbeddings
         # Check if env value contains 'azure'
         if os.getenv("OPENAI_API_BASE", "").find("azure") > -1 or os.getenv("AZURE_OPENAI_ENDPOINT", None) is not None:
             if os.getenv("AZURE_OPENAI_ENDPOINT ", None) is None:
                 os.environ["AZURE_OPENAI_ENDPOINT"] = os.getenv("OPENAI_API_BASE")
                 del os.environ["OPENAI_API_BASE"]
-            self.embedder = AzureOpenAIEmbeddings(azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT", ""),
-                                                  deployment=config["azure_search_embedding_model"],
-                                                  chunk_size=1)
-        else:
-            self.embedder = OpenAIEmbeddings(deployment=config["azure_search_embedding_model"],
-                                             chunk_size=1,
-                                             )
-        self.now = datetime.utcnow().strftime(self.datetime_format)
+            return AzureOpenAIEmbeddings(azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT", ""),
+                                         deployment=config["azure_search_embedding_model"],
+                                         chunk_size=config["embedding_batch_size"],
+                                         # shortened vectors, only the text-embedding-3 models take it
+                                         dimensions=config["azure_search_vector_dimensions"] or None,
+                                         # throttled requests are retried by the scheduler
+                                         max_retries=0,
+                                         http_client=self.transport.http_client,
+                                         http_async_client=self.transport.async_http_client)
+        return OpenAIEmbeddings(deployment=config["azure_search_embedding_model"],
+                                chunk_size=config["embedding_batch_size"],
+                                dimensions=config["azure_search_vector_dimensions"] or None,
+                                max_retries=0,
+                                http_client=self.transport.http_client,
+                                http_async_client=self.transport.async_http_client
+                                )
+
+    def create_client(self, config) -> SearchClient:
         self.credential = AzureKeyCredential(config["azure_search_key"]) if config[
-            "azure_search_key"] else DefaultAzureCredential()
-        self.client = SearchClient(endpoint=self.endpoint, index_name=self.index_name, credential=self.credential)
-        self.blob_client = None
-        self.reset()
+            "azure_search_key"] else self.transport.credential()
+        return SearchClient(endpoint=self.endpoint, index_name=self.index_name, credential=self.credential,
+                            **self.transport.azure_kwargs())
+
+    def aio_client(self, aio: AsyncTransport):
+        """A search client of the index for async code, on the connections of aio"""
+        from azure.search.documents.aio import SearchClient as AsyncSearchClient
+
+        credential = AzureKeyCredential(self.config["azure_search_key"]) if self.config["azure_search_key"] \
+            else aio.credential()
+        return AsyncSearchClient(endpoint=self.endpoint, index_name=self.index_name, credential=credential,
+                                 **aio.azure_kwargs())
+
+    def index(self, changeset: Dict[str, Iterable], owns: Callable[[str], bool] = None,
+              stop: Callable[[], bool] = None):
+        """Indexes the changes of the container. The changeset has either the full blob listing as a stream
+        in "blobs", soft deleted blobs included, or the lists of changed "upsert" and "remove" blobs.
+        With owns, only the blobs and index documents it accepts are handled (one shard of a sharded run).
+        Once stop returns True no more blobs enter the pipeline, the ones in it are finished"""
+        # The listing and the lookups are part of the run's time
+        self.budget.start()
+        if "blobs" in changeset:
+            blobs = map(as_record, changeset["blobs"])
+        else:
+            blobs = map(as_record, chain(changeset["upsert"], changeset["remove"]))
+        if owns:
+            blobs = (blob for blob in blobs if owns(blob.name))
+        # Scanning the whole index only pays off against a full listing
+        if self.rebuild == "shadow":
+            # The new version starts empty, every live blob is created and nothing is looked up or deleted
+            with telemetry.span("list", root=True):
+                create = [blob for blob in blobs if not blob.deleted]
+            create.sort(key=lambda x: x["last_modified"], reverse=True)
+            update, remove = [], []
+        elif self.snapshot_mode in ("memory", "disk") and "blobs" in changeset:
+            # One scan of the index instead of a lookup per blob, the listing is not held in memory
+            with telemetry.span("lookup", root=True, mode="snapshot"):
+                self.snapshot = self.load_snapshot(owns)
+            with telemetry.span("list", root=True):
+                create, update, remove = self.snapshot.diff(blobs, self.full_reindex)
+            create.sort(key=lambda x: x["last_modified"], reverse=True)
+            update.sort(key=lambda x: x["last_modified"], reverse=True)
+        else:
+            upserts = []
+            remove = []
+            with telemetry.span("list", root=True):
+                for blob in blobs:
+                    (remove if blob.deleted else upserts).append(blob)
+            with telemetry.span("lookup", root=True, mode="per_blob"):
+                create, update = self.find_upserts(upserts, stop_early="blobs" in changeset)
+            # A soft deleted blob can have a live blob with the same name, that one wins
+            live = {item.name for item in upserts}
+            remove = [item for item in remove if item.name not in live]
+
+        extraction_cache = getattr(self.blob_client.media_handler, "cache", None)
+        if extraction_cache is not None:
+            extraction_cache.reset()
+        self.diagnostics["extraction_cache"] = extraction_cache.stats if extraction_cache else None
+        try:
+            self.apply(create, update, remove, owns=owns, stop=stop)
+        finally:
+            if self.snapshot:
+                self.snapshot.close()
+                self.snapshot = None
+        if self.rebuild == "shadow":
+            self.finish_rebuild(create)
+
+    def apply(self, create: List[BlobRecord], update: List[BlobRecord], remove: List[BlobRecord],
+              owns: Callable[[str], bool] = None, stop: Callable[[], bool] = None):
+        if self.journal:
+            create, update, remove = self.journal.start(create, update, remove, owns=owns)
+            self.diagnostics["journal"] = self.journal.stats
+        # remove items in changeset remove
+        with telemetry.span("delete", root=True, documents=len(remove)):
+            counts = self.remove_items(remove)
+        self.awaiting_flush.update({item.name: "removed" for item in remove})
+        # The count is number of chunks, not documents
+        self.diagnostics["counts"]["remove"] += len([count for count in counts.values() if count > 0])
+        # update items chunk by chunk, the chunk keys are derived from their content ->
+        # unchanged chunks stay as they are, changed ones are uploaded and the orphans deleted.
+        # The document stays searchable during the update
+        with telemetry.span("lookup", root=True, mode="chunk_keys"):
+            existing = self.chunk_keys([item["name"] for item in update])
+        jobs = []
+        for item in update:
+            self.diagnostics["counts"]["update"] += 1
+            jobs.append({"item": item, "action": "update", "existing": existing[item["name"]]})
+        # create new items
+        for item in create:
+            self.diagnostics["counts"]["create"] += 1
+            jobs.append({"item": item, "action": "create", "existing": []})
+        # With a budget the blobs at the end of the order are the ones deferred
+        jobs.sort(key=lambda job: self.priority(job["item"]))
+        self.copies = {}
+        if self.dedup == "index" and not self.full_reindex and self.rebuild != "shadow":
+            with telemetry.span("lookup", root=True, mode="content_md5"):
+                # the documents this run rewrites with other content or removes cannot be copied from
+                rewritten = {job["item"].name: job["item"].content_md5.hex() if job["item"].content_md5 else None
+                             for job in jobs if job["action"] == "update"}
+                rewritten.update({item.name: None for item in remove})
+                self.indexed_copies = self.find_indexed_copies([job["item"] for job in jobs], rewritten)
+        # Download, analysis and embedding of different items overlap, the writer is only used from this thread
+        pipeline = Pipeline([("download", self.download_job, self.pipeline_workers["download"]),
+                             ("analyze", self.analyze_job, self.pipeline_workers["analyze"]),
+                             ("embed", self.embed_job, self.pipeline_workers["embed"])],
+                            queue_size=self.pipeline_queue_size)
+        deferred = []
+        pipeline.run(self.budget.admit(jobs, deferred, stop), self.write_job, describe=lambda job: job["item"].name)
+        # The copies of a blob that failed are indexed on their own, the failure may not be in the content
+        orphaned = []
+        for group in self.copies.values():
+            for job in group["copies"]:
+                if group["texts"] is None:
+                    job["dedup"] = False
+                    orphaned.append(job)
+                else:
+                    try:
+                        self.write_copy(job, group)
+                    except Exception as e:
+                        logging.warning(f"copy failed for {job['item'].name}: {e}")
+                        self.diagnostics["incomplete"] += 1
+        self.copies = {}
+        self.indexed_copies = {}
+        if orphaned:
+            pipeline.run(orphaned, self.write_job, describe=lambda job: job["item"].name)
+        self.diagnostics["stages"] = pipeline.stats
+        self.writer.flush()
+        # Items dropped by a stage or deferred, the ones with failed chunks are counted by flushed
+        self.diagnostics["incomplete"] += sum(stats["errors"] for stats in pipeline.stats.values()) + len(deferred)
+        if self.budget.limited:
+            # Left in the journal as listed, the next run resumes them first
+            for job in deferred:
+                self.diagnostics["counts"][job["action"]] -= 1
+            self.diagnostics["budget"] = {"limits": self.budget.limits, "spent": self.budget.spent(),
+                                          "exhausted": self.budget.exhausted(), "deferred": len(deferred),
+                                          "deferred_items": [job["item"].name for job in deferred[:100]]}
+            if deferred:
+                logging.info(f"Run budget used up, {len(deferred)} blobs deferred to the next run")
+        if self.journal:
+            self.journal.finish()
+
+    def download_job(self, job: Dict) -> Optional[Dict]:
+        item = job["item"]
+        # A copy of a blob of the run is not downloaded at all when storage has the md5 of its content
+        if item.content_md5 and not self.lead(job, item.content_md5.hex()):
+            return None
+        # One trace per blob, its stages run in the threads of the pipeline
+        job["span"] = telemetry.start_blob(item.name, job["action"])
+        if job.get("content_md5") in self.indexed_copies:
+            with self.stage(job, "copy"):
+                job["texts"], job["vectors"] = self.copy_from_index(self.indexed_copies[job["content_md5"]])
+            if job["texts"] is not None:
+                with self.copies_lock:
+                    self.diagnostics["dedup"]["indexed_copies"] += 1
+                return job
+        with self.stage(job, "download"):
+            job["content"] = self.blob_client.download(item)
+        telemetry.payload("download", item.size or 0)
+        return job
+
+    def analyze_job(self, job: Dict) -> Optional[Dict]:
+        if job.get("texts") is not None:
+            return job
+        content = job.pop("content")
+        if "content_md5" not in job and not self.lead(job, content.content_hash()):
+            content.close()
+            telemetry.end_blob(job.pop("span"))
+            return None
+        with self.stage(job, "analyze"), content:
+            job["texts"] = [chunk.text for chunk in self.blob_client.media_handler.handle(content)]
+        if self.journal:
+            self.journal.mark([job["item"].name], "extracted")
+        return job
+
+    def embed_job(self, job: Dict) -> Dict:
+        with self.stage(job, "embed", chunks=len(job["texts"])):
+            job["changes"] = self.prepare_changes(job["item"], job["texts"], job["existing"], job.get("vectors"),
+                                                  job.get("content_md5"))
+        if self.journal:
+            self.journal.mark([job["item"].name], "embedded")
+        return job
+
+    def write_job(self, job: Dict):
+        with self.stage(job, "write"), self.handing_over(job["item"].name, "uploaded"):
+            self.write_changes(job["item"].name, job["changes"])
+        telemetry.end_blob(job.pop("span"))
+        if not job["texts"]:
+            self.empty_documents.add(job["item"].name)
+        self.led(job)
+
+    def lead(self, job: Dict, content_md5: str) -> bool:
+        """Claims the content for the job. False when a blob of the run with the same content is being indexed,
+        the job then waits in its group and is written from that blob's chunks once the pipeline is done"""
+        job["content_md5"] = content_md5
+        if self.dedup == "off" or not job.get("dedup", True):
+            return True
+        with self.copies_lock:
+            group = self.copies.get(content_md5)
+            if group is None:
+                self.copies[content_md5] = {"leader": job["item"].name, "done": False, "texts": None,
+                                            "vectors": None, "copies": []}
+                job["leads"] = True
+                return True
+            if group["done"]:
+                # Too late to wait for, its chunks are not kept
+                return True
+            group["copies"].append(job)
+            return False
+
+    def led(self, job: Dict, failed: bool = False):
+        """The leading job is written or failed, its chunks and vectors are kept if it has copies waiting"""
+        if not job.pop("leads", False):
+            return
+        with self.copies_lock:
+            group = self.copies[job["content_md5"]]
+            group["done"] = True
+            if group["copies"] and not failed:
+                group["texts"] = job["texts"]
+                group["vectors"] = {doc["chunk"]: doc["chunkVector"] for doc in job["changes"]["changed"]}
+                if job.get("vectors"):
+                    group["vectors"].update(job["vectors"])
+
+    def write_copy(self, job: Dict, group: Dict):
+        """Writes a copy from the chunks of the blob with the same content, only the unknown vectors are embedded"""
+        job["span"] = telemetry.start_blob(job["item"].name, job["action"])
+        with self.stage(job, "copy", leader=group["leader"]), self.handing_over(job["item"].name, "uploaded"):
+            self.write_changes(job["item"].name, self.prepare_changes(job["item"], group["texts"], job["existing"],
+                                                                      group["vectors"], job["content_md5"]))
+        telemetry.end_blob(job.pop("span"))
+        if not group["texts"]:
+            self.empty_documents.add(job["item"].name)
+        self.diagnostics["dedup"]["copies"] += 1
+
+    def find_indexed_copies(self, items: List[BlobRecord],
+                            rewritten: Dict[str, Optional[str]] = None) -> Dict[str, Dict]:
+        """Finds the documents in the index with the same content as the blobs, by the content md5 kept on
+        their first chunk. The blobs' own documents count, a blob rewritten with the same bytes is a copy of itself.
+        rewritten has the new content md5 (None when unknown or removed) of the documents this run writes:
+        the ones getting other content are skipped, their chunks may change while they are copied"""
+        rewritten = rewritten or {}
+        hashes = list({item.content_md5.hex() for item in items if item.content_md5})
+        copies = {}
+        for i in range(0, len(hashes), self.remove_lookup_batch_size):
+            for result in self.client.search(search_text="*", select=["document_id", "content_md5", "chunk_ids"],
+                                             filter=in_filter("content_md5",
+                                                              hashes[i:i + self.remove_lookup_batch_size])):
+                name = result["document_id"]
+                if result.get("chunk_ids") and (name not in rewritten or rewritten[name] == result["content_md5"]):
+                    copies.setdefault(result["content_md5"], result)
+        return copies
+
+    def copy_from_index(self, source: Dict) -> Tuple[Optional[List[str]], Optional[Dict[str, List[float]]]]:
+        """Reads the chunks of an indexed document in order, with their vectors unless they are not stored.
+        None when chunks are missing, the document was removed or rewritten since it was found"""
+        fields = ["id", "chunk", "chunkVector"] if self.vector_stored else ["id", "chunk"]
+        docs = {}
+        keys = source["chunk_ids"]
+        for i in range(0, len(keys), self.remove_lookup_batch_size):
+            for result in self.client.search(search_text="*", select=fields,
+                                             filter=in_filter("id", keys[i:i + self.remove_lookup_batch_size])):
+                docs[result["id"]] = result
+        if any(key not in docs for key in keys):
+            return None, None
+        texts = [docs[key]["chunk"] for key in keys]
+        vectors = {doc["chunk"]: doc["chunkVector"] for doc in docs.values() if doc.get("chunkVector")}
+        return texts, vectors
+
+    @contextmanager
+    def stage(self, job: Dict, name: str, **attributes):
+        """A stage of the blob's trace, a failure ends the trace as the pipeline drops the blob"""
+        try:
+            with telemetry.span(name, parent=job["span"], **attributes):
+                yield
+        except Exception as e:
+            telemetry.end_blob(job.pop("span"), e)
+            self.led(job, failed=True)
+            raise
+
+    @contextmanager
+    def handing_over(self, name: str, stage: str):
+        """The actions of the item are handed to the writer. A flush in between leaves it waiting for the next one,
+        an item that fails on the way is not finished by a later flush"""
+        self.awaiting_flush[name] = stage
+        self.writing = name
+        try:
+            yield
+        except Exception:
+            self.awaiting_flush.pop(name, None)
+            raise
+        finally:
+            self.writing = None
 
-    def index(self, changeset: Dict[str, List]):
-        """List all documents in the index and map to spaces with their pages"""
+    def flushed(self, failed: List[Dict]):
+        """The items handed to the writer before the flush are done, except the ones with failed chunks
+        in this flush or an earlier one and the one still being handed over"""
+        failed_items = {doc.get("document_id", doc["id"]) for doc in failed} - self.failed_items
+        self.failed_items |= failed_items
+        self.diagnostics["incomplete"] += len(failed_items)
+        done = {name: stage for name, stage in self.awaiting_flush.items()
+                if name != self.writing and name not in self.failed_items}
+        if self.journal:
+            for stage in ("uploaded", "removed"):
+                self.journal.mark([name for name, done_stage in done.items() if done_stage == stage], stage)
+        self.awaiting_flush = {name: stage for name, stage in self.awaiting_flush.items() if name == self.writing}
+
+    def find_upserts(self, items: List[BlobRecord], stop_early: bool = True):
+        """Finds the blobs to create and to update by looking each one up from the index.
+        With stop_early, a full listing is assumed and the lookups stop at the first blob indexed after its last
+        change. Changes read again from the change feed can be older than blobs already indexed."""
         # First go through all upserts and update latest_updates for each new space
         # Sor them by date first
         create = []
         update = []
-        upserts = sorted(changeset["upsert"], key=lambda x: x["last_modified"], reverse=True)
+        upserts = sorted(items, key=lambda x: x["last_modified"], reverse=True)
         for upsert in upserts:
             page_id = upsert.name
             # Check if document exists (the first chunk)
@@ -62,26 +488,31 @@ class AzureAISearchIndexer:
                 modified_in_storage = upsert["last_modified"]
                 if last_modified_date_in_index < modified_in_storage or self.full_reindex:
                     update.append(upsert)
-                if last_indexed_date > modified_in_storage and not self.full_reindex:
+                if last_indexed_date > modified_in_storage and not self.full_reindex and stop_early:
                     # break from the loop, as the rest are older
                     break
+        return create, update
 
-        # remove items in changeset remove
-        for item in changeset["remove"]:
-            count = self.remove_item(item)
-            if count > 0:  # The count is number of chunks, not documents
-                self.diagnostics["counts"]["remove"] += 1
-        # remove items that need to be updated ->
-        # document is split in multiple search entries and we dont know how its going to chuck this time ->
-        # easier to remove existing chunks and reindex
-        for item in update:
-            self.diagnostics["counts"]["update"] += 1
-            self.remove_item(item)
-            self.create_item(item)
-        # create new items
-        for item in create:
-            self.diagnostics["counts"]["create"] += 1
-            self.create_item(item)
+    def load_snapshot(self, owns: Callable[[str], bool] = None) -> IndexSnapshot:
+        """Pages through the whole index once, keyset paginated on the id as skip is capped at 100 000.
+        Documents not accepted by owns are left out, so the diff does not remove other shards' documents"""
+        snapshot = IndexSnapshot(on_disk=self.snapshot_mode == "disk")
+        last_key = None
+        while True:
+            results = list(self.client.search(search_text="*",
+                                              select=["id", "document_id", "last_modified_date",
+                                                      "last_indexed_date"],
+                                              filter=f"id gt '{last_key}'" if last_key else None,
+                                              order_by=["id asc"],
+                                              top=self.snapshot_page_size))
+            for doc in results:
+                if owns and not owns(doc["document_id"]):
+                    continue
+                snapshot.add(doc["id"], doc["document_id"], doc["last_modified_date"], doc["last_indexed_date"])
+            if len(results) < self.snapshot_page_size:
+                break
+            last_key = results[-1]["id"]
+        return snapshot
 
     def get_indexing_metadata(self, page_id):
         # not found, set olden times
@@ -98,61 +529,115 @@ class AzureAISearchIndexer:
         return last_indexed_date, last_modified_date_in_index
 
     def remove_item(self, item):
-        # Get all documents that match the document_id
-        results = list(self.client.search(search_text="*",
-                                          filter="document_id eq '" + item["name"] + "'"))
-        to_be_deleted = list(map(lambda x: {'id': x['id']}, results))
-        if len(to_be_deleted) > 0:
-            self.client.delete_documents(documents=to_be_deleted)
-        return len(to_be_deleted)
-
-    def create_item(self, item):
-        # Handle attachments
-        docs = []
-        # Create a new document
+        count = self.remove_items([item])[item["name"]]
+        self.writer.flush()
+        return count
+
+    def remove_items(self, items: List[BlobRecord]) -> Dict[str, int]:
+        """Deletes the chunks of all the items in bulk, returns the number of chunks removed per document"""
+        keys = self.chunk_keys([item["name"] for item in items])
+        for name, chunk_keys in keys.items():
+            self.writer.delete(chunk_keys, document_id=name)
+        return {name: len(chunk_keys) for name, chunk_keys in keys.items()}
+
+    def chunk_keys(self, document_ids: List[str]) -> Dict[str, List[str]]:
+        if self.snapshot:
+            return self.snapshot.chunk_keys(document_ids)
+        return self.find_chunk_keys(document_ids)
+
+    def find_chunk_keys(self, document_ids: List[str]) -> Dict[str, List[str]]:
+        """Finds the chunk keys of the documents with batched search.in queries"""
+        keys = {document_id: [] for document_id in document_ids}
+        for i in range(0, len(document_ids), self.remove_lookup_batch_size):
+            batch = document_ids[i:i + self.remove_lookup_batch_size]
+            for result in self.client.search(search_text="*", select=["id", "document_id"],
+                                             filter=document_id_filter(batch)):
+                keys[result["document_id"]].append(result["id"])
+        return keys
+
+    def create_item(self, item, existing_keys: List[str] = None):
+        """Indexes the chunks of the item. Given the keys of the chunks already in the index, uploads only
+        the new or changed chunks and deletes the ones that are no longer produced"""
         page_chunks = self.blob_client.chunk_document(item)
-        docs.extend(self.chunks_to_documents(page_chunks, item))
-        try:
-            for doc in docs:
-                resp = self.client.upload_documents(documents=[doc])
-                if not resp[0].succeeded:
-                    logging.warning(f"Could not index document {doc['url']} to Azure Search: {resp[0].errors}")
-        except Exception as e:
-            logging.warning(f"Could not index documents to Azure Search: {e}")
+        self.write_changes(as_record(item).name,
+                           self.prepare_changes(item, [chunk.text for chunk in page_chunks], existing_keys))
+
+    def prepare_changes(self, item, texts: List[str], existing_keys: List[str] = None,
+                        vectors: Dict[str, List[float]] = None, content_md5: str = None) -> Dict:
+        """Given the chunk texts of the item, the documents to upload and the keys to delete.
+        vectors of a copy of the content are used instead of embedding the same texts again"""
+        docs = self.texts_to_documents(texts, item, content_md5)
+        existing = set(existing_keys or [])
+        # The first chunk is always rewritten, it carries the dates of the document
+        changed = [doc for i, doc in enumerate(docs) if i == 0 or doc["id"] not in existing or self.full_reindex]
+        self.embed_documents(changed, vectors)
+        return {"changed": changed,
+                "orphans": list(existing - {doc["id"] for doc in docs}),
+                "unchanged": len(docs) - len(changed)}
+
+    def write_changes(self, name: str, changes: Dict):
+        self.writer.merge_or_upload(changes["changed"])
+        self.writer.delete(changes["orphans"], document_id=name)
+        self.diagnostics["chunks"]["uploaded"] += len(changes["changed"])
+        self.diagnostics["chunks"]["unchanged"] += changes["unchanged"]
+        self.diagnostics["chunks"]["deleted"] += len(changes["orphans"])
 
     def chunks_to_documents(self,
-                            chunks: List[Dict],
-                            item: BlobProperties
+                            chunks: List[Chunk],
+                            item: Union[BlobRecord, BlobProperties],
+                            embed: bool = True
                             ) -> List[Dict]:
+        docs = self.texts_to_documents([chunk.text for chunk in chunks], item)
+        if embed:
+            self.embed_documents(docs)
+        return docs
+
+    def texts_to_documents(self, texts: List[str], item: Union[BlobRecord, BlobProperties],
+                           content_md5: str = None) -> List[Dict]:
         docs = []
-        item_type = item.content_settings.content_type
+        item = as_record(item)
+        item_type = item.content_type
         url = f'{self.blob_client.container.url}/{item.name}'
 
         last_modified_date = item.last_modified.strftime(self.datetime_format)
 
-        for i, chunk in enumerate(chunks):
-            # Different chunkers return different type of objects :rolleyes:
-            if isinstance(chunk, dict):
-                chunk_text = chunk.page_content if chunk.page_content else "-------"
-            else:
-                chunk_text = chunk
-            document_id = f'{item.name}_{i}'
+        occurrences = {}
+        for i, chunk_text in enumerate(texts):
+            content_hash = hashlib.sha1(chunk_text.encode("utf-8")).hexdigest()
+            occurrences[content_hash] = occurrences.get(content_hash, -1) + 1
             docs.append({
-                "id": create_md5_hash(document_id),
+                "id": chunk_key(item.name, i, content_hash, occurrences[content_hash]),
                 "document_id": item.name,
                 "item_type": item_type,
                 "chunk": chunk_text,
-                "chunkVector": self.embedder.embed_query(chunk_text),
                 "last_modified_date": last_modified_date,
                 "last_indexed_date": self.now,
                 "url": url
             })
+        if docs:
+            # The first chunk tells the content the document was made from, and its chunks in order,
+            # another blob with the same content is indexed from these
+            content_md5 = content_md5 or (item.content_md5.hex() if item.content_md5 else None)
+            docs[0]["content_md5"] = content_md5
+            docs[0]["chunk_ids"] = [doc["id"] for doc in docs] if content_md5 else None
         return docs
 
+    def embed_documents(self, docs: List[Dict], known: Dict[str, List[float]] = None):
+        # Embed all chunks of the document in batches instead of one request per chunk
+        known = known or {}
+        missing = [doc for doc in docs if doc["chunk"] not in known]
+        vectors = dict(zip((doc["chunk"] for doc in missing),
+                           (encode_vector(vector, self.vector_type)
+                            for vector in self.batch_embedder.embed([doc["chunk"] for doc in missing]))))
+        for doc in docs:
+            doc["chunkVector"] = known[doc["chunk"]] if doc["chunk"] in known else vectors[doc["chunk"]]
+
     def create_or_update_index(self):
         """Create or update the index with the latest schema
             the operation is idempotent and can be invoked multiple times without any side effects
         """
+        vector_field, vector_search = vector_schema(self.vector_dimensions, self.vector_type, self.vector_compression,
+                                                    self.vector_stored, self.vector_oversampling, self.api_version)
         schema = {
             "name": self.index_name,
             "fields": [
@@ -164,27 +649,17 @@ class AzureAISearchIndexer:
                  "filterable": "true"},
                 {"name": "name", "type": "Edm.String", "searchable": "true", "retrievable": "true"},
                 {"name": "chunk", "type": "Edm.String", "searchable": "true", "retrievable": "true"},
-                {"name": "chunkVector", "type": "Collection(Edm.Single)", "searchable": "true", "retrievable": "true",
-                 "dimensions": 1536, "vectorSearchProfile": "default-vector-profile"},
+                vector_field,
                 {"name": "last_modified_date", "type": "Edm.DateTimeOffset", "searchable": "false",
                  "retrievable": "true", "filterable": "true"},
                 {"name": "last_indexed_date", "type": "Edm.DateTimeOffset", "searchable": "false",
                  "retrievable": "true", "filterable": "true"},
-                {"name": "url", "type": "Edm.String", "searchable": "false", "retrievable": "true"}
+                {"name": "url", "type": "Edm.String", "searchable": "false", "retrievable": "true"},
+                {"name": "content_md5", "type": "Edm.String", "searchable": "false", "retrievable": "true",
+                 "filterable": "true"},
+                {"name": "chunk_ids", "type": "Collection(Edm.String)", "searchable": "false", "retrievable": "true"}
             ],
-            "vectorSearch": {
-                "algorithms": [
-                    {
-                        "name": "hnsw-config-1",
-                        "kind": "hnsw"
-                    }],
-                "profiles": [
-                    {
-                        "name": "default-vector-profile",
-                        "algorithm": "hnsw-config-1"
-                    }
-                ]
-            },
+            "vectorSearch": vector_search,
             "semantic": {
                 "configurations": [
                     {
@@ -201,26 +676,166 @@ class AzureAISearchIndexer:
                 ]
             }
         }
-        resp = requests.put(self.endpoint + "/indexes/" + self.index_name, data=json.dumps(schema),
-                            headers=self.headers, params=self.params)
+        resp = self.transport.session.put(self.endpoint + "/indexes/" + self.index_name, data=json.dumps(schema),
+                                          headers=self.headers, params=self.params)
 
         if resp.status_code > 299:
             print(f'Could not create or update index, error {resp.text}')
             logging.error(f'Could not create or update index, error {resp.text}')
             exit(-1)
 
-    def drop_index(self):
-        resp = requests.delete(self.endpoint + "/indexes/" + self.index_name, headers=self.headers, params=self.params)
+    def drop_index(self, name: str = None):
+        resp = self.transport.session.delete(self.endpoint + "/indexes/" + (name or self.index_name),
+                                             headers=self.headers, params=self.params)
+
+    def list_indexes(self) -> List[str]:
+        resp = self.transport.session.get(self.endpoint + "/indexes", headers=self.headers,
+                                          params={**self.params, "$select": "name"})
+        resp.raise_for_status()
+        return [index["name"] for index in resp.json()["value"]]
+
+    def alias_target(self) -> Optional[str]:
+        """The index the alias points to, None before the first rebuild created the alias"""
+        resp = self.transport.session.get(self.endpoint + "/aliases/" + self.alias, headers=self.headers,
+                                          params={"api-version": ALIAS_API_VERSION})
+        if resp.status_code == 404:
+            return None
+        resp.raise_for_status()
+        return resp.json()["indexes"][0]
+
+    def switch_alias(self, index_name: str):
+        """Points the alias to the index, in one request, queries go to either the old or the new index"""
+        resp = self.transport.session.put(self.endpoint + "/aliases/" + self.alias,
+                                          data=json.dumps({"name": self.alias, "indexes": [index_name]}),
+                                          headers=self.headers, params={"api-version": ALIAS_API_VERSION})
+        resp.raise_for_status()
+
+    def select_index(self):
+        """With an alias, the index written to is the one the alias points to, or the configured index before
+        the first rebuild. A rebuild writes to a new version of the index instead, named after the alias"""
+        if not self.alias:
+            return
+        live = self.alias_target() or self.config["azure_search_index"]
+        if self.rebuild == "shadow":
+            self.live_index = live
+            self.use_index(f"{self.alias}-{datetime.now(timezone.utc):%Y%m%d%H%M%S%f}")
+        elif live != self.index_name:
+            self.use_index(live)
+
+    def use_index(self, name: str):
+        self.client.close()
+        self.index_name = name
+        self.client = self.create_client(self.config)
+        self.writer.client = self.client
+
+    def is_version(self, name: str) -> bool:
+        return re.fullmatch(re.escape(self.alias) + r"-\d{20}", name) is not None
+
+    def finish_rebuild(self, items: List[BlobRecord]):
+        """Checks that the new version has a document for every blob with content, then switches the alias to it.
+        A version missing more than AZURE_SEARCH_REBUILD_MAX_MISSING documents is left for inspection and the
+        alias stays where it was"""
+        expected = [item.name for item in items if item.name not in self.empty_documents]
+        missing = []
+        for attempt in range(self.rebuild_validation_attempts):
+            if attempt:
+                time.sleep(self.rebuild_validation_wait)
+            with telemetry.span("validate", root=True):
+                snapshot = self.load_snapshot()
+                try:
+                    missing = [name for name, keys in snapshot.chunk_keys(expected).items() if not keys]
+                finally:
+                    snapshot.close()
+            if len(missing) <= self.rebuild_max_missing:
+                break
+        self.diagnostics["rebuild"] = {"index": self.index_name, "previous": self.live_index,
+                                       "expected": len(expected), "indexed": len(expected) - len(missing),
+                                       "missing": sorted(missing)[:100], "switched": False, "dropped": []}
+        if len(missing) > self.rebuild_max_missing:
+            raise RuntimeError(f"Rebuilt index {self.index_name} is missing {len(missing)} of {len(expected)} "
+                               f"documents, alias {self.alias} still points to {self.live_index}")
+        self.switch_alias(self.index_name)
+        self.diagnostics["rebuild"]["switched"] = True
+        logging.info(f"Alias {self.alias} switched from {self.live_index} to {self.index_name}")
+        # The version that was live is kept for rollback, with the rebuild_keep newest ones before it. Versions
+        # newer than it were never live, they are failed rebuilds or the ones rolled back from
+        versions = sorted((name for name in self.list_indexes() if self.is_version(name)), reverse=True)
+        earlier = [name for name in versions if self.is_version(self.live_index) and name < self.live_index]
+        for name in set(versions) - {self.index_name, self.live_index} - set(earlier[:self.rebuild_keep]):
+            self.drop_index(name)
+            self.diagnostics["rebuild"]["dropped"].append(name)
+
+    def rollback(self) -> Dict:
+        """Points the alias back to the version before the one it points to. The configured index, indexed
+        before the alias existed, is the oldest version"""
+        current = self.alias_target()
+        if current is None:
+            raise RuntimeError(f"Alias {self.alias} does not exist, there is nothing to roll back")
+        indexes = self.list_indexes()
+        configured = self.config["azure_search_index"]
+        candidates = [configured] if configured in indexes and not self.is_version(configured) else []
+        candidates += sorted(name for name in indexes if self.is_version(name))
+        position = candidates.index(current) if current in candidates else 0
+        if position == 0:
+            raise RuntimeError(f"There is no index before {current} to roll alias {self.alias} back to")
+        self.switch_alias(candidates[position - 1])
+        logging.info(f"Alias {self.alias} rolled back from {current} to {candidates[position - 1]}")
+        return {"rollback": {"alias": self.alias, "from": current, "to": candidates[position - 1]}}
 
     def reset(self):
         self.spaces_indexed = []
+        # Blobs without any text, they have no documents in the index
+        self.empty_documents = set()
+        # Items with actions the writer could not apply, they are not done even if later flushes succeed
+        self.failed_items = set()
+        self.writer.reset()
+        self.scheduler.reset()
+        telemetry.reset()
+        if self.embedding_cache:
+            self.embedding_cache.reset()
         self.diagnostics = {"counts": {"create": 0,
                                        "update": 0,
                                        "remove": 0,
                                        "attachment-create": 0,
-                                       "attachment-update": 0}
+                                       "attachment-update": 0},
+                            "chunks": {"uploaded": 0,
+                                       "unchanged": 0,
+                                       "deleted": 0},
+                            "stages": {},
+                            "journal": None,
+                            "dedup": {"copies": 0, "indexed_copies": 0},
+                            "rebuild": None,
+                            "budget": None,
+                            # Items of the run that are not fully indexed, the next run has to pick them up again
+                            "incomplete": 0,
+                            "upload": self.writer.stats,
+                            "rate_limits": self.scheduler.stats,
+                            "telemetry": telemetry.summary,
+                            "embedding_cache": self.embedding_cache.stats if self.embedding_cache else None
                             }
 
+def document_id_filter(document_ids: List[str]) -> str:
+    """OData filter matching any of the document ids"""
+    return in_filter("document_id", document_ids)
+
+
+def in_filter(field: str, values: List[str]) -> str:
+    """OData filter matching any of the values of the field"""
+    escaped = [value.replace("'", "''") for value in values]
+    for delimiter in ["|", ",", ";", "~", "\t"]:
+        if not any(delimiter in value for value in escaped):
+            return f"search.in({field}, '{delimiter.join(escaped)}', '{delimiter}')"
+    return " or ".join(f"{field} eq '{value}'" for value in escaped)
+
+
+def chunk_key(name: str, position: int, content_hash: str, occurrence: int) -> str:
+    """Key of a chunk in the index. The first chunk keeps its positional key, so that the document can be looked up
+    with a point read, the rest are derived from their content and stay the same when the chunks around them change"""
+    if position == 0:
+        return create_md5_hash(f"{name}_0")
+    return create_md5_hash(f"{name}_{content_hash}_{occurrence}")
+
+
 def create_md5_hash(input_string):
     # Step 2: Encode the input string to bytes
     input_bytes = input_string.encode('utf-8')
@@ -1,69 +1,173 @@
 import logging
+import mmap
+import re
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Dict
+from typing import Callable, List, Dict, Tuple, TypeVar, Union
 
-from langchain.text_splitter import MarkdownHeaderTextSplitter
-from langchain_community.document_loaders import AzureAIDocumentIntelligenceLoader
-from langchain_core.documents import Document
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+from azure.ai.documentintelligence import DocumentIntelligenceClient
+from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import HttpResponseError
 
+from blob_sync.blob import BlobContent, BufferReader
+from blob_sync.cache import LocalCache, cache_key
+from blob_sync.chunking import Chunk, Chunker, chunker_from_config
+from blob_sync.otel import telemetry
+from blob_sync.ratelimit import RateLimiter, scheduler_from_config
+from blob_sync.transport import Transport, transport as shared_transport, transport_from_config
+
+T = TypeVar("T")
 
-class AzureDocumentIntelligenceMediaHandler:
-    headers_to_split_on = [
-        ("#", "Header 1"),
-        ("##", "Header 2"),
-        ("###", "Header 3"),
-        ("===", "Page Break"),
-    ]
 
-    chunk_size = 2000
-    chunk_overlap = 500
+class AzureDocumentIntelligenceMediaHandler:
+    page_break = "<!-- PageBreak -->"
 
-    def __init__(self, api_endpoint: str, api_key: str, chunking_strategy: str = "text"):
+    def __init__(self, api_endpoint: str, api_key: str, chunking_strategy: str = "text", cache: LocalCache = None,
+                 page_range_size: int = 300, range_concurrency: int = 4, limiter: RateLimiter = None,
+                 chunker: Chunker = None, transport: Transport = None):
         self.api_endpoint = api_endpoint
         self.api_key = api_key
         self.api_model = "prebuilt-layout"
         self.chunking_strategy = chunking_strategy
+        self.chunker = chunker or Chunker(chunking_strategy, page_break=self.page_break)
+        # Extracted markdown by content hash and model, unchanged bytes are not sent to analysis again
+        self.cache = cache
+        # PDFs with more pages than this are analyzed in page ranges in parallel
+        self.page_range_size = page_range_size
+        self.range_concurrency = range_concurrency
+        # Paces the analysis requests and retries the throttled ones
+        self.limiter = limiter
+        # Connections shared with the other clients of the process
+        self.transport = transport or shared_transport
+        self.client = None
 
-    def handle(self, file_path: str) -> List[Document]:
-        try:
-            file_format = file_path.split(".")[-1].lower()
-            if file_format not in ["pdf", "docx", "doc", "png", "jpg", "jpeg", "bmp", "tiff", "heif", "pptx"]:
-                logging.info("Treating file as text")
-                docs_string = Path(file_path).read_text()
-            else:
-                # TODO: if pdf is over 2000 pages, we wound need to split it into smaller chunks
-                # Currently this is not handled
-                loader = AzureAIDocumentIntelligenceLoader(
-                    api_endpoint=self.api_endpoint,
-                    api_key=self.api_key,
-                    file_path=file_path,
-                    api_model=self.api_model
-                )
-                try:
-                    documents = loader.load()
-                except Exception as e:
-                    logging.ERROR(f"Error loading document {file_path}: {e}")
-                    return []
-                docs_string = documents[0].page_content
-
-            if self.chunking_strategy == "text":
-                text_splitter = RecursiveCharacterTextSplitter(
-                    chunk_size=self.chunk_size,
-                    chunk_overlap=self.chunk_overlap
-                )
+    def handle(self, source: Union[str, BlobContent]) -> List[Chunk]:
+        """Handles a downloaded blob, or a file path"""
+        file_name = source.name if isinstance(source, BlobContent) else source
+        file_format = file_name.split(".")[-1].lower()
+        if file_format in ["pdf", "docx", "doc", "png", "jpg", "jpeg", "bmp", "tiff", "heif", "pptx"]:
+            # Analysis failures are raised, an empty result would remove the document from the index
+            with telemetry.span("document_intelligence", model=self.api_model):
+                docs_string = self.extract(source)
+        else:
+            logging.info("Treating file as text")
+            if isinstance(source, BlobContent):
+                docs_string = source.read_text()
             else:
-                text_splitter = MarkdownHeaderTextSplitter(headers_to_split_on=self.headers_to_split_on)
+                docs_string = Path(source).read_text()
+
+        with telemetry.span("chunk", strategy=self.chunker.strategy):
+            return list(self.chunker.split(docs_string))
 
-            return text_splitter.split_text(docs_string)
+    def extract(self, source: Union[str, BlobContent]) -> str:
+        """Returns the markdown of the document, from the cache when the same bytes were analyzed before"""
+        key = None
+        if self.cache is not None and isinstance(source, BlobContent):
+            key = cache_key(self.api_model, source.content_hash())
+            cached = self.cache.get(key)
+            if cached is not None:
+                return zlib.decompress(cached).decode("utf-8")
+        docs_string = self.analyze(source)
+        if key is not None:
+            self.cache.put(key, zlib.compress(docs_string.encode("utf-8")))
+        return docs_string
+
+    def analyze(self, source: Union[str, BlobContent]) -> str:
+        file_name = source.name if isinstance(source, BlobContent) else source
+        if isinstance(source, BlobContent) and file_name.lower().endswith(".pdf"):
+            return self.analyze_ranges(source, estimate_pdf_pages(source))
+
+        def analyze():
+            with (source.open() if isinstance(source, BlobContent) else open(source, "rb")) as f:
+                poller = self.get_client().begin_analyze_document(self.api_model, f,
+                                                                  content_type="application/octet-stream",
+                                                                  output_content_format="markdown")
+                return poller.result()
+
+        try:
+            return self.call(analyze).content
         except Exception as e:
-            logging.error(f"Error splitting text: {e}")
-            return []
+            logging.error(f"Error loading document {file_name}: {e}")
+            raise
+
+    def analyze_ranges(self, source: BlobContent, pages: int) -> str:
+        """Analyzes the document in page ranges concurrently and merges the markdown in page order.
+        The page count is an estimate, analysis continues past it as long as the last range comes back full."""
+        ranges = [(first, first + self.page_range_size - 1)
+                  for first in range(1, max(pages, 1) + 1, self.page_range_size)]
+        try:
+            with ThreadPoolExecutor(max_workers=self.range_concurrency) as executor:
+                results = list(executor.map(lambda page_range: self.analyze_pages(source, *page_range), ranges))
+            last = ranges[-1][1]
+            while results[-1][1] == self.page_range_size:
+                results.append(self.analyze_pages(source, last + 1, last + self.page_range_size))
+                last += self.page_range_size
+        except Exception as e:
+            logging.error(f"Error loading document {source.name}: {e}")
+            raise
+        return f"\n\n{self.page_break}\n\n".join(content for content, page_count in results if page_count)
+
+    def analyze_pages(self, source: BlobContent, first: int, last: int) -> Tuple[str, int]:
+        """Returns the markdown of the pages and the number of pages analyzed"""
+
+        def analyze():
+            with source.open() as f:
+                poller = self.get_client().begin_analyze_document(self.api_model, f,
+                                                            pages=f"{first}-{last}",
+                                                            content_type="application/octet-stream",
+                                                            output_content_format="markdown")
+                return poller.result()
+
+        try:
+            result = self.call(analyze)
+        except HttpResponseError as e:
+            # A range starting past the end of the document
+            if e.status_code == 400 and first > 1:
+                return "", 0
+            raise
+        return result.content, len(result.pages or [])
+
+
+    def get_client(self) -> DocumentIntelligenceClient:
+        if self.client is None:
+            self.client = DocumentIntelligenceClient(endpoint=self.api_endpoint,
+                                                     credential=AzureKeyCredential(self.api_key),
+                                                     **self.transport.azure_kwargs())
+        return self.client
+
+    def call(self, fn: Callable[[], T]) -> T:
+        return self.limiter.call(fn) if self.limiter else fn()
+
+
+def estimate_pdf_pages(source: BlobContent) -> int:
+    """Counts the pages of a pdf from its page objects and page tree, without a pdf library.
+    Returns 0 when the page tree is in compressed object streams."""
+    with source.open() as f:
+        # the buffer of an in-memory blob, or the file mapped into memory
+        data = f.getbuffer() if isinstance(f, BufferReader) else mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            pages = len(re.findall(rb"/Type\s*/Page(?![a-zA-Z])", data))
+            counts = [int(count) for count in re.findall(rb"/Type\s*/Pages\b[^>]*?/Count\s+(\d+)", data)]
+            counts += [int(count) for count in re.findall(rb"/Count\s+(\d+)[^>]*?/Type\s*/Pages\b", data)]
+        finally:
+            if not isinstance(data, memoryview):
+                data.close()
+    return max([pages] + counts)
 
 
-def doc_intelligence_from_config(config: Dict[str, str]) -> AzureDocumentIntelligenceMediaHandler:
-    """Creates a Azure Blob client wrapper from a config"""
+def doc_intelligence_from_config(config: Dict[str, str], cache: LocalCache = None) -> AzureDocumentIntelligenceMediaHandler:
+    """Creates a Document Intelligence handler from a config, with the cache of the registry when it has one"""
+    if cache is None and config["document_intelligence_cache_path"]:
+        cache = LocalCache(config["document_intelligence_cache_path"],
+                           max_bytes=config["document_intelligence_cache_max_mb"] * 1024 * 1024)
     return AzureDocumentIntelligenceMediaHandler(
         config["document_intelligence_endpoint"],
-        config["document_intelligence_key"]
+        config["document_intelligence_key"],
+        cache=cache,
+        page_range_size=config["document_intelligence_page_range"],
+        range_concurrency=config["document_intelligence_range_concurrency"],
+        limiter=scheduler_from_config(config).limiter("document_intelligence"),
+        chunker=chunker_from_config(config, page_break=AzureDocumentIntelligenceMediaHandler.page_break),
+        transport=transport_from_config(config)
     )
@@ -1,53 +1,330 @@
+import hashlib
+import io
+import logging
 import os
+import queue
+import shutil
 import tempfile
-from typing import Dict, List
+import threading
+from dataclasses import dataclass
+from datetime import datetime
+from typing import AsyncIterator, BinaryIO, Dict, Iterator, List, Optional, Union
 
-from azure.identity import DefaultAzureCredential
-from azure.storage.blob import BlobServiceClient, BlobProperties
+from azure.storage.blob import BlobServiceClient, BlobProperties, BlobPrefix
+
+from blob_sync.chunking import Chunk
+from blob_sync.transport import AsyncTransport, transport, transport_from_config
+
+
+@dataclass(slots=True)
+class BlobRecord:
+    """The properties of a blob the indexer needs, a fraction of the size of BlobProperties"""
+    name: str
+    last_modified: datetime = None
+    etag: str = None
+    size: int = 0
+    content_md5: bytes = None
+    content_type: str = None
+    deleted: bool = False
+    # From the blob metadata, when runs are prioritized by it
+    priority: float = None
+
+    def __getitem__(self, key):
+        # dict style access like BlobProperties
+        return getattr(self, key)
+
+    @classmethod
+    def from_properties(cls, blob: BlobProperties, priority_metadata: str = None) -> "BlobRecord":
+        content_settings = blob.content_settings
+        priority = (blob.metadata or {}).get(priority_metadata) if priority_metadata else None
+        return cls(name=blob.name,
+                   last_modified=blob.last_modified,
+                   etag=blob.etag,
+                   size=blob.size,
+                   content_md5=bytes(content_settings.content_md5) if content_settings.content_md5 else None,
+                   content_type=content_settings.content_type,
+                   deleted=bool(blob.deleted),
+                   priority=parse_priority(priority))
+
+
+def parse_priority(value: str = None) -> Optional[float]:
+    try:
+        return float(value) if value else None
+    except ValueError:
+        logging.warning(f"Ignoring priority {value}, it is not a number")
+        return None
+
+
+def as_record(blob: Union[BlobRecord, BlobProperties]) -> BlobRecord:
+    return blob if isinstance(blob, BlobRecord) else BlobRecord.from_properties(blob)
+
+
+class BlobContent:
+    """Downloaded content of a blob. Small blobs are kept in memory and large ones are streamed into a file
+    in a temporary directory, which is removed on close. Handlers can ask for a readable buffer or for a path,
+    a path to an in-memory blob is written out only when asked for."""
+
+    def __init__(self, name: str, content_md5: bytes = None, content_type: str = None):
+        self.name = name
+        self.content_md5 = content_md5
+        # Picks the handler, with the extension of the name when storage has only a generic type
+        self.content_type = content_type
+        self.buffer = None
+        self.file_path = None
+        self.tmp_dir = None
+
+    def spool(self, size: int, max_memory_bytes: int) -> BinaryIO:
+        """Returns a writable target for the download, memory or file depending on the size"""
+        if size <= max_memory_bytes:
+            self.buffer = io.BytesIO()
+            return self.buffer
+        return open(self._tmp_path(), mode="wb")
+
+    def _tmp_path(self) -> str:
+        if self.tmp_dir is None:
+            self.tmp_dir = tempfile.mkdtemp()
+        # blob names can contain virtual directories, the file only needs to keep the extension
+        self.file_path = os.path.join(self.tmp_dir, os.path.basename(self.name))
+        return self.file_path
+
+    @property
+    def path(self) -> str:
+        if self.file_path is None:
+            with open(self._tmp_path(), mode="wb") as f:
+                f.write(self.buffer.getbuffer())
+        return self.file_path
+
+    def open(self) -> BinaryIO:
+        """A new reader of the content, readers of an in-memory blob share its buffer"""
+        if self.buffer is not None:
+            return BufferReader(self.buffer.getbuffer())
+        return open(self.file_path, mode="rb")
+
+    def read_text(self, encoding: str = "utf-8") -> str:
+        if self.buffer is not None:
+            return str(self.buffer.getbuffer(), encoding)
+        with open(self.file_path, encoding=encoding) as f:
+            return f.read()
+
+    def content_hash(self) -> str:
+        """Hex md5 of the content, from the blob properties when storage has it, otherwise computed"""
+        if not self.content_md5 and self.buffer is not None:
+            with self.buffer.getbuffer() as data:
+                self.content_md5 = hashlib.md5(data).digest()
+        elif not self.content_md5:
+            md5 = hashlib.md5()
+            with self.open() as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    md5.update(block)
+            self.content_md5 = md5.digest()
+        return bytes(self.content_md5).hex()
+
+    def close(self):
+        self.buffer = None
+        if self.tmp_dir is not None:
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+            self.tmp_dir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class BufferReader(io.RawIOBase):
+    """A read-only file over a memoryview. Every reader has its own position, so page ranges can be sent
+    concurrently from one in-memory blob without copying it"""
+
+    def __init__(self, data: memoryview):
+        self.data = data
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        count = max(0, min(len(b), len(self.data) - self.position))
+        b[:count] = self.data[self.position:self.position + count]
+        self.position += count
+        return count
+
+    def read(self, size: int = -1) -> bytes:
+        end = len(self.data) if size is None or size < 0 else min(len(self.data), self.position + size)
+        if end <= self.position:
+            return b""
+        chunk = self.data[self.position:end].tobytes()
+        self.position = end
+        return chunk
+
+    def readall(self) -> bytes:
+        return self.read()
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: len(self.data)}[whence]
+        self.position = max(0, base + offset)
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def getbuffer(self) -> memoryview:
+        return self.data
+
+    def close(self):
+        if not self.closed:
+            self.data.release()
+        super().close()
 
 
 class BlobWrapper:
     """Wrapper around Azure Blob Storage"""
 
-    def __init__(self, account_name: str, account_key: str, container_name: str):
+    def __init__(self, account_name: str, account_key: str, container_name: str, max_concurrency: int = 4,
+                 spool_max_bytes: int = 16 * 1024 * 1024, prefixes: List[str] = None, list_workers: int = 8,
+                 priority_metadata: str = None):
         self.container_name = container_name
+        # Virtual directories listed in parallel, "auto" for the top level directories of the container
+        self.prefixes = prefixes or []
+        self.list_workers = list_workers
+        # Metadata key with the priority of a blob, the metadata is only listed when it is set
+        self.priority_metadata = priority_metadata
+        self.include = ["deleted", "metadata"] if priority_metadata else ["deleted"]
+        self.max_concurrency = max_concurrency
+        self.spool_max_bytes = spool_max_bytes
+        self.account_name = account_name
+        self.account_key = account_key
+        self.account_url = f"https://{account_name}.blob.core.windows.net"
         if not account_key:
-            creds = DefaultAzureCredential()
-            self.blob_client = BlobServiceClient(account_url=f"https://{account_name}.blob.core.windows.net",
-                                                 credential=creds)
+            self.blob_client = BlobServiceClient(account_url=self.account_url, credential=transport.credential(),
+                                                 **transport.azure_kwargs())
         else:
             self.blob_client = BlobServiceClient.from_connection_string(
-                conn_str=f"DefaultEndpointsProtocol=https;AccountName={account_name};AccountKey={account_key};EndpointSuffix=core.windows.net")
+                conn_str=f"DefaultEndpointsProtocol=https;AccountName={account_name};AccountKey={account_key};EndpointSuffix=core.windows.net",
+                **transport.azure_kwargs())
         self.container = self.blob_client.get_container_client(container_name)
         self.blobs = []
         self.media_handler = None
 
     def list_blobs(self):
-        continuation_token = None
-        while True:
-            blobs = (self.container.list_blobs(include=['deleted'], results_per_page=5000)
-                     .by_page(continuation_token=continuation_token))
-            self.blobs.extend([blob for blob in list(next(blobs))])
-            continuation_token = blobs.continuation_token
-            if not continuation_token:
-                break
+        self.blobs = list(self.iter_blobs())
         return self.blobs
 
-    def chunk_document(self, blob: BlobProperties) -> List[Dict]:
-        """Chunks a doc into smaller pieces"""
+    def iter_blobs(self, prefixes: List[str] = None) -> Iterator[BlobRecord]:
+        """Streams the blobs of the container, including the soft deleted ones, as BlobRecords.
+        With prefixes, the virtual directories are listed in parallel and the records come in no particular order."""
+        prefixes = prefixes if prefixes is not None else self.prefixes
+        if prefixes == ["auto"]:
+            prefixes = yield from self.iter_top_level()
+        if not prefixes:
+            yield from self.iter_prefix(None)
+            return
+        records = queue.Queue(maxsize=10000)
+        pending = queue.Queue()
+        for prefix in prefixes:
+            pending.put(prefix)
+        errors = []
+
+        def list_prefixes():
+            try:
+                while True:
+                    try:
+                        prefix = pending.get_nowait()
+                    except queue.Empty:
+                        return
+                    for record in self.iter_prefix(prefix):
+                        records.put(record)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                records.put(None)
+
+        workers = min(self.list_workers, len(prefixes))
+        for _ in range(workers):
+            threading.Thread(target=list_prefixes, daemon=True).start()
+        done = 0
+        while done < workers:
+            record = records.get()
+            if record is None:
+                done += 1
+            else:
+                yield record
+        if errors:
+            raise errors[0]
+
+    def iter_prefix(self, prefix: str = None) -> Iterator[BlobRecord]:
+        for blob in self.container.list_blobs(name_starts_with=prefix, include=self.include, results_per_page=5000):
+            yield BlobRecord.from_properties(blob, self.priority_metadata)
+
+    def iter_top_level(self):
+        """Yields the blobs at the root of the container and returns the top level virtual directories"""
+        prefixes = []
+        for item in self.container.walk_blobs(include=self.include, delimiter="/"):
+            if isinstance(item, BlobPrefix):
+                prefixes.append(item.name)
+            else:
+                yield BlobRecord.from_properties(item, self.priority_metadata)
+        return prefixes
+
+    def download(self, blob: Union[BlobRecord, BlobProperties]) -> BlobContent:
+        """Streams the blob into memory or a temporary file, large blobs are read with parallel ranged requests"""
+        blob = as_record(blob)
+        blob_client = self.container.get_blob_client(blob.name)
+        download_stream = blob_client.download_blob(max_concurrency=self.max_concurrency)
+        content = BlobContent(blob.name, content_md5=blob.content_md5, content_type=blob.content_type)
         try:
-            blob_client = self.container.get_blob_client(blob.name)
-            # create tmp dir
-            tmp_dir = tempfile.mkdtemp()
-            with open(file=os.path.join(tmp_dir, blob.name), mode="wb") as dl_blob:
-                download_stream = blob_client.download_blob()
-                dl_blob.write(download_stream.readall())
-                dl_blob.close()
-                chunks = self.media_handler.handle(os.path.join(tmp_dir, blob.name))
-                os.remove(os.path.join(tmp_dir, blob.name))
-                return chunks
+            target = content.spool(download_stream.size, self.spool_max_bytes)
+            try:
+                download_stream.readinto(target)
+            finally:
+                if target is not content.buffer:
+                    target.close()
         except:
-            return []
+            content.close()
+            raise
+        return content
+
+    def aio_container(self, aio: AsyncTransport):
+        """The container for async code, on the connections of aio"""
+        from azure.storage.blob.aio import ContainerClient
+
+        credential = {"account_name": self.account_name, "account_key": self.account_key} if self.account_key \
+            else aio.credential()
+        return ContainerClient(self.account_url, self.container_name, credential=credential, **aio.azure_kwargs())
+
+    async def aiter_blobs(self, container) -> AsyncIterator[BlobRecord]:
+        """iter_blobs for async code with a container from aio_container, the prefixes are listed one by one"""
+        prefixes = self.prefixes if self.prefixes and self.prefixes != ["auto"] else [None]
+        for prefix in prefixes:
+            async for blob in container.list_blobs(name_starts_with=prefix, include=self.include,
+                                                   results_per_page=5000):
+                yield BlobRecord.from_properties(blob, self.priority_metadata)
+
+    async def adownload(self, blob: Union[BlobRecord, BlobProperties], container) -> BlobContent:
+        """download for async code with a container from aio_container"""
+        blob = as_record(blob)
+        download_stream = await container.get_blob_client(blob.name).download_blob(
+            max_concurrency=self.max_concurrency)
+        content = BlobContent(blob.name, content_md5=blob.content_md5, content_type=blob.content_type)
+        try:
+            target = content.spool(download_stream.size, self.spool_max_bytes)
+            try:
+                await download_stream.readinto(target)
+            finally:
+                if target is not content.buffer:
+                    target.close()
+        except:
+            content.close()
+            raise
+        return content
+
+    def chunk_document(self, blob: Union[BlobRecord, BlobProperties]) -> List[Chunk]:
+        """Chunks a doc into smaller pieces. Failures are raised, an empty list would empty the document"""
+        with self.download(blob) as content:
+            return self.media_handler.handle(content)
 
     def create_test_container(self):
         """Creates a test container"""
@@ -74,8 +351,14 @@ class BlobWrapper:
 
 def blob_client_from_config(config: Dict[str, str]) -> BlobWrapper:
     """Creates a Azure Blob client wrapper from a config"""
+    transport_from_config(config)
     return BlobWrapper(
         config["account_name"],
         config["account_key"],
-        config["container_name"]
+        config["container_name"],
+        max_concurrency=config["download_max_concurrency"],
+        spool_max_bytes=config["download_spool_max_mb"] * 1024 * 1024,
+        prefixes=config["storage_prefixes"],
+        list_workers=config["storage_list_workers"],
+        priority_metadata=config["run_priority_metadata"] if config["run_priority"] == "tag" else None
     )
@@ -0,0 +1,72 @@
+import time
+from typing import Callable, Dict, Iterator, List, Optional
+
+from blob_sync.blob import BlobRecord
+from blob_sync.ratelimit import RateScheduler
+
+LIMITS = ("seconds", "calls", "tokens")
+
+
+def priority_key(policy: str) -> Callable[[BlobRecord], tuple]:
+    """Sort key of the blobs of a run, the first ones are indexed first and the last ones deferred first.
+    recency is newest first, size smallest first and tag the highest priority metadata first, then newest"""
+
+    def newest(item: BlobRecord) -> float:
+        return -item.last_modified.timestamp() if item.last_modified else 0.0
+
+    match policy:
+        case "recency":
+            return lambda item: (newest(item),)
+        case "size":
+            return lambda item: (item.size or 0, newest(item))
+        case "tag":
+            return lambda item: (-(item.priority or 0), newest(item))
+        case _:
+            raise ValueError(f"Unknown run priority {policy}, one of recency, size, tag")
+
+
+class RunBudget:
+    """Limits of a run in seconds, calls to the services and embedding tokens, 0 for no limit.
+    The budget is checked before a blob enters the pipeline, the blobs already in it are finished,
+    so a run stops cleanly a little after the budget is used up."""
+
+    def __init__(self, scheduler: RateScheduler, seconds: float = 0, calls: int = 0, tokens: int = 0):
+        self.scheduler = scheduler
+        self.limits = {"seconds": seconds, "calls": calls, "tokens": tokens}
+        self.started = time.monotonic()
+        self.baseline = {"calls": 0, "tokens": 0}
+
+    @property
+    def limited(self) -> bool:
+        return any(self.limits.values())
+
+    def start(self):
+        self.started = time.monotonic()
+        self.baseline = self.usage()
+
+    def usage(self) -> Dict[str, int]:
+        stats = list(self.scheduler.stats.values())
+        return {"calls": sum(limiter["calls"] for limiter in stats),
+                "tokens": sum(limiter["tokens"] for limiter in stats)}
+
+    def spent(self) -> Dict[str, float]:
+        usage = self.usage()
+        return {"seconds": round(time.monotonic() - self.started, 3),
+                "calls": usage["calls"] - self.baseline["calls"],
+                "tokens": usage["tokens"] - self.baseline["tokens"]}
+
+    def exhausted(self) -> Optional[str]:
+        """The first limit used up, None while there is budget left"""
+        if not self.limited:
+            return None
+        spent = self.spent()
+        return next((name for name in LIMITS if self.limits[name] and spent[name] >= self.limits[name]), None)
+
+    def admit(self, jobs: List[Dict], deferred: List[Dict], stop: Callable[[], bool] = None) -> Iterator[Dict]:
+        """Yields the jobs while there is budget left and stop does not return True,
+        the ones not admitted are added to deferred"""
+        for i, job in enumerate(jobs):
+            if self.exhausted() or (stop and stop()):
+                deferred.extend(jobs[i:])
+                return
+            yield job
@@ -0,0 +1,89 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+
+class LocalCache:
+    """Persistent key-value cache in a sqlite file, evicting the least recently used entries
+    when the stored values exceed max_bytes"""
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB, last_used REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        self.size = self.db.execute("SELECT coalesce(sum(length(value)), 0) FROM entries").fetchone()[0]
+        self.stats = None
+        self.reset()
+
+    def reset(self):
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get_many(self, keys: List[str]) -> Dict[str, bytes]:
+        found = {}
+        with self.lock:
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                rows = self.db.execute(f"SELECT key, value FROM entries WHERE key IN ({','.join('?' * len(batch))})",
+                                       batch).fetchall()
+                found.update(rows)
+            if found:
+                now = time.time()
+                self.db.executemany("UPDATE entries SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+            self.stats["hits"] += len(found)
+            self.stats["misses"] += len(set(keys)) - len(found)
+        return found
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.get_many([key]).get(key)
+
+    def put_many(self, items: Dict[str, bytes]):
+        if not items:
+            return
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN")
+            for key, value in items.items():
+                old = self.db.execute("SELECT length(value) FROM entries WHERE key = ?", (key,)).fetchone()
+                self.db.execute("INSERT OR REPLACE INTO entries (key, value, last_used) VALUES (?, ?, ?)",
+                                (key, value, now))
+                self.size += len(value) - (old[0] if old else 0)
+            self.db.execute("COMMIT")
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def put(self, key: str, value: bytes):
+        self.put_many({key: value})
+
+    def evict(self):
+        """Drops the least recently used entries until the cache is at 90% of max_bytes"""
+        target = self.max_bytes * 0.9
+        while self.size > target:
+            rows = self.db.execute("SELECT key, length(value) FROM entries ORDER BY last_used LIMIT 1000").fetchall()
+            if not rows:
+                break
+            evicted = []
+            for key, size in rows:
+                evicted.append((key,))
+                self.size -= size
+                if self.size <= target:
+                    break
+            self.db.executemany("DELETE FROM entries WHERE key = ?", evicted)
+            self.stats["evictions"] += len(evicted)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def cache_key(*parts: str) -> str:
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
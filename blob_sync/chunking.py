@@ -0,0 +1,152 @@
+import logging
+import re
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, List, Tuple
+
+# Finer and finer separators for the pieces of a paragraph that alone is over the token limit
+SEPARATORS = [re.compile(r"\n+"), re.compile(r"(?<=[.!?;:])\s+"), re.compile(r"\s+")]
+
+
+@dataclass(slots=True)
+class Chunk:
+    """A chunk of an extracted document, text is document[start:end] and page the 1-based page it is on"""
+    text: str
+    start: int
+    end: int
+    page: int
+    tokens: int
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+def token_counter(model: str) -> Callable[[str], int]:
+    """Counts tokens with the tokenizer of the embedding model, or estimates them when tiktoken or its
+    encoding files are not available"""
+    try:
+        import tiktoken
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            # Azure deployment names are not model names, all the embedding models use cl100k
+            encoding = tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logging.warning(f"Could not load tokenizer for {model}, estimating token counts: {e}")
+        return estimate_tokens
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+class Chunker:
+    """Splits extracted text into chunks of up to max_tokens tokens in one pass over the text.
+
+    Paragraphs are packed into chunks, a paragraph over the limit is split at lines, then sentences, then words.
+    Chunks never span a page break, with the markdown strategy they never span a heading of up to heading_depth
+    either and do not overlap. With the text strategy consecutive chunks share up to overlap_tokens of paragraphs.
+    Pieces are tracked as offsets, the text of a chunk is sliced once from the document."""
+
+    def __init__(self, strategy: str = "text", max_tokens: int = 500, overlap_tokens: int = 125,
+                 count_tokens: Callable[[str], int] = estimate_tokens, page_break: str = "<!-- PageBreak -->",
+                 heading_depth: int = 3):
+        if strategy not in ("text", "markdown"):
+            raise ValueError(f"Unknown chunking strategy {strategy}")
+        self.strategy = strategy
+        self.max_tokens = max(1, max_tokens)
+        self.overlap_tokens = 0 if strategy == "markdown" else max(0, min(overlap_tokens, self.max_tokens // 2))
+        self.count_tokens = count_tokens
+        # Every boundary starts with a newline, a literal prefix keeps the scan in the regex engine's fast path.
+        # A blank line does not consume the next newline, it can be the start of a heading.
+        boundaries = [r"[ \t]*(?=\n)", f"[ \\t]*(?P<page>{re.escape(page_break)})"]
+        if strategy == "markdown":
+            boundaries.append(f"(?P<heading>(?=#{{1,{heading_depth}}}[ \\t]))")
+        self.boundary = re.compile(r"\n(?:" + "|".join(boundaries) + ")")
+
+    def split(self, text: str) -> Iterator[Chunk]:
+        window: List[Tuple[int, int, int]] = []
+        tokens = 0
+        page = 1
+        for start, end, block_page, hard in self.blocks(text):
+            if window and (hard or block_page != page):
+                yield self.chunk(text, window, page)
+                window, tokens = [], 0
+            page = block_page
+            for piece in self.pieces(text, start, end, 0):
+                if window and tokens + piece[2] > self.max_tokens:
+                    yield self.chunk(text, window, page)
+                    window = self.overlap(window, piece[2])
+                    tokens = sum(overlapping[2] for overlapping in window)
+                window.append(piece)
+                tokens += piece[2]
+        if window:
+            yield self.chunk(text, window, page)
+
+    def blocks(self, text: str) -> Iterator[Tuple[int, int, int, bool]]:
+        """Yields the paragraphs as (start, end, page, hard), hard when a heading or page break precedes it"""
+        page = 1
+        position = 0
+        hard = False
+        for match in self.boundary.finditer(text):
+            start, end = strip(text, position, match.start())
+            if start < end:
+                yield start, end, page, hard
+                hard = False
+            if match.lastgroup == "page":
+                page += 1
+                hard = True
+            elif match.lastgroup == "heading":
+                hard = True
+            position = match.end()
+        start, end = strip(text, position, len(text))
+        if start < end:
+            yield start, end, page, hard
+
+    def pieces(self, text: str, start: int, end: int, level: int) -> Iterator[Tuple[int, int, int]]:
+        """Yields (start, end, tokens) of the range, split with the separators from level on until under the limit"""
+        tokens = self.count_tokens(text[start:end])
+        if tokens <= self.max_tokens:
+            yield start, end, tokens
+            return
+        if level == len(SEPARATORS):
+            # A single word over the limit, cut into pieces of about max_tokens
+            step = max(1, (end - start) * self.max_tokens // tokens)
+            for offset in range(start, end, step):
+                yield offset, min(offset + step, end), self.count_tokens(text[offset:min(offset + step, end)])
+            return
+        position = start
+        for match in SEPARATORS[level].finditer(text, start, end):
+            if match.start() > position:
+                yield from self.pieces(text, position, match.start(), level + 1)
+            position = match.end()
+        if position < end:
+            yield from self.pieces(text, position, end, level + 1)
+
+    def overlap(self, window: List[Tuple[int, int, int]], next_tokens: int) -> List[Tuple[int, int, int]]:
+        """The trailing pieces of the emitted window that are repeated at the start of the next chunk"""
+        tail = []
+        tokens = 0
+        for piece in reversed(window[1:]):
+            if tokens + piece[2] > self.overlap_tokens or tokens + piece[2] + next_tokens > self.max_tokens:
+                break
+            tail.append(piece)
+            tokens += piece[2]
+        tail.reverse()
+        return tail
+
+    @staticmethod
+    def chunk(text: str, window: List[Tuple[int, int, int]], page: int) -> Chunk:
+        start, end = window[0][0], window[-1][1]
+        return Chunk(text[start:end], start, end, page, sum(piece[2] for piece in window))
+
+
+def strip(text: str, start: int, end: int) -> Tuple[int, int]:
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    return start, end
+
+
+def chunker_from_config(config: Dict, page_break: str = "<!-- PageBreak -->") -> Chunker:
+    return Chunker(config["chunking_strategy"], max_tokens=config["chunk_max_tokens"],
+                   overlap_tokens=config["chunk_overlap_tokens"],
+                   count_tokens=token_counter(config["azure_search_embedding_model"]), page_break=page_break)
@@ -1,23 +1,81 @@
 import os
-# All the different handlers must be imported so that the dynamic loading works
-# Todo: Find a better way to do this
-from blob_sync.gpt_vision import GPTVisionMediaHandler
-from blob_sync.azure_document_intelligence import AzureDocumentIntelligenceMediaHandler
 
 
 def get_config():
     return {
         "search_type": os.getenv("SEARCH_TYPE", "AZURE_COGNITIVE_SEARCH"),
+        "local_index_path": os.getenv("LOCAL_INDEX_PATH", ".blob-indexer/index"),
+        "local_index_hnsw": os.getenv("LOCAL_INDEX_HNSW", "false").lower() == "true",
         "azure_search_endpoint": os.getenv("AZURE_SEARCH_ENDPOINT"),
         "azure_search_key": os.getenv("AZURE_SEARCH_KEY"),
         "azure_search_full_reindex": os.getenv("AZURE_SEARCH_FULL_REINDEX", "false").lower() == "true",
         "azure_search_embedding_model": os.getenv("AZURE_SEARCH_EMBEDDING_MODEL", "text-embedding-ada-002"),
         "azure_search_api_version": os.getenv("AZURE_SEARCH_API_VERSION", "2023-11-01"),
         "azure_search_index": os.getenv("AZURE_SEARCH_INDEX", "default"),
+        "azure_search_vector_dimensions": int(os.getenv("AZURE_SEARCH_VECTOR_DIMENSIONS", "0")),
+        "azure_search_vector_type": os.getenv("AZURE_SEARCH_VECTOR_TYPE", "single").lower(),
+        "azure_search_vector_compression": os.getenv("AZURE_SEARCH_VECTOR_COMPRESSION", "none").lower(),
+        "azure_search_vector_stored": os.getenv("AZURE_SEARCH_VECTOR_STORED", "true").lower() == "true",
+        "azure_search_vector_oversampling": float(os.getenv("AZURE_SEARCH_VECTOR_OVERSAMPLING", "4")),
+        "azure_search_dedup": os.getenv("AZURE_SEARCH_DEDUP", "index").lower(),
+        "azure_search_alias": os.getenv("AZURE_SEARCH_ALIAS", ""),
+        "azure_search_rebuild": os.getenv("AZURE_SEARCH_REBUILD", "off").lower(),
+        "azure_search_rebuild_max_missing": int(os.getenv("AZURE_SEARCH_REBUILD_MAX_MISSING", "0")),
+        "azure_search_rebuild_keep": int(os.getenv("AZURE_SEARCH_REBUILD_KEEP", "1")),
+        "azure_search_snapshot": os.getenv("AZURE_SEARCH_SNAPSHOT", "off").lower(),
+        "azure_search_upload_batch_size": int(os.getenv("AZURE_SEARCH_UPLOAD_BATCH_SIZE", "1000")),
+        "azure_search_upload_batch_mb": int(os.getenv("AZURE_SEARCH_UPLOAD_BATCH_MB", "16")),
+        "http_pool_size": int(os.getenv("HTTP_POOL_SIZE", "64")),
+        "http_keep_alive_seconds": float(os.getenv("HTTP_KEEP_ALIVE_SECONDS", "60")),
+        "download_max_concurrency": int(os.getenv("DOWNLOAD_MAX_CONCURRENCY", "4")),
+        "download_spool_max_mb": int(os.getenv("DOWNLOAD_SPOOL_MAX_MB", "16")),
+        "pipeline_download_workers": int(os.getenv("PIPELINE_DOWNLOAD_WORKERS", "4")),
+        "pipeline_analysis_workers": int(os.getenv("PIPELINE_ANALYSIS_WORKERS", "4")),
+        "pipeline_embedding_workers": int(os.getenv("PIPELINE_EMBEDDING_WORKERS", "2")),
+        "pipeline_queue_size": int(os.getenv("PIPELINE_QUEUE_SIZE", "8")),
+        "embedding_batch_size": int(os.getenv("EMBEDDING_BATCH_SIZE", "16")),
+        "embedding_batch_tokens": int(os.getenv("EMBEDDING_BATCH_TOKENS", "100000")),
+        "embedding_concurrency": int(os.getenv("EMBEDDING_CONCURRENCY", "4")),
+        "embedding_cache_path": os.getenv("EMBEDDING_CACHE_PATH", ""),
+        "embedding_cache_max_mb": int(os.getenv("EMBEDDING_CACHE_MAX_MB", "1024")),
+        "rate_limit_openai_rpm": int(os.getenv("RATE_LIMIT_OPENAI_RPM", "0")),
+        "rate_limit_openai_tpm": int(os.getenv("RATE_LIMIT_OPENAI_TPM", "0")),
+        "rate_limit_openai_concurrency": int(os.getenv("RATE_LIMIT_OPENAI_CONCURRENCY", "8")),
+        "rate_limit_document_intelligence_rpm": int(os.getenv("RATE_LIMIT_DOCUMENT_INTELLIGENCE_RPM", "0")),
+        "rate_limit_document_intelligence_concurrency": int(
+            os.getenv("RATE_LIMIT_DOCUMENT_INTELLIGENCE_CONCURRENCY", "8")),
+        "rate_limit_search_rpm": int(os.getenv("RATE_LIMIT_SEARCH_RPM", "0")),
+        "rate_limit_search_concurrency": int(os.getenv("RATE_LIMIT_SEARCH_CONCURRENCY", "4")),
+        "rate_limit_max_retries": int(os.getenv("RATE_LIMIT_MAX_RETRIES", "8")),
         "account_name": os.getenv("STORAGE_ACCOUNT_NAME", None),
         "account_key": os.getenv("STORAGE_ACCOUNT_KEY", None),
         "document_intelligence_endpoint": os.getenv("DOCUMENT_INTELLIGENCE_ENDPOINT"),
         "document_intelligence_key": os.getenv("DOCUMENT_INTELLIGENCE_API_KEY"),
-        "container_name": os.getenv("STORAGE_CONTAINER_NAME", "files")
+        "document_intelligence_page_range": int(os.getenv("DOCUMENT_INTELLIGENCE_PAGE_RANGE", "300")),
+        "document_intelligence_range_concurrency": int(os.getenv("DOCUMENT_INTELLIGENCE_RANGE_CONCURRENCY", "4")),
+        "document_intelligence_cache_path": os.getenv("DOCUMENT_INTELLIGENCE_CACHE_PATH", ""),
+        "document_intelligence_cache_max_mb": int(os.getenv("DOCUMENT_INTELLIGENCE_CACHE_MAX_MB", "2048")),
+        "chunking_strategy": os.getenv("CHUNKING_STRATEGY", "text").lower(),
+        "chunk_max_tokens": int(os.getenv("CHUNK_MAX_TOKENS", "500")),
+        "chunk_overlap_tokens": int(os.getenv("CHUNK_OVERLAP_TOKENS", "125")),
+        "media_handler_routes": os.getenv("MEDIA_HANDLER_ROUTES", ""),
+        "media_handler_default": os.getenv("MEDIA_HANDLER_DEFAULT", "document_intelligence"),
+        "container_name": os.getenv("STORAGE_CONTAINER_NAME", "files"),
+        "storage_prefixes": [prefix for prefix in os.getenv("STORAGE_PREFIXES", "").split(",") if prefix],
+        "storage_list_workers": int(os.getenv("STORAGE_LIST_WORKERS", "8")),
+        "shard_count": int(os.getenv("SHARD_COUNT", "1")),
+        "shard_index": int(os.getenv("SHARD_INDEX")) if os.getenv("SHARD_INDEX") else None,
+        "shard_run_id": os.getenv("SHARD_RUN_ID", ""),
+        "shard_container_name": os.getenv("SHARD_CONTAINER_NAME", "blob-indexer-shards"),
+        "shard_lease_seconds": int(os.getenv("SHARD_LEASE_SECONDS", "60")),
+        "run_budget_seconds": float(os.getenv("RUN_BUDGET_SECONDS", "0")),
+        "run_budget_calls": int(os.getenv("RUN_BUDGET_CALLS", "0")),
+        "run_budget_tokens": int(os.getenv("RUN_BUDGET_TOKENS", "0")),
+        "run_priority": os.getenv("RUN_PRIORITY", "recency").lower(),
+        "run_priority_metadata": os.getenv("RUN_PRIORITY_METADATA", "priority"),
+        "journal_path": os.getenv("JOURNAL_PATH", ""),
+        "incremental_mode": os.getenv("INCREMENTAL_MODE", "off").lower(),
+        "incremental_state_path": os.getenv("INCREMENTAL_STATE_PATH", ".blob-indexer/changefeed.json"),
+        "incremental_max_age_hours": int(os.getenv("INCREMENTAL_MAX_AGE_HOURS", "168"))
     }
 
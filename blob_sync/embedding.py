@@ -0,0 +1,125 @@
+import asyncio
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Dict, List, Tuple
+
+from blob_sync.cache import LocalCache, cache_key
+from blob_sync.chunking import token_counter
+from blob_sync.ratelimit import RateLimiter
+
+if TYPE_CHECKING:
+    from langchain_core.embeddings import Embeddings
+
+
+class BatchedEmbedder:
+    """Embeds texts in batches packed up to the model's input-count and token limits"""
+
+    def __init__(self, embedder: "Embeddings", model: str, batch_size: int = 16, batch_tokens: int = 100000,
+                 concurrency: int = 4, cache: LocalCache = None, dimensions: int = None, limiter: RateLimiter = None):
+        self.embedder = embedder
+        # Requests and tokens per minute of the model, shared with the other embedders of the process
+        self.limiter = limiter
+        self.model = model
+        self.cache = cache
+        self.dimensions = dimensions
+        self.batch_size = max(1, batch_size)
+        self.batch_tokens = max(1, batch_tokens)
+        self.concurrency = max(1, concurrency)
+        self.count_tokens = token_counter(model)
+
+    def batches(self, texts: List[str], tokens: List[int] = None) -> List[List[int]]:
+        """Packs the indexes of texts into batches, keeping each under the input-count and token limits.
+        A text that alone exceeds the token limit gets a batch of its own."""
+        if tokens is None:
+            tokens = [self.count_tokens(text) for text in texts]
+        batches = []
+        batch = []
+        batch_tokens = 0
+        for i, text_tokens in enumerate(tokens):
+            if batch and (len(batch) >= self.batch_size or batch_tokens + text_tokens > self.batch_tokens):
+                batches.append(batch)
+                batch = []
+                batch_tokens = 0
+            batch.append(i)
+            batch_tokens += text_tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        """Returns the vectors in the same order as the texts, taking the ones it can from the cache"""
+        if self.cache is None:
+            return self.embed_batches(texts)
+        keys, cached, missing = self.lookup(texts)
+        return self.store(keys, cached, missing, self.embed_batches(list(missing.values())))
+
+    async def aembed(self, texts: List[str]) -> List[List[float]]:
+        """embed for async code, the batches are sent with the async client of the embedder"""
+        if self.cache is None:
+            return await self.aembed_batches(texts)
+        keys, cached, missing = self.lookup(texts)
+        return self.store(keys, cached, missing, await self.aembed_batches(list(missing.values())))
+
+    def lookup(self, texts: List[str]) -> Tuple[List[str], Dict[str, bytes], Dict[str, str]]:
+        """The cache keys of the texts, the cached vectors and the texts to embed by key"""
+        keys = [cache_key(self.model, str(self.dimensions or ""), text) for text in texts]
+        cached = self.cache.get_many(keys)
+        # identical texts are embedded only once
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+        return keys, cached, missing
+
+    def store(self, keys: List[str], cached: Dict[str, bytes], missing: Dict[str, str],
+              vectors: List[List[float]]) -> List[List[float]]:
+        fresh = {key: array("f", vector).tobytes() for key, vector in zip(missing, vectors)}
+        self.cache.put_many(fresh)
+        cached.update(fresh)
+        return [array("f", cached[key]).tolist() for key in keys]
+
+    def embed_batches(self, texts: List[str]) -> List[List[float]]:
+        vectors = [None] * len(texts)
+        tokens = [self.count_tokens(text) for text in texts]
+        batches = self.batches(texts, tokens)
+        if not batches:
+            return []
+
+        def embed_batch(batch: List[int]) -> List[List[float]]:
+            def request():
+                return self.embedder.embed_documents([texts[i] for i in batch], chunk_size=len(batch))
+
+            if self.limiter is None:
+                return request()
+            return self.limiter.call(request, tokens=sum(tokens[i] for i in batch))
+
+        if len(batches) == 1 or self.concurrency == 1:
+            results = [embed_batch(batch) for batch in batches]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.concurrency, len(batches))) as executor:
+                results = list(executor.map(embed_batch, batches))
+        for batch, result in zip(batches, results):
+            for i, vector in zip(batch, result):
+                vectors[i] = vector
+        return vectors
+
+    async def aembed_batches(self, texts: List[str]) -> List[List[float]]:
+        vectors = [None] * len(texts)
+        tokens = [self.count_tokens(text) for text in texts]
+        batches = self.batches(texts, tokens)
+        slots = asyncio.Semaphore(self.concurrency)
+
+        async def embed_batch(batch: List[int]) -> List[List[float]]:
+            async def request():
+                return await self.embedder.aembed_documents([texts[i] for i in batch], chunk_size=len(batch))
+
+            async with slots:
+                if self.limiter is None:
+                    return await request()
+                return await self.limiter.acall(request, tokens=sum(tokens[i] for i in batch))
+
+        results = await asyncio.gather(*(embed_batch(batch) for batch in batches))
+        for batch, result in zip(batches, results):
+            for i, vector in zip(batch, result):
+                vectors[i] = vector
+        return vectors
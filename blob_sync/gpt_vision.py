@@ -25,6 +25,6 @@ class GPTVisionMediaHandler:
             )
         self.llm = llm
 
-    def handle(self, file_path: str) -> List[Document]:
+    def handle(self, source) -> List[Document]:
         print("Not implemented yet")
         return []
@@ -0,0 +1,165 @@
+import importlib
+import logging
+import re
+import threading
+from html.parser import HTMLParser
+from importlib.metadata import entry_points
+from pathlib import Path
+from typing import Callable, Dict, List, Union
+
+from blob_sync.blob import BlobContent
+from blob_sync.cache import LocalCache
+from blob_sync.chunking import Chunk, Chunker, chunker_from_config
+from blob_sync.otel import telemetry
+
+# Packages can add handlers under this entry point group, the name is what routes refer to
+ENTRY_POINT_GROUP = "blob_sync.media_handlers"
+# Factories of the built-in handlers, called with the config and the extraction cache shared by the handlers.
+# They are imported the first time a blob is routed to them, a run without work never loads the SDKs.
+HANDLERS = {
+    "text": "blob_sync.handlers:text_handler_from_config",
+    "document_intelligence": "blob_sync.azure_document_intelligence:doc_intelligence_from_config",
+}
+# Content types and extensions that need no analysis, blob storage often has application/octet-stream for
+# everything so the extension is looked at too
+ROUTES = {
+    "text/plain": "text",
+    "text/markdown": "text",
+    "text/x-markdown": "text",
+    "text/html": "text",
+    ".txt": "text",
+    ".md": "text",
+    ".markdown": "text",
+    ".html": "text",
+    ".htm": "text",
+}
+
+
+def parse_routes(value: str) -> Dict[str, str]:
+    """Parses "image/png=vision,.eml=mypackage.handlers:factory" into a route table"""
+    routes = {}
+    for route in filter(None, (route.strip() for route in value.split(","))):
+        key, _, handler = route.partition("=")
+        if not handler.strip():
+            raise ValueError(f"Invalid media handler route {route}, expected <content type or .extension>=<handler>")
+        routes[key.strip().lower()] = handler.strip()
+    return routes
+
+
+def load_factory(name: str) -> Callable:
+    """A handler factory by built-in name, entry point name or "module:attribute" import string"""
+    reference = HANDLERS.get(name)
+    if reference is None:
+        found = entry_points(group=ENTRY_POINT_GROUP, name=name)
+        if found:
+            return next(iter(found)).load()
+        reference = name
+    module, _, attribute = reference.partition(":")
+    if not attribute:
+        raise ValueError(f"Unknown media handler {name}, not built in, not an entry point of {ENTRY_POINT_GROUP} "
+                         f"and not a module:attribute import string")
+    return getattr(importlib.import_module(module), attribute)
+
+
+class MediaHandlerRegistry:
+    """Routes a downloaded blob to a handler by its content type, then its extension, then the default.
+    Handlers are created on the first blob routed to them."""
+
+    def __init__(self, config: Dict, routes: Dict[str, str] = None, default: str = "document_intelligence",
+                 cache: LocalCache = None):
+        self.config = config
+        self.routes = {**ROUTES, **(routes or {})}
+        self.default = default
+        # Extracted text by content hash, shared by all the handlers
+        self.cache = cache
+        self.handlers = {}
+        self.lock = threading.Lock()
+
+    def route(self, source: Union[str, BlobContent]) -> str:
+        name = source.name if isinstance(source, BlobContent) else source
+        content_type = getattr(source, "content_type", None)
+        if content_type:
+            handler = self.routes.get(content_type.split(";")[0].strip().lower())
+            if handler:
+                return handler
+        return self.routes.get(Path(name).suffix.lower(), self.default)
+
+    def handler(self, name: str):
+        handler = self.handlers.get(name)
+        if handler is None:
+            with self.lock:
+                handler = self.handlers.get(name)
+                if handler is None:
+                    logging.info(f"Loading media handler {name}")
+                    handler = self.handlers[name] = load_factory(name)(self.config, cache=self.cache)
+        return handler
+
+    def handle(self, source: Union[str, BlobContent]) -> List[Chunk]:
+        return self.handler(self.route(source)).handle(source)
+
+
+class TextMediaHandler:
+    """Chunks plain text, markdown and HTML without sending them to analysis. HTML is reduced to its text,
+    headings become markdown headings so the markdown strategy still splits at them."""
+
+    def __init__(self, chunker: Chunker = None):
+        self.chunker = chunker or Chunker()
+
+    def handle(self, source: Union[str, BlobContent]) -> List[Chunk]:
+        name = source.name if isinstance(source, BlobContent) else source
+        text = source.read_text() if isinstance(source, BlobContent) else Path(source).read_text()
+        content_type = getattr(source, "content_type", None) or ""
+        if content_type.startswith("text/html") or Path(name).suffix.lower() in (".html", ".htm"):
+            text = html_to_text(text)
+        with telemetry.span("chunk", strategy=self.chunker.strategy):
+            return list(self.chunker.split(text))
+
+
+class HTMLText(HTMLParser):
+    skipped = {"script", "style", "head", "template", "noscript"}
+    blocks = {"p", "div", "br", "li", "tr", "table", "ul", "ol", "section", "article", "header", "footer",
+              "blockquote", "pre", "hr"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.skipped:
+            self.skipping += 1
+        elif re.fullmatch(r"h[1-6]", tag):
+            self.parts.append("\n\n" + "#" * int(tag[1]) + " ")
+        elif tag in self.blocks:
+            self.parts.append("\n\n" if tag != "br" else "\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.skipped:
+            self.skipping = max(0, self.skipping - 1)
+        elif tag in self.blocks or re.fullmatch(r"h[1-6]", tag):
+            self.parts.append("\n\n")
+
+    def handle_data(self, data):
+        if not self.skipping:
+            self.parts.append(re.sub(r"\s+", " ", data))
+
+
+def html_to_text(markup: str) -> str:
+    parser = HTMLText()
+    parser.feed(markup)
+    parser.close()
+    lines = (line.strip() for line in "".join(parser.parts).split("\n"))
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+
+def text_handler_from_config(config: Dict, cache: LocalCache = None) -> TextMediaHandler:
+    return TextMediaHandler(chunker_from_config(config))
+
+
+def media_handlers_from_config(config: Dict) -> MediaHandlerRegistry:
+    cache = None
+    if config["document_intelligence_cache_path"]:
+        cache = LocalCache(config["document_intelligence_cache_path"],
+                           max_bytes=config["document_intelligence_cache_max_mb"] * 1024 * 1024)
+    return MediaHandlerRegistry(config, routes=parse_routes(config["media_handler_routes"]),
+                                default=config["media_handler_default"], cache=cache)
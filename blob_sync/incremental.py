@@ -0,0 +1,124 @@
+import json
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+from azure.core.exceptions import ResourceNotFoundError
+
+from blob_sync.blob import BlobRecord, BlobWrapper
+from blob_sync.transport import transport_from_config
+
+UPSERT_EVENTS = {"BlobCreated", "BlobPropertiesUpdated"}
+DELETE_EVENTS = {"BlobDeleted"}
+
+
+class ChangeFeedSource:
+    """Builds the changeset from the storage change feed instead of listing the whole container.
+    The position in the feed is kept in a state file. Without a usable position (first run, a cursor older
+    than max_age or one the feed rejects) changes() returns None and the caller has to list the container."""
+
+    def __init__(self, feed_client, blob_client: BlobWrapper, state_path: str, max_age: timedelta = timedelta(days=7),
+                 results_per_page: int = 5000):
+        self.feed_client = feed_client
+        self.blob_client = blob_client
+        self.state_path = state_path
+        self.max_age = max_age
+        self.results_per_page = results_per_page
+        self.state = self.load_state()
+        self.next_state = None
+
+    def load_state(self) -> Dict:
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            logging.warning(f"Ignoring unreadable change feed state {self.state_path}: {e}")
+            return {}
+
+    def changes(self) -> Optional[Dict[str, List[BlobRecord]]]:
+        """Returns the changeset since the last run, or None when a full listing is needed"""
+        now = datetime.now(timezone.utc)
+        updated = self.state.get("updated")
+        if not updated or now - datetime.fromisoformat(updated) > self.max_age:
+            logging.info("No recent change feed position, listing the whole container")
+            return None
+        try:
+            if self.state.get("cursor"):
+                pages = self.feed_client.list_changes(results_per_page=self.results_per_page).by_page(
+                    continuation_token=self.state["cursor"])
+            else:
+                pages = self.feed_client.list_changes(start_time=datetime.fromisoformat(self.state["start_time"]),
+                                                      results_per_page=self.results_per_page).by_page()
+            # The last event of each blob wins
+            events = {}
+            for page in pages:
+                for event in page:
+                    name = self.blob_name(event)
+                    if name is not None and event["eventType"] in UPSERT_EVENTS | DELETE_EVENTS:
+                        if name not in events or events[name]["eventTime"] <= event["eventTime"]:
+                            events[name] = event
+            cursor = pages.continuation_token
+        except Exception as e:
+            logging.warning(f"Could not read the change feed, listing the whole container: {e}")
+            return None
+        self.next_state = {"cursor": cursor, "updated": now.isoformat()}
+        changeset = {"upsert": [], "remove": []}
+        for name, event in events.items():
+            record = self.current(name) if event["eventType"] in UPSERT_EVENTS else None
+            if record is None or record.deleted:
+                changeset["remove"].append(BlobRecord(name=name, deleted=True))
+            else:
+                changeset["upsert"].append(record)
+        return changeset
+
+    def blob_name(self, event: Dict) -> Optional[str]:
+        """Name of the blob from the event subject, None for other containers"""
+        prefix = f"/blobServices/default/containers/{self.blob_client.container_name}/blobs/"
+        subject = event.get("subject", "")
+        return subject[len(prefix):] if subject.startswith(prefix) else None
+
+    def current(self, name: str) -> Optional[BlobRecord]:
+        """The blob as it is now, it may have changed or been deleted after the event"""
+        try:
+            return BlobRecord.from_properties(self.blob_client.container.get_blob_client(name).get_blob_properties(),
+                                              self.blob_client.priority_metadata)
+        except ResourceNotFoundError:
+            return None
+
+    def start(self):
+        """Marks the start of a full listing, the next run reads the feed from here"""
+        now = datetime.now(timezone.utc)
+        self.next_state = {"start_time": now.isoformat(), "updated": now.isoformat()}
+
+    def commit(self):
+        """Persists the feed position once the changes are indexed"""
+        if self.next_state is None:
+            return
+        if os.path.dirname(self.state_path):
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.next_state, f)
+        os.replace(tmp_path, self.state_path)
+        self.state = self.next_state
+        self.next_state = None
+
+
+def change_feed_from_config(config: Dict[str, str], blob_client: BlobWrapper) -> ChangeFeedSource:
+    """Creates a change feed source from a config, needs the azure-storage-blob-changefeed package"""
+    from azure.storage.blob.changefeed import ChangeFeedClient
+
+    transport = transport_from_config(config)
+    if config["account_key"]:
+        feed_client = ChangeFeedClient.from_connection_string(
+            conn_str=f"DefaultEndpointsProtocol=https;AccountName={config['account_name']};"
+                     f"AccountKey={config['account_key']};EndpointSuffix=core.windows.net",
+            **transport.azure_kwargs())
+    else:
+        feed_client = ChangeFeedClient(account_url=f"https://{config['account_name']}.blob.core.windows.net",
+                                       credential=transport.credential(), **transport.azure_kwargs())
+    return ChangeFeedSource(feed_client, blob_client, config["incremental_state_path"],
+                            max_age=timedelta(hours=config["incremental_max_age_hours"]))
@@ -0,0 +1,132 @@
+import json
+import logging
+import time
+from typing import Callable, Dict, List, Optional
+
+from azure.core.exceptions import HttpResponseError, ServiceRequestError, ServiceResponseError
+from azure.search.documents import IndexDocumentsBatch, SearchClient
+
+from blob_sync.otel import telemetry
+from blob_sync.ratelimit import RateLimiter
+
+# Per-document status codes that Azure AI Search documents as transient
+RETRYABLE_STATUS_CODES = {409, 422, 429, 503}
+# Azure AI Search rejects larger requests with a 413 that is not retried. The sizes are measured on json.dumps,
+# the SDK serializer may differ slightly (number formatting, escaping), hence the margin.
+MAX_REQUEST_BYTES = 16 * 1024 * 1024 - 256 * 1024
+# {"value": [ ... ]} around the actions of a request
+REQUEST_ENVELOPE_BYTES = len('{"value": []}')
+# "@search.action" member of each action, by action
+ACTION_NAMES = {"upload": "upload", "merge_or_upload": "mergeOrUpload", "delete": "delete"}
+
+
+class IndexWriter:
+    """Buffers index actions across items and sends them in bulk requests.
+    The buffer is flushed before an action would make the request larger than max_bytes (JSON payload size,
+    never more than MAX_REQUEST_BYTES) and when it reaches max_documents.
+    Only the keys that failed with a transient status are retried, with exponential backoff."""
+
+    def __init__(self, client: SearchClient, max_documents: int = 1000, max_bytes: int = 16 * 1024 * 1024,
+                 max_retries: int = 5, backoff: float = 1.0, on_flush: Callable[[List[Dict]], None] = None,
+                 limiter: RateLimiter = None):
+        self.client = client
+        # Paces the bulk requests, throttled documents slow down the other callers of the service too
+        self.limiter = limiter
+        # Called after every flush with the documents that could not be indexed, deletes with the document_id
+        # they were given
+        self.on_flush = on_flush
+        self.max_documents = max_documents
+        self.max_bytes = min(max_bytes, MAX_REQUEST_BYTES)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        # key -> (action, document, size in the request, document_id). A later action on the same key replaces the
+        # pending one, a single batch must not contain the same key twice.
+        self.pending: Dict[str, tuple] = {}
+        # Size of the request the pending actions make
+        self.pending_bytes = REQUEST_ENVELOPE_BYTES
+        self.stats = None
+        self.reset()
+
+    def reset(self):
+        self.stats = {"requests": 0, "documents": 0, "retries": 0, "failed": 0}
+
+    def upload(self, documents: List[Dict]):
+        for doc in documents:
+            self._add("upload", doc, doc.get("document_id"))
+
+    def merge_or_upload(self, documents: List[Dict]):
+        for doc in documents:
+            self._add("merge_or_upload", doc, doc.get("document_id"))
+
+    def delete(self, keys: List[str], document_id: str = None):
+        """Deletes the keys, a failed delete is reported with document_id, the document the chunks belong to"""
+        for key in keys:
+            self._add("delete", {"id": key}, document_id)
+
+    def _add(self, action: str, doc: Dict, document_id: Optional[str]):
+        # the document with its "@search.action": "...", member and the comma separating it from the next one
+        size = len(json.dumps(doc)) + len(f'"@search.action": "{ACTION_NAMES[action]}", ') + len(", ")
+        key = doc["id"]
+        replaced = self.pending[key][2] if key in self.pending else 0
+        if self.pending and self.pending_bytes - replaced + size > self.max_bytes:
+            self.flush()
+            replaced = 0
+        self.pending[key] = (action, doc, size, document_id)
+        self.pending_bytes += size - replaced
+        # a document larger than max_bytes on its own goes alone, its error is reported per document
+        if len(self.pending) >= self.max_documents or self.pending_bytes >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        entries = self.pending
+        self.pending = {}
+        self.pending_bytes = REQUEST_ENVELOPE_BYTES
+        errors = []
+        for attempt in range(self.max_retries + 1):
+            retry = {}
+            throttled = False
+            for key, status, message in self._send(entries):
+                if status in RETRYABLE_STATUS_CODES and attempt < self.max_retries:
+                    retry[key] = entries[key]
+                    throttled = throttled or status in (429, 503)
+                else:
+                    _, doc, _, document_id = entries[key]
+                    errors.append(({**doc, "document_id": document_id} if document_id else doc, status, message))
+            if not retry:
+                break
+            if self.limiter and throttled:
+                self.limiter.throttled()
+            self.stats["retries"] += len(retry)
+            time.sleep(self.backoff * 2 ** attempt)
+            entries = retry
+        for doc, status, message in errors:
+            self.stats["failed"] += 1
+            logging.warning(f"Could not index document {doc.get('url', doc['id'])} to Azure Search: "
+                            f"{status} {message}")
+        if self.on_flush:
+            self.on_flush([doc for doc, _, _ in errors])
+
+    def _send(self, entries: Dict[str, tuple]) -> List[tuple]:
+        """Sends one batch, returns the (key, status, message) of the actions that did not succeed"""
+        batch = IndexDocumentsBatch()
+        for action, doc, _, _ in entries.values():
+            getattr(batch, f"add_{action}_actions")([doc])
+        self.stats["requests"] += 1
+        telemetry.payload("upload", REQUEST_ENVELOPE_BYTES + sum(entry[2] for entry in entries.values()))
+        try:
+            # Batches mix the chunks of many blobs, each upload is a trace of its own
+            with telemetry.span("upload", root=True, documents=len(entries)):
+                if self.limiter:
+                    results = self.limiter.call(lambda: self.client.index_documents(batch))
+                else:
+                    results = self.client.index_documents(batch)
+        except HttpResponseError as e:
+            return [(key, e.status_code, e.message) for key in entries]
+        except (ServiceRequestError, ServiceResponseError) as e:
+            # connection level errors, worth retrying the whole batch
+            return [(key, 503, str(e)) for key in entries]
+        failed = [(result.key, result.status_code, result.error_message) for result in results if not result.succeeded]
+        self.stats["documents"] += len(entries) - len(failed)
+        return failed
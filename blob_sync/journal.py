@@ -0,0 +1,106 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from itertools import chain
+from typing import Callable, Iterable, List, Tuple
+
+from blob_sync.blob import BlobRecord
+
+# An item goes through listed, extracted and embedded and is done once it is uploaded or removed
+DONE = ("uploaded", "removed")
+
+
+class RunJournal:
+    """Records the stage of every item of a run in a sqlite file, so that a run that dies halfway can be resumed.
+    Done items are cleared when a run finishes, anything else left in the journal at the start of a run is from
+    a run that died or from items that failed: unfinished items are done first and finished ones are skipped."""
+
+    def __init__(self, path: str):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS items (name TEXT PRIMARY KEY, action TEXT, etag TEXT, "
+                        "record TEXT, stage TEXT, updated REAL)")
+        self.stats = {"resumed": 0, "skipped": 0}
+
+    def start(self, create: List[BlobRecord], update: List[BlobRecord], remove: List[BlobRecord],
+              owns: Callable[[str], bool] = None) -> Tuple[List[BlobRecord], List[BlobRecord], List[BlobRecord]]:
+        """Merges the work left by an unfinished run into the planned work and records the plan.
+        Unfinished items come first, re-planned items the previous run already finished are skipped.
+        With owns, only the unfinished items it accepts are resumed, the others belong to other shards."""
+        self.stats = {"resumed": 0, "skipped": 0}
+        with self.lock:
+            rows = self.db.execute("SELECT name, action, etag, record, stage FROM items").fetchall()
+        finished = {name: etag for name, action, etag, record, stage in rows if stage in DONE}
+        unfinished = {name: (action, record) for name, action, etag, record, stage in rows
+                      if stage not in DONE and (owns is None or owns(name))}
+        planned = {item.name: item for item in chain(create, update, remove)}
+
+        def keep(item: BlobRecord) -> bool:
+            if item.name in finished and finished[item.name] == item.etag:
+                self.stats["skipped"] += 1
+                return False
+            return item.name not in unfinished
+
+        create = [item for item in create if keep(item)]
+        update = [item for item in update if keep(item)]
+        remove = [item for item in remove if keep(item)]
+        resumed_update = []
+        resumed_remove = []
+        for name, (action, record) in unfinished.items():
+            item = planned.get(name) or to_record(record)
+            # Only some of the chunks may be in the index, a resumed upsert is always an update
+            (resumed_remove if item.deleted else resumed_update).append(item)
+            self.stats["resumed"] += 1
+        update = resumed_update + update
+        remove = resumed_remove + remove
+
+        with self.lock:
+            self.db.execute("BEGIN")
+            for action, items in (("create", create), ("update", update), ("remove", remove)):
+                self.db.executemany("INSERT INTO items (name, action, etag, record, stage, updated) "
+                                    "VALUES (?, ?, ?, ?, 'listed', ?) ON CONFLICT(name) DO UPDATE SET "
+                                    "action = excluded.action, etag = excluded.etag, record = excluded.record",
+                                    [(item.name, action, item.etag, from_record(item), time.time())
+                                     for item in items])
+            self.db.execute("COMMIT")
+        return create, update, remove
+
+    def mark(self, names: Iterable[str], stage: str):
+        with self.lock:
+            self.db.executemany("UPDATE items SET stage = ?, updated = ? WHERE name = ?",
+                                [(stage, time.time(), name) for name in names])
+
+    def finish(self):
+        """The run is complete, only the items that failed are left for the next one"""
+        with self.lock:
+            self.db.execute(f"DELETE FROM items WHERE stage IN {DONE}")
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def from_record(record: BlobRecord) -> str:
+    return json.dumps({"name": record.name,
+                       "last_modified": record.last_modified.isoformat() if record.last_modified else None,
+                       "etag": record.etag,
+                       "size": record.size,
+                       "content_md5": record.content_md5.hex() if record.content_md5 else None,
+                       "content_type": record.content_type,
+                       "deleted": record.deleted,
+                       "priority": record.priority})
+
+
+def to_record(value: str) -> BlobRecord:
+    fields = json.loads(value)
+    if fields["last_modified"]:
+        fields["last_modified"] = datetime.fromisoformat(fields["last_modified"])
+    if fields["content_md5"]:
+        fields["content_md5"] = bytes.fromhex(fields["content_md5"])
+    return BlobRecord(**fields)
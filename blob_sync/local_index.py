@@ -0,0 +1,382 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import threading
+from typing import AsyncIterator, Dict, Iterator, List, Optional
+
+import numpy as np
+from azure.core.exceptions import ResourceNotFoundError
+from azure.search.documents.models import IndexingResult
+
+from blob_sync.azure_ai_search import AzureAISearchIndexer
+
+# Fields kept in columns, the ones the indexer filters on. The rest of a document is kept as json
+COLUMNS = ["id", "document_id", "content_md5"]
+VECTOR_FIELD = "chunkVector"
+
+
+class LocalVectorStore:
+    """A search index in a directory: the vectors in a memory-mapped float32 matrix, one row per chunk,
+    and the other fields in sqlite. Vectors are stored normalized, the cosine similarity is a dot product.
+
+    Top-k queries scan the matrix with NumPy in blocks. With hnsw and hnswlib installed they go through an
+    HNSW graph persisted next to the matrix instead."""
+
+    block_rows = 65536
+
+    def __init__(self, path: str, dimensions: int, hnsw: bool = False):
+        self.path = path
+        self.dimensions = dimensions
+        self.lock = threading.RLock()
+        self.db = None
+        self.matrix = None
+        self.live = None
+        self.graph = None
+        self.hnsw = hnsw
+
+    def open(self):
+        """Creates the index or opens the existing one, the idempotent counterpart of create_or_update_index"""
+        with self.lock:
+            if self.db is not None:
+                return self
+            os.makedirs(self.path, exist_ok=True)
+            self.db = sqlite3.connect(os.path.join(self.path, "metadata.sqlite"), check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS documents (id TEXT PRIMARY KEY, document_id TEXT, "
+                            "content_md5 TEXT, row INTEGER, data TEXT)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS documents_document_id ON documents (document_id)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS documents_content_md5 ON documents (content_md5)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS free_rows (row INTEGER PRIMARY KEY)")
+            stored = self.db.execute("SELECT value FROM settings WHERE name = 'dimensions'").fetchone()
+            if stored is None:
+                self.db.execute("INSERT INTO settings VALUES ('dimensions', ?), ('rows', 0)", (str(self.dimensions),))
+            elif int(stored[0]) != self.dimensions:
+                raise ValueError(f"The local index in {self.path} has {stored[0]} dimensions, not {self.dimensions}. "
+                                 f"Drop it to change them")
+            self.db.commit()
+            rows = int(self.db.execute("SELECT value FROM settings WHERE name = 'rows'").fetchone()[0])
+            self.map(max(rows, 1024))
+            self.live = np.zeros(len(self.matrix), dtype=bool)
+            for (row,) in self.db.execute("SELECT row FROM documents WHERE row IS NOT NULL"):
+                self.live[row] = True
+            if self.hnsw:
+                self.open_graph()
+        return self
+
+    def map(self, rows: int):
+        """Maps the matrix file with room for rows vectors, growing the file when needed"""
+        path = os.path.join(self.path, "vectors.f32")
+        size = rows * self.dimensions * 4
+        if not os.path.exists(path) or os.path.getsize(path) < size:
+            with open(path, "ab") as f:
+                f.truncate(size)
+        if self.matrix is not None:
+            self.matrix.flush()
+        self.matrix = np.memmap(path, dtype=np.float32, mode="r+", shape=(rows, self.dimensions))
+
+    def open_graph(self):
+        try:
+            # optional, brute force top-k without it
+            import hnswlib
+        except ImportError:
+            logging.warning("LOCAL_INDEX_HNSW is set but hnswlib is not installed, searching the vectors exhaustively")
+            self.hnsw = False
+            return
+        self.graph = hnswlib.Index(space="ip", dim=self.dimensions)
+        path = os.path.join(self.path, "hnsw.bin")
+        if os.path.exists(path):
+            self.graph.load_index(path, max_elements=len(self.matrix), allow_replace_deleted=True)
+        else:
+            self.graph.init_index(max_elements=len(self.matrix), allow_replace_deleted=True)
+            rows = np.flatnonzero(self.live)
+            if len(rows):
+                self.graph.add_items(self.matrix[rows], rows)
+
+    def close(self):
+        with self.lock:
+            if self.db is None:
+                return
+            self.matrix.flush()
+            if self.graph is not None:
+                self.graph.save_index(os.path.join(self.path, "hnsw.bin"))
+            self.db.close()
+            self.db = None
+            self.matrix = None
+            self.graph = None
+
+    def drop(self):
+        self.close()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def write(self, actions: List[Dict]) -> List[IndexingResult]:
+        """Applies upload, merge, mergeOrUpload and delete actions in one transaction"""
+        results = []
+        with self.lock:
+            for action in actions:
+                doc = dict(action)
+                kind = doc.pop("@search.action")
+                if kind == "delete":
+                    self.delete(doc["id"])
+                else:
+                    existing = self.get(doc["id"], vectors=False)
+                    if kind == "merge" and existing is None:
+                        results.append(IndexingResult(key=doc["id"], succeeded=False, status_code=404,
+                                                      error_message="Document not found"))
+                        continue
+                    if kind in ("merge", "mergeOrUpload") and existing is not None:
+                        doc = {**existing, **doc}
+                    self.put(doc)
+                results.append(IndexingResult(key=doc["id"], succeeded=True, status_code=200))
+            self.db.commit()
+            self.matrix.flush()
+        return results
+
+    def put(self, doc: Dict):
+        vector = doc.pop(VECTOR_FIELD, None)
+        row = self.db.execute("SELECT row FROM documents WHERE id = ?", (doc["id"],)).fetchone()
+        row = row[0] if row else None
+        if vector is not None:
+            if row is None:
+                row = self.allocate()
+            vector = np.asarray(vector, dtype=np.float32)
+            norm = np.linalg.norm(vector)
+            self.matrix[row] = vector / norm if norm else vector
+            self.live[row] = True
+            if self.graph is not None:
+                self.graph.add_items(self.matrix[row:row + 1], [row], replace_deleted=True)
+        self.db.execute("INSERT OR REPLACE INTO documents (id, document_id, content_md5, row, data) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (doc["id"], doc.get("document_id"), doc.get("content_md5"), row, json.dumps(doc)))
+
+    def delete(self, key: str):
+        row = self.db.execute("SELECT row FROM documents WHERE id = ?", (key,)).fetchone()
+        if row is None:
+            return
+        self.db.execute("DELETE FROM documents WHERE id = ?", (key,))
+        if row[0] is not None:
+            self.live[row[0]] = False
+            self.db.execute("INSERT OR IGNORE INTO free_rows VALUES (?)", (row[0],))
+            if self.graph is not None:
+                self.graph.mark_deleted(row[0])
+
+    def allocate(self) -> int:
+        """A free row of the matrix, rows of deleted documents are reused"""
+        free = self.db.execute("SELECT row FROM free_rows LIMIT 1").fetchone()
+        if free is not None:
+            self.db.execute("DELETE FROM free_rows WHERE row = ?", free)
+            return free[0]
+        row = int(self.db.execute("SELECT value FROM settings WHERE name = 'rows'").fetchone()[0])
+        self.db.execute("UPDATE settings SET value = ? WHERE name = 'rows'", (str(row + 1),))
+        if row >= len(self.matrix):
+            self.map(len(self.matrix) * 2)
+            self.live = np.concatenate([self.live, np.zeros(len(self.matrix) - len(self.live), dtype=bool)])
+            if self.graph is not None:
+                self.graph.resize_index(len(self.matrix))
+        return row
+
+    def get(self, key: str, vectors: bool = True) -> Optional[Dict]:
+        with self.lock:
+            found = self.db.execute("SELECT data, row FROM documents WHERE id = ?", (key,)).fetchone()
+            if found is None:
+                return None
+            return self.document(*found, vectors)
+
+    def document(self, data: str, row: Optional[int], vectors: bool = True) -> Dict:
+        doc = json.loads(data)
+        if row is not None and vectors:
+            doc[VECTOR_FIELD] = self.matrix[row].tolist()
+        return doc
+
+    def query(self, where: str = "", parameters: tuple = (), order_by: str = "", top: int = None,
+              vectors: bool = True) -> List[Dict]:
+        sql = "SELECT data, row FROM documents" + (f" WHERE {where}" if where else "") + \
+              (f" ORDER BY {order_by}" if order_by else "") + (f" LIMIT {int(top)}" if top else "")
+        with self.lock:
+            return [self.document(data, row, vectors) for data, row in self.db.execute(sql, parameters).fetchall()]
+
+    def nearest(self, vector: List[float], k: int) -> List[tuple]:
+        """Returns the (row, cosine similarity) of the k nearest vectors"""
+        query = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        query = query / norm if norm else query
+        with self.lock:
+            live = int(self.live.sum())
+            if not live:
+                return []
+            if self.graph is not None:
+                rows, distances = self.graph.knn_query(query, k=min(k, live))
+                return [(int(row), 1 - float(distance)) for row, distance in zip(rows[0], distances[0])]
+            best_rows = np.empty(0, dtype=np.int64)
+            best_scores = np.empty(0, dtype=np.float32)
+            for start in range(0, len(self.matrix), self.block_rows):
+                mask = self.live[start:start + self.block_rows]
+                if not mask.any():
+                    continue
+                scores = self.matrix[start:start + len(mask)] @ query
+                scores[~mask] = -np.inf
+                best_rows = np.concatenate([best_rows, np.arange(start, start + len(mask))])
+                best_scores = np.concatenate([best_scores, scores])
+                if len(best_scores) > k:
+                    keep = np.argpartition(-best_scores, k)[:k]
+                    best_rows, best_scores = best_rows[keep], best_scores[keep]
+            order = np.argsort(-best_scores)
+            return [(int(best_rows[i]), float(best_scores[i])) for i in order if best_scores[i] > -np.inf]
+
+    def by_rows(self, rows: List[int]) -> Dict[int, Dict]:
+        with self.lock:
+            found = self.db.execute(f"SELECT data, row FROM documents WHERE row IN ({','.join('?' * len(rows))})",
+                                    rows).fetchall()
+            return {row: self.document(data, row) for data, row in found}
+
+
+class LocalSearchClient:
+    """The part of SearchClient the indexer uses, over a LocalVectorStore. Understands the filters the indexer
+    sends, id gt '...', search.in(field, ...) and field eq '...' or ..., and vector queries on chunkVector"""
+
+    def __init__(self, store: LocalVectorStore):
+        self.store = store
+
+    def search(self, search_text: str = "*", select: List[str] = None, filter: str = None,
+               order_by: List[str] = None, top: int = None, vector_queries: list = None, **kwargs) -> Iterator[Dict]:
+        self.store.open()
+        where, parameters = to_sql(filter)
+        if vector_queries:
+            query = vector_queries[0]
+            results = []
+            nearest = self.store.nearest(query.vector, query.k_nearest_neighbors if not where else len(self.store.live))
+            docs = self.store.by_rows([row for row, _ in nearest])
+            allowed = None if not where else {doc["id"] for doc in self.store.query(where, parameters, vectors=False)}
+            for row, score in nearest:
+                doc = docs.get(row)
+                if doc is not None and (allowed is None or doc["id"] in allowed):
+                    results.append({**doc, "@search.score": score})
+            results = results[:top or query.k_nearest_neighbors]
+        else:
+            order = ", ".join(order_clause(field) for field in order_by) if order_by else ""
+            results = self.store.query(where, parameters, order, top, vectors=not select or VECTOR_FIELD in select)
+        return iter([{field: doc.get(field) for field in select} if select else doc for doc in results])
+
+    def get_document(self, key: str, selected_fields: List[str] = None, **kwargs) -> Dict:
+        doc = self.store.open().get(key)
+        if doc is None:
+            raise ResourceNotFoundError("Document not found")
+        return {field: doc.get(field) for field in selected_fields} if selected_fields else doc
+
+    def index_documents(self, batch, **kwargs) -> List[IndexingResult]:
+        return self.store.open().write([action.as_dict() for action in batch.actions])
+
+    def close(self):
+        self.store.close()
+
+
+class AsyncLocalSearchClient:
+    """The async counterpart of LocalSearchClient, the calls run in a thread as the store is sqlite and NumPy.
+    The store belongs to the indexer, closing the client leaves it open."""
+
+    def __init__(self, client: LocalSearchClient):
+        self.client = client
+
+    async def search(self, search_text: str = "*", **kwargs) -> AsyncIterator[Dict]:
+        results = await asyncio.to_thread(lambda: list(self.client.search(search_text, **kwargs)))
+        return aiter_results(results)
+
+    async def get_document(self, key: str, selected_fields: List[str] = None, **kwargs) -> Dict:
+        return await asyncio.to_thread(self.client.get_document, key, selected_fields)
+
+    async def index_documents(self, batch, **kwargs) -> List[IndexingResult]:
+        return await asyncio.to_thread(self.client.index_documents, batch)
+
+    async def close(self):
+        pass
+
+    async def __aenter__(self) -> "AsyncLocalSearchClient":
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+
+async def aiter_results(results: List[Dict]) -> AsyncIterator[Dict]:
+    for result in results:
+        yield result
+
+
+def to_sql(odata_filter: Optional[str]) -> tuple:
+    """Translates the OData filters the indexer sends to a sqlite where clause and its parameters"""
+    if not odata_filter:
+        return "", ()
+    if m := re.fullmatch(r"id gt '((?:[^']|'')*)'", odata_filter):
+        return "id > ?", (m.group(1).replace("''", "'"),)
+    if m := re.fullmatch(r"search\.in\((\w+), '(.*)', '(.)'\)", odata_filter, re.DOTALL):
+        values = [value.replace("''", "'") for value in m.group(2).split(m.group(3))]
+        return f"{column(m.group(1))} IN ({','.join('?' * len(values))})", tuple(values)
+    conditions = re.findall(r"(\w+) eq '((?:[^']|'')*)'", odata_filter)
+    if conditions and re.fullmatch(r"\w+ eq '(?:[^']|'')*'(?: or \w+ eq '(?:[^']|'')*')*", odata_filter):
+        return " OR ".join(f"{column(field)} = ?" for field, _ in conditions), \
+            tuple(value.replace("''", "'") for _, value in conditions)
+    raise ValueError(f"Filter not supported by the local index: {odata_filter}")
+
+
+def order_clause(order_by: str) -> str:
+    field, _, direction = order_by.partition(" ")
+    if direction.lower() not in ("", "asc", "desc"):
+        raise ValueError(f"Order not supported by the local index: {order_by}")
+    return f"{column(field)} {direction or 'asc'}"
+
+
+def column(field: str) -> str:
+    if field not in COLUMNS:
+        raise ValueError(f"Field {field} is not filterable in the local index")
+    return field
+
+
+class LocalIndexer(AzureAISearchIndexer):
+    """The indexer on a local vector store in LOCAL_INDEX_PATH instead of Azure AI Search.
+    Everything but the index is the same: the listing, the diff, the pipeline, the embeddings and the writer."""
+
+    def create_client(self, config) -> LocalSearchClient:
+        self.store = LocalVectorStore(os.path.join(config["local_index_path"], self.index_name),
+                                      self.vector_dimensions, hnsw=config["local_index_hnsw"])
+        return LocalSearchClient(self.store)
+
+    def aio_client(self, aio=None) -> AsyncLocalSearchClient:
+        """The local index needs no connections, aio is not used"""
+        return AsyncLocalSearchClient(self.client)
+
+    def create_or_update_index(self):
+        self.store.open()
+
+    def drop_index(self, name: str = None):
+        if name is None or name == self.index_name:
+            self.store.drop()
+        else:
+            shutil.rmtree(os.path.join(self.config["local_index_path"], name), ignore_errors=True)
+
+    def list_indexes(self) -> List[str]:
+        path = self.config["local_index_path"]
+        if not os.path.isdir(path):
+            return []
+        return [name for name in os.listdir(path) if os.path.isdir(os.path.join(path, name))]
+
+    def aliases(self) -> Dict[str, str]:
+        try:
+            with open(os.path.join(self.config["local_index_path"], "aliases.json")) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def alias_target(self) -> Optional[str]:
+        return self.aliases().get(self.alias)
+
+    def switch_alias(self, index_name: str):
+        aliases = self.aliases()
+        aliases[self.alias] = index_name
+        path = os.path.join(self.config["local_index_path"], "aliases.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(aliases, f)
+        # the rename is atomic, a reader sees the old or the new alias
+        os.replace(path + ".tmp", path)
@@ -1,28 +1,36 @@
 import logging
 import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
 
 from azure.core.settings import settings
-from azure.monitor.opentelemetry.exporter import AzureMonitorLogExporter
-from opentelemetry.sdk._logs import (
-    LoggerProvider,
-    LoggingHandler
-)
-from opentelemetry._logs import set_logger_provider
-from opentelemetry.sdk._logs._internal.export import BatchLogRecordProcessor
-from opentelemetry import trace
-from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry import metrics, trace
+from opentelemetry.trace import Span, Status, StatusCode
 
 
 def setup():
     settings.tracing_implementation = "opentelemetry"
+    # Every blob is a trace, only this share of them is recorded. Metrics are not sampled.
+    sample_ratio = float(os.environ.get("TRACING_SAMPLE_RATIO", "0.1"))
+    span_exporters = []
+    metric_exporters = []
     if os.environ.get("APPLICATIONINSIGHTS_CONNECTION_STRING") is not None:
-        trace.set_tracer_provider(TracerProvider())
-        tracer = trace.get_tracer(__name__)
+        # The exporters and the SDK are loaded only when there is somewhere to export to
+        from azure.monitor.opentelemetry.exporter import AzureMonitorLogExporter, AzureMonitorMetricExporter, \
+            AzureMonitorTraceExporter
+        from opentelemetry._logs import set_logger_provider
+        from opentelemetry.sdk._logs import LoggerProvider, LoggingHandler
+        from opentelemetry.sdk._logs._internal.export import BatchLogRecordProcessor
+        connection_string = os.environ["APPLICATIONINSIGHTS_CONNECTION_STRING"]
+        span_exporters.append(AzureMonitorTraceExporter(connection_string=connection_string))
+        metric_exporters.append(AzureMonitorMetricExporter(connection_string=connection_string))
         logger_provider = LoggerProvider()
         set_logger_provider(logger_provider)
 
         exporter = AzureMonitorLogExporter(
-            connection_string=os.environ["APPLICATIONINSIGHTS_CONNECTION_STRING"]
+            connection_string=connection_string
         )
 
         logger_provider.add_log_record_processor(BatchLogRecordProcessor(exporter))
@@ -32,3 +40,102 @@ def setup():
         logging.getLogger().addHandler(handler)
     else:
         logging.warning("No application insights connection string found.")
+    if os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT") is not None:
+        try:
+            # optional, the opentelemetry-exporter-otlp package reads the endpoint and headers from the environment
+            from opentelemetry.exporter.otlp.proto.http.metric_exporter import OTLPMetricExporter
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+            span_exporters.append(OTLPSpanExporter())
+            metric_exporters.append(OTLPMetricExporter())
+        except ImportError:
+            logging.warning("OTEL_EXPORTER_OTLP_ENDPOINT is set but opentelemetry-exporter-otlp is not installed")
+    if span_exporters:
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+        tracer_provider = TracerProvider(sampler=ParentBased(TraceIdRatioBased(sample_ratio)))
+        for span_exporter in span_exporters:
+            tracer_provider.add_span_processor(BatchSpanProcessor(span_exporter))
+        trace.set_tracer_provider(tracer_provider)
+    if metric_exporters:
+        from opentelemetry.sdk.metrics import MeterProvider
+        from opentelemetry.sdk.metrics.export import PeriodicExportingMetricReader
+        metrics.set_meter_provider(MeterProvider(
+            metric_readers=[PeriodicExportingMetricReader(metric_exporter) for metric_exporter in metric_exporters]))
+
+
+class Telemetry:
+    """Spans, histograms and counters of a run. Without exporters (no setup) the OpenTelemetry calls are no-ops,
+    the summary of the stage timings and payload sizes is kept either way for the diagnostics."""
+
+    def __init__(self):
+        # the global tracer and meter are proxies until setup() sets the providers
+        self.tracer = trace.get_tracer("blob_sync")
+        meter = metrics.get_meter("blob_sync")
+        self.durations = meter.create_histogram("blob_sync.stage.duration", unit="s",
+                                                description="Duration of a stage of indexing a blob")
+        self.payloads = meter.create_histogram("blob_sync.payload.size", unit="By",
+                                               description="Size of downloaded blobs and upload requests")
+        self.api_calls = meter.create_counter("blob_sync.api.calls", description="Requests sent to a service")
+        self.api_retries = meter.create_counter("blob_sync.api.retries",
+                                                description="Requests retried after a throttled or failed response")
+        self.lock = threading.Lock()
+        self.summary = None
+        self.reset()
+
+    def reset(self):
+        self.summary = {"stages": {}, "bytes": {}}
+
+    @contextmanager
+    def span(self, name: str, parent: Span = None, root: bool = False, **attributes) -> Iterator[Span]:
+        """Times a stage into the histogram and the summary, inside a span that is a child of parent,
+        of the current span, or with root the start of a new trace"""
+        if root:
+            context = trace.set_span_in_context(trace.INVALID_SPAN)
+        elif parent is not None:
+            context = trace.set_span_in_context(parent)
+        else:
+            context = None
+        start = time.perf_counter()
+        with self.tracer.start_as_current_span(name, context=context, attributes=attributes,
+                                               record_exception=True, set_status_on_exception=True) as span:
+            try:
+                yield span
+            finally:
+                self.record(name, time.perf_counter() - start)
+
+    def start_blob(self, name: str, action: str) -> Span:
+        """Root span of one blob, ended by end_blob. Its stages run in different threads"""
+        return self.tracer.start_span("blob", context=trace.set_span_in_context(trace.INVALID_SPAN),
+                                      attributes={"blob.name": name, "blob.action": action})
+
+    @staticmethod
+    def end_blob(span: Optional[Span], error: Exception = None):
+        if span is None:
+            return
+        if error is not None:
+            span.record_exception(error)
+            span.set_status(Status(StatusCode.ERROR, str(error)))
+        span.end()
+
+    def record(self, stage: str, seconds: float):
+        self.durations.record(seconds, {"stage": stage})
+        with self.lock:
+            stats = self.summary["stages"].setdefault(stage, {"count": 0, "seconds": 0.0, "max_seconds": 0.0})
+            stats["count"] += 1
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+
+    def payload(self, kind: str, size: int):
+        self.payloads.record(size, {"kind": kind})
+        with self.lock:
+            self.summary["bytes"][kind] = self.summary["bytes"].get(kind, 0) + size
+
+    def api_call(self, service: str, outcome: str):
+        self.api_calls.add(1, {"service": service, "outcome": outcome})
+
+    def api_retry(self, service: str, reason: str):
+        self.api_retries.add(1, {"service": service, "reason": reason})
+
+
+telemetry = Telemetry()
@@ -0,0 +1,78 @@
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Iterable, List, Tuple
+
+_DONE = object()
+
+
+class Pipeline:
+    """Runs items through a sequence of stages, each with its own pool of worker threads.
+    The stages are connected with bounded queues, so a slow stage holds back the ones before it
+    instead of letting work pile up in memory. Items come out of the pipeline in completion order."""
+
+    def __init__(self, stages: List[Tuple[str, Callable[[Any], Any], int]], queue_size: int = 8):
+        self.stages = [(name, fn, max(1, workers)) for name, fn, workers in stages]
+        self.queue_size = queue_size
+        self.stats = {name: {"items": 0, "errors": 0, "seconds": 0.0} for name, _, _ in self.stages}
+        self.lock = threading.Lock()
+
+    def run(self, items: Iterable, sink: Callable[[Any], None], describe: Callable[[Any], str] = str):
+        """Feeds the items to the first stage and calls sink with the output of the last stage.
+        The sink runs in the calling thread. An item failing in a stage is logged and dropped."""
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self._feed, args=(items, queues[0]), daemon=True)]
+        for i, (name, fn, workers) in enumerate(self.stages):
+            next_workers = self.stages[i + 1][2] if i + 1 < len(self.stages) else 1
+            remaining = [workers]
+            for _ in range(workers):
+                threads.append(threading.Thread(target=self._work,
+                                                args=(name, fn, queues[i], queues[i + 1], remaining, next_workers,
+                                                      describe),
+                                                daemon=True))
+        for thread in threads:
+            thread.start()
+        while True:
+            result = queues[-1].get()
+            if result is _DONE:
+                break
+            sink(result)
+        for thread in threads:
+            thread.join()
+
+    def _feed(self, items: Iterable, out: queue.Queue):
+        try:
+            for item in items:
+                out.put(item)
+        finally:
+            for _ in range(self.stages[0][2]):
+                out.put(_DONE)
+
+    def _work(self, name: str, fn: Callable, inbox: queue.Queue, out: queue.Queue, remaining: List[int],
+              next_workers: int, describe: Callable[[Any], str]):
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                break
+            start = time.perf_counter()
+            try:
+                result = fn(item)
+                error = False
+            except Exception as e:
+                logging.warning(f"{name} failed for {describe(item)}: {e}")
+                result = None
+                error = True
+            with self.lock:
+                self.stats[name]["items"] += 1
+                self.stats[name]["errors"] += error
+                self.stats[name]["seconds"] += time.perf_counter() - start
+            if result is not None:
+                out.put(result)
+        # The last worker of the stage to finish tells the next stage there is nothing more coming
+        with self.lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            for _ in range(next_workers):
+                out.put(_DONE)
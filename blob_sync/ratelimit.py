@@ -0,0 +1,256 @@
+import asyncio
+import email.utils
+import logging
+import random
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+from azure.core.exceptions import ServiceRequestError, ServiceResponseError
+
+from blob_sync.otel import telemetry
+
+T = TypeVar("T")
+
+# Statuses worth another try, 429 and 503 are the services telling us to slow down
+THROTTLE_STATUS_CODES = {429, 503}
+TRANSIENT_STATUS_CODES = {408, 500, 502, 504}
+
+
+class TokenBucket:
+    """Refills at per_minute / 60 per second up to one minute of quota. A take larger than the bucket
+    waits for a full bucket and leaves it in debt, so oversized requests still go through."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def wait_time(self, amount: float) -> float:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing * 60 / self.capacity)
+
+    def take(self, amount: float):
+        self.level -= amount
+
+
+class RateLimiter:
+    """Schedules the calls to one service. A call waits for its share of the requests per minute and tokens per
+    minute buckets and for a concurrency slot. The concurrency limit is adjusted AIMD style: it grows by one every
+    limit successful calls while the latency stays near the best seen, and is halved on a throttled response.
+    Throttled and transient failures are retried after the Retry-After the service asked for, or with
+    exponential backoff, and every caller of the service waits that long."""
+
+    def __init__(self, name: str, requests_per_minute: float = 0, tokens_per_minute: float = 0,
+                 max_concurrency: int = 8, max_retries: int = 8, backoff: float = 1.0, max_backoff: float = 60.0):
+        self.name = name
+        self.condition = threading.Condition()
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_concurrency = max(1, max_concurrency)
+        self.limit = float(self.max_concurrency)
+        self.active = 0
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.latency = None
+        self.best_latency = None
+        self.stats = None
+        self.reset()
+
+    def reset(self):
+        self.stats = {"calls": 0, "tokens": 0, "throttled": 0, "retries": 0, "wait_seconds": 0.0,
+                      "concurrency": self.limit, "latency_seconds": self.latency}
+
+    def configure(self, requests_per_minute: float = 0, tokens_per_minute: float = 0, max_concurrency: int = 8,
+                  max_retries: int = 8):
+        with self.condition:
+            self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+            self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+            self.max_concurrency = max(1, max_concurrency)
+            self.limit = min(self.limit, self.max_concurrency)
+            self.max_retries = max_retries
+            self.condition.notify_all()
+
+    def call(self, fn: Callable[[], T], tokens: float = 0) -> T:
+        """Runs fn when the quota allows it, retrying throttled and transient failures"""
+        for attempt in range(self.max_retries + 1):
+            self.acquire(tokens)
+            start = time.monotonic()
+            try:
+                result = fn()
+            except Exception as e:
+                time.sleep(self.failed(e, attempt, time.monotonic() - start))
+                continue
+            self.release(time.monotonic() - start, False)
+            telemetry.api_call(self.name, "ok")
+            return result
+
+    async def acall(self, fn: Callable[[], Awaitable[T]], tokens: float = 0) -> T:
+        """call for a coroutine, the wait for the quota runs in a thread so it does not block the event loop"""
+        for attempt in range(self.max_retries + 1):
+            await asyncio.to_thread(self.acquire, tokens)
+            start = time.monotonic()
+            try:
+                result = await fn()
+            except Exception as e:
+                await asyncio.sleep(self.failed(e, attempt, time.monotonic() - start))
+                continue
+            self.release(time.monotonic() - start, False)
+            telemetry.api_call(self.name, "ok")
+            return result
+
+    def failed(self, e: Exception, attempt: int, latency: float) -> float:
+        """Records a failed call and returns how long to wait before the retry, raises e when it is not retried.
+        A throttled call pauses every caller of the service instead"""
+        status = status_code(e)
+        throttled = status in THROTTLE_STATUS_CODES
+        self.release(latency, throttled)
+        telemetry.api_call(self.name, "throttled" if throttled else "error")
+        if not (throttled or status in TRANSIENT_STATUS_CODES or is_connection_error(e)) \
+                or attempt == self.max_retries:
+            raise e
+        delay = retry_after(e)
+        if delay is None:
+            delay = min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+        logging.info(f"{self.name} call failed ({status or e}), retrying in {delay:.1f}s")
+        telemetry.api_retry(self.name, "throttled" if throttled else str(status or type(e).__name__))
+        with self.condition:
+            self.stats["retries"] += 1
+            if throttled:
+                self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        return 0.0 if throttled else delay
+
+    def acquire(self, tokens: float = 0):
+        start = time.monotonic()
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                wait = max(self.paused_until - now,
+                           self.requests.wait_time(1) if self.requests else 0.0,
+                           self.tokens.wait_time(tokens) if self.tokens and tokens else 0.0)
+                if wait <= 0 and self.active < int(self.limit):
+                    break
+                # woken up early when a slot frees, otherwise when the quota or pause allows
+                self.condition.wait(timeout=wait if wait > 0 else None)
+            if self.requests:
+                self.requests.take(1)
+            if self.tokens and tokens:
+                self.tokens.take(tokens)
+            self.active += 1
+            self.stats["calls"] += 1
+            self.stats["tokens"] += tokens
+            self.stats["wait_seconds"] += time.monotonic() - start
+
+    def release(self, latency: float, throttled: bool):
+        with self.condition:
+            self.active -= 1
+            now = time.monotonic()
+            if throttled:
+                self._decrease(now)
+            else:
+                self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+                self.best_latency = self.latency if self.best_latency is None else min(self.best_latency,
+                                                                                       self.latency)
+                # a growing latency means the service is queueing our calls, more of them would not help
+                if self.latency < 2 * self.best_latency:
+                    self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+            self.stats["concurrency"] = round(self.limit, 2)
+            self.stats["latency_seconds"] = round(self.latency, 3) if self.latency is not None else None
+            self.condition.notify_all()
+
+    def throttled(self):
+        """Records a throttled response the caller retries itself, like a failed document in a bulk upload"""
+        with self.condition:
+            self._decrease(time.monotonic())
+
+    def _decrease(self, now: float):
+        self.stats["throttled"] += 1
+        # the calls in flight when the service pushed back count as one signal
+        if now - self.last_decrease > (self.latency or 1.0):
+            self.limit = max(1.0, self.limit / 2)
+            self.last_decrease = now
+        self.stats["concurrency"] = round(self.limit, 2)
+
+
+class RateScheduler:
+    """The rate limiters of the services a run calls, shared by all the clients of the process"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.limiters: Dict[str, RateLimiter] = {}
+
+    def limiter(self, name: str) -> RateLimiter:
+        with self.lock:
+            if name not in self.limiters:
+                self.limiters[name] = RateLimiter(name)
+            return self.limiters[name]
+
+    def reset(self):
+        for limiter in list(self.limiters.values()):
+            limiter.reset()
+
+    @property
+    def stats(self) -> Dict[str, Dict]:
+        return {name: limiter.stats for name, limiter in self.limiters.items()}
+
+
+scheduler = RateScheduler()
+
+
+def status_code(e: Exception) -> Optional[int]:
+    status = getattr(e, "status_code", None)
+    if status is None:
+        status = getattr(getattr(e, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def is_connection_error(e: Exception) -> bool:
+    # openai is matched by name, importing it only for the check would cost every run half a second
+    return isinstance(e, (ServiceRequestError, ServiceResponseError)) or any(
+        cls.__name__ == "APIConnectionError" and cls.__module__.startswith("openai") for cls in type(e).__mro__)
+
+
+def retry_after(e: Exception) -> Optional[float]:
+    """Seconds the service asked us to wait, from the retry-after-ms or Retry-After headers"""
+    headers = getattr(getattr(e, "response", None), "headers", None)
+    if not headers:
+        return None
+    for header in ("retry-after-ms", "x-ms-retry-after-ms"):
+        if headers.get(header):
+            try:
+                return float(headers[header]) / 1000
+            except ValueError:
+                pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def scheduler_from_config(config: Dict) -> RateScheduler:
+    """Applies the configured limits to the shared scheduler"""
+    scheduler.limiter("openai").configure(requests_per_minute=config["rate_limit_openai_rpm"],
+                                          tokens_per_minute=config["rate_limit_openai_tpm"],
+                                          max_concurrency=config["rate_limit_openai_concurrency"],
+                                          max_retries=config["rate_limit_max_retries"])
+    scheduler.limiter("document_intelligence").configure(
+        requests_per_minute=config["rate_limit_document_intelligence_rpm"],
+        max_concurrency=config["rate_limit_document_intelligence_concurrency"],
+        max_retries=config["rate_limit_max_retries"])
+    scheduler.limiter("search").configure(requests_per_minute=config["rate_limit_search_rpm"],
+                                          max_concurrency=config["rate_limit_search_concurrency"],
+                                          max_retries=config["rate_limit_max_retries"])
+    return scheduler
@@ -10,5 +10,11 @@ def search_indexer_from_config(config: Dict[str, str]):
             return AzureAISearchIndexer(
                 config=config
             )
+        case "LOCAL":
+            # numpy is only loaded for a local index
+            from blob_sync.local_index import LocalIndexer
+            return LocalIndexer(
+                config=config
+            )
         case _:
             raise Exception(f'Invalid search type {config["search_type"]} specified in config')
@@ -0,0 +1,177 @@
+import hashlib
+import json
+import logging
+import random
+import threading
+import time
+from typing import Dict, Iterable, Optional
+
+from azure.core.exceptions import AzureError, HttpResponseError, ResourceExistsError, ResourceNotFoundError
+from azure.storage.blob import BlobServiceClient, ContainerClient
+
+from blob_sync.transport import transport_from_config
+
+
+def shard_of(name: str, count: int) -> int:
+    """Shard of a blob name, stable across processes and nodes unlike hash()"""
+    return int.from_bytes(hashlib.md5(name.encode("utf-8")).digest()[:8], "big") % count
+
+
+class ShardLease:
+    """A claimed shard. The lease on the shard blob is renewed in the background until the shard is completed
+    or released, a worker that dies loses the lease and another worker can take the shard over.
+    A failed renewal is retried while the lease lasts, once it is lost the worker has to stop indexing the shard."""
+
+    def __init__(self, coordinator: "ShardCoordinator", shard: int, blob_client, lease):
+        self.coordinator = coordinator
+        self.shard = shard
+        self.blob_client = blob_client
+        self.lease = lease
+        self.lost = False
+        self.stopped = threading.Event()
+        self.renewer = threading.Thread(target=self._renew, daemon=True)
+        self.renewer.start()
+
+    def owns(self, name: str) -> bool:
+        return shard_of(name, self.coordinator.count) == self.shard
+
+    def _renew(self):
+        lease_seconds = self.coordinator.lease_seconds
+        retry_wait = lease_seconds / 12
+        renewed = time.monotonic()
+        wait = lease_seconds / 3
+        while not self.stopped.wait(wait):
+            try:
+                self.lease.renew()
+            except AzureError as e:
+                # 409 and 412: the lease expired and is held by another worker, or it is not ours anymore
+                definitive = getattr(e, "status_code", None) in (409, 412)
+                if not definitive and time.monotonic() + retry_wait - renewed < lease_seconds:
+                    logging.warning(f"Could not renew the lease of shard {self.shard}, retrying: {e}")
+                    wait = retry_wait
+                    continue
+                self.lost = True
+                logging.error(f"Lost the lease of shard {self.shard}, another worker may take it over: {e}")
+                return
+            renewed = time.monotonic()
+            wait = lease_seconds / 3
+
+    def complete(self, diagnostics: Dict):
+        """Records the diagnostics of the shard for this run and releases it"""
+        self.stopped.set()
+        self.renewer.join()
+        self.blob_client.upload_blob(json.dumps({"run": self.coordinator.run_id, "diagnostics": diagnostics}),
+                                     overwrite=True, lease=self.lease)
+        self.lease.release()
+
+    def release(self):
+        """Gives the shard back unfinished"""
+        self.stopped.set()
+        self.renewer.join()
+        try:
+            self.lease.release()
+        except HttpResponseError as e:
+            logging.warning(f"Could not release the lease of shard {self.shard}: {e}")
+
+
+class ShardCoordinator:
+    """Splits a run across workers. The blob names are partitioned into count shards by hash and every shard
+    has a blob in the coordination container. A worker claims a shard by taking the lease of its blob, and writes
+    the run id and its diagnostics into the blob when the shard is done. The last worker to finish merges the
+    diagnostics of all the shards. Every worker of a run has to be started with the same run id."""
+
+    def __init__(self, container: ContainerClient, count: int, run_id: str, lease_seconds: int = 60):
+        self.container = container
+        self.count = count
+        self.run_id = run_id
+        # Blob leases are 15 to 60 seconds
+        self.lease_seconds = lease_seconds
+
+    def claim(self, preferred: int = None) -> Optional[ShardLease]:
+        """Leases a shard not done in this run, None when every shard is done or taken"""
+        try:
+            self.container.create_container()
+        except ResourceExistsError:
+            pass
+        if preferred is not None:
+            shards = [preferred]
+        else:
+            # Workers starting together would all try the same shard first
+            offset = random.randrange(self.count)
+            shards = [(offset + i) % self.count for i in range(self.count)]
+        for shard in shards:
+            blob_client = self.container.get_blob_client(self.shard_blob(shard))
+            try:
+                blob_client.upload_blob(b"{}", overwrite=False)
+            except ResourceExistsError:
+                pass
+            if self.done(blob_client):
+                continue
+            try:
+                lease = blob_client.acquire_lease(lease_duration=self.lease_seconds)
+            except HttpResponseError:
+                # leased by another worker
+                continue
+            # another worker may have finished it between the check and the lease
+            if self.done(blob_client):
+                lease.release()
+                continue
+            return ShardLease(self, shard, blob_client, lease)
+        return None
+
+    def done(self, blob_client) -> bool:
+        return self.read(blob_client).get("run") == self.run_id
+
+    def shard_blob(self, shard: int) -> str:
+        return f"{self.run_id}/shard-{shard}-of-{self.count}.json"
+
+    def merge(self) -> Optional[Dict]:
+        """Merged diagnostics of the run once every shard is done, None while some are left"""
+        shards = [self.read(self.container.get_blob_client(self.shard_blob(shard))) for shard in range(self.count)]
+        if any(shard.get("run") != self.run_id for shard in shards):
+            return None
+        diagnostics = merge_diagnostics([shard["diagnostics"] for shard in shards])
+        diagnostics["shards"] = self.count
+        self.container.get_blob_client(f"{self.run_id}/diagnostics.json").upload_blob(json.dumps(diagnostics),
+                                                                                       overwrite=True)
+        return diagnostics
+
+    @staticmethod
+    def read(blob_client) -> Dict:
+        try:
+            return json.loads(blob_client.download_blob().readall() or b"{}")
+        except ResourceNotFoundError:
+            return {}
+
+
+def merge_diagnostics(items: Iterable[Dict]) -> Dict:
+    """Adds up the counters of several diagnostics, nested dicts are merged key by key"""
+    merged = {}
+    for diagnostics in items:
+        for key, value in diagnostics.items():
+            if isinstance(value, dict):
+                merged[key] = merge_diagnostics([merged.get(key) or {}, value])
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                merged[key] = merged.get(key, 0) + value
+            elif merged.get(key) is None:
+                merged[key] = value
+    return merged
+
+
+def shard_coordinator_from_config(config: Dict) -> ShardCoordinator:
+    """Creates a shard coordinator from a config, the coordination container is in the storage account"""
+    if not config["shard_run_id"]:
+        raise ValueError("SHARD_RUN_ID must be set when SHARD_COUNT is more than 1")
+    transport = transport_from_config(config)
+    if config["account_key"]:
+        service = BlobServiceClient.from_connection_string(
+            conn_str=f"DefaultEndpointsProtocol=https;AccountName={config['account_name']};"
+                     f"AccountKey={config['account_key']};EndpointSuffix=core.windows.net",
+            **transport.azure_kwargs())
+    else:
+        service = BlobServiceClient(account_url=f"https://{config['account_name']}.blob.core.windows.net",
+                                    credential=transport.credential(), **transport.azure_kwargs())
+    return ShardCoordinator(service.get_container_client(config["shard_container_name"]),
+                            count=config["shard_count"],
+                            run_id=config["shard_run_id"],
+                            lease_seconds=config["shard_lease_seconds"])
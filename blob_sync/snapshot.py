@@ -0,0 +1,85 @@
+import os
+import sqlite3
+import tempfile
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Tuple
+
+from blob_sync.blob import BlobRecord
+
+
+class IndexSnapshot:
+    """Indexing state of every document in the search index, loaded with a single scan.
+    Backed by sqlite, in memory or in a temporary file for indexes that do not fit in memory."""
+
+    def __init__(self, on_disk: bool = False):
+        self.path = None
+        if on_disk:
+            fd, self.path = tempfile.mkstemp(suffix=".sqlite")
+            os.close(fd)
+        self.db = sqlite3.connect(self.path or ":memory:")
+        self.db.execute("CREATE TABLE documents (document_id TEXT PRIMARY KEY, last_modified REAL, "
+                        "last_indexed REAL, seen INTEGER DEFAULT 0)")
+        self.db.execute("CREATE TABLE chunks (id TEXT PRIMARY KEY, document_id TEXT)")
+        self.db.execute("CREATE INDEX chunks_document_id ON chunks (document_id)")
+
+    def add(self, key: str, document_id: str, last_modified_date: str, last_indexed_date: str):
+        """Adds a chunk, a document has the latest dates of its chunks as unchanged chunks are not rewritten"""
+        self.db.execute("INSERT OR REPLACE INTO chunks (id, document_id) VALUES (?, ?)", (key, document_id))
+        self.db.execute("INSERT INTO documents (document_id, last_modified, last_indexed) VALUES (?, ?, ?) "
+                        "ON CONFLICT(document_id) DO UPDATE SET "
+                        "last_modified = max(last_modified, excluded.last_modified), "
+                        "last_indexed = max(last_indexed, excluded.last_indexed)",
+                        (document_id, to_timestamp(last_modified_date), to_timestamp(last_indexed_date)))
+
+    def get(self, document_id: str) -> Tuple[datetime, datetime]:
+        """Returns (last_indexed_date, last_modified_date) like AzureAISearchIndexer.get_indexing_metadata"""
+        row = self.db.execute("SELECT last_indexed, last_modified FROM documents WHERE document_id = ?",
+                              (document_id,)).fetchone()
+        if row is None:
+            return None, datetime(1900, 1, 1, 1, 1, tzinfo=timezone.utc)
+        return from_timestamp(row[0]), from_timestamp(row[1])
+
+    def chunk_keys(self, document_ids: Iterable[str]) -> Dict[str, List[str]]:
+        """Returns the keys of the chunks of each document"""
+        keys = {}
+        for document_id in document_ids:
+            keys[document_id] = [row[0] for row in self.db.execute("SELECT id FROM chunks WHERE document_id = ?",
+                                                                   (document_id,))]
+        return keys
+
+    def __len__(self):
+        return self.db.execute("SELECT count(*) FROM documents").fetchone()[0]
+
+    def diff(self, blobs: Iterable[BlobRecord], full_reindex: bool = False) -> Tuple[List, List, List]:
+        """Diffs the blob listing against the snapshot in one pass, consuming it as a stream.
+        Returns the blobs to create, the blobs to update and the documents to remove. A document is removed when
+        it has no live blob, whether the blob is soft deleted or deleted for good."""
+        create = []
+        update = []
+        for blob in blobs:
+            if blob.deleted:
+                continue
+            self.db.execute("UPDATE documents SET seen = 1 WHERE document_id = ?", (blob.name,))
+            last_indexed_date, last_modified_date_in_index = self.get(blob.name)
+            if last_indexed_date is None:
+                create.append(blob)
+            elif last_modified_date_in_index < blob.last_modified or full_reindex:
+                update.append(blob)
+        remove = [BlobRecord(name=document_id, deleted=True)
+                  for (document_id,) in self.db.execute("SELECT document_id FROM documents WHERE seen = 0")]
+        return create, update, remove
+
+    def close(self):
+        self.db.close()
+        if self.path:
+            os.remove(self.path)
+
+
+def to_timestamp(value) -> float:
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return value.timestamp()
+
+
+def from_timestamp(value: float) -> datetime:
+    return datetime.fromtimestamp(value, tz=timezone.utc)
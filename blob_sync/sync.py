@@ -5,13 +5,15 @@ from typing import Dict
 from dotenv import load_dotenv
 
 from blob_sync import otel
-from blob_sync.azure_document_intelligence import doc_intelligence_from_config
 from blob_sync.blob import blob_client_from_config
 from blob_sync.config import get_config
+from blob_sync.handlers import media_handlers_from_config
+from blob_sync.incremental import ChangeFeedSource, change_feed_from_config
 from blob_sync.search import search_indexer_from_config
+from blob_sync.sharding import ShardCoordinator, merge_diagnostics, shard_coordinator_from_config
 
 
-def sync(config: Dict[str, str] = None, blob_client=None, search=None):
+def sync(config: Dict[str, str] = None, blob_client=None, search=None, change_feed: ChangeFeedSource = None):
     load_dotenv()
     otel.setup()
     logging.getLogger().setLevel(level=os.getenv('LOG_LEVEL', 'WARNING').upper())
@@ -20,25 +22,84 @@ def sync(config: Dict[str, str] = None, blob_client=None, search=None):
         config = get_config()
     if not blob_client:
         blob_client = blob_client_from_config(config)
-        blob_client.media_handler = doc_intelligence_from_config(config)
+        blob_client.media_handler = media_handlers_from_config(config)
 
     if not search:
         search = search_indexer_from_config(config)
-    blob_client.list_blobs()
-    # blobs that are not deleted
-    current = [blob for blob in blob_client.blobs if not blob.deleted]
-    archived = [blob for blob in blob_client.blobs if blob.deleted]
-
+    if config["azure_search_rebuild"] == "rollback":
+        return search.rollback()
+    search.select_index()
     search.create_or_update_index()
     search.blob_client = blob_client
 
-    search.index(changeset={"upsert": current, "remove": archived})
+    if config["shard_count"] > 1:
+        return sync_shards(config, blob_client, search)
+
+    if not change_feed and config["incremental_mode"] == "changefeed":
+        change_feed = change_feed_from_config(config, blob_client)
+    # A rebuild reads the whole listing, the change feed continues from the time it started
+    changeset = change_feed.changes() if change_feed and config["azure_search_rebuild"] == "off" else None
+    if changeset is None:
+        if change_feed:
+            change_feed.start()
+        # The listing is streamed to the diff, soft deleted blobs included
+        changeset = {"blobs": blob_client.iter_blobs()}
+    search.index(changeset=changeset)
+    if change_feed:
+        # The journal resumes the items that failed or were deferred, without it they are only read again
+        # from the feed when the position stays where it was
+        if search.diagnostics["incomplete"] and not config["journal_path"]:
+            logging.warning(f"{search.diagnostics['incomplete']} items were not indexed, the change feed position "
+                            f"is kept and the next run reads the same changes again")
+        else:
+            change_feed.commit()
 
     logging.info("Indexing complete")
     logging.debug(search.diagnostics)
     return search.diagnostics
 
 
+def sync_shards(config: Dict, blob_client, search, coordinator: ShardCoordinator = None):
+    """Indexes the shards of a sharded run this worker can claim, one after the other.
+    Returns the merged diagnostics of the run if this worker finished it last, else the ones of its own shards"""
+    if config["incremental_mode"] != "off":
+        raise ValueError("A sharded run lists the whole container, INCREMENTAL_MODE must be off")
+    if config["azure_search_rebuild"] != "off":
+        raise ValueError("A rebuild switches the alias when the whole container is indexed, it cannot be sharded")
+    if any(config[f"run_budget_{limit}"] for limit in ("seconds", "calls", "tokens")):
+        raise ValueError("A shard is done when all its blobs are indexed, a sharded run cannot have a budget")
+    if not coordinator:
+        coordinator = shard_coordinator_from_config(config)
+    preferred = config["shard_index"]
+    shards = []
+    while shard := coordinator.claim(preferred):
+        logging.info(f"Indexing shard {shard.shard} of {coordinator.count}")
+        search.reset()
+        try:
+            # Another worker may take over a shard whose lease is lost, this one stops taking its blobs
+            search.index(changeset={"blobs": blob_client.iter_blobs()}, owns=shard.owns, stop=lambda: shard.lost)
+        except:
+            shard.release()
+            raise
+        if shard.lost:
+            logging.warning(f"Stopped indexing shard {shard.shard}, its lease was lost")
+            shard.release()
+            if preferred is not None:
+                break
+            continue
+        shard.complete(search.diagnostics)
+        shards.append(search.diagnostics)
+        if preferred is not None:
+            break
+    merged = coordinator.merge()
+    if merged is not None:
+        logging.info(f"All {coordinator.count} shards are done")
+        logging.debug(merged)
+        return merged
+    logging.info(f"Indexed {len(shards)} shards, others are still running")
+    return merge_diagnostics(shards)
+
+
 # main
 if __name__ == "__main__":
     print(sync())
@@ -0,0 +1,167 @@
+import socket
+import threading
+from typing import Dict
+
+import requests
+from azure.core.pipeline.transport import RequestsTransport
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+
+
+class Transport:
+    """The connections and the credential shared by all the clients of the process. Blob Storage, Azure AI Search,
+    Document Intelligence and the REST calls to the search service share one pool of kept-alive connections,
+    so concurrent calls reuse TLS sessions instead of opening a socket each. Entra ID tokens come from one
+    credential, fetched once per scope and refreshed in one place. The embedding model has its own httpx pools,
+    its client is built on httpx."""
+
+    def __init__(self, pool_size: int = 64, keep_alive: float = 60.0):
+        # reentrant, the credential is built on the session, which is created under the same lock
+        self.lock = threading.RLock()
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self._session = None
+        self._credential = None
+        self._http_client = None
+        self._async_http_client = None
+
+    def configure(self, pool_size: int = 64, keep_alive: float = 60.0):
+        with self.lock:
+            changed = (pool_size, keep_alive) != (self.pool_size, self.keep_alive)
+            self.pool_size = pool_size
+            self.keep_alive = keep_alive
+            if changed and self._session is not None:
+                self.mount(self._session)
+
+    @property
+    def session(self) -> requests.Session:
+        if self._session is None:
+            with self.lock:
+                if self._session is None:
+                    session = requests.Session()
+                    self.mount(session)
+                    self._session = session
+        return self._session
+
+    def mount(self, session: requests.Session):
+        # One pool per host, the services are a handful of hosts. Failed calls are retried by the SDK policies
+        # and the rate limiters, not by urllib3
+        adapter = KeepAliveAdapter(self.keep_alive, pool_connections=16, pool_maxsize=self.pool_size, max_retries=0)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+    def azure_kwargs(self) -> Dict:
+        """Keyword arguments of an Azure SDK client, its requests go through the shared session"""
+        return {"transport": RequestsTransport(session=self.session, session_owner=False)}
+
+    def credential(self):
+        """The DefaultAzureCredential of the process, the managed identity token is fetched on the shared session"""
+        if self._credential is None:
+            with self.lock:
+                if self._credential is None:
+                    from azure.identity import DefaultAzureCredential
+                    self._credential = DefaultAzureCredential(
+                        transport=RequestsTransport(session=self.session, session_owner=False))
+        return self._credential
+
+    @property
+    def http_client(self):
+        """httpx client of the OpenAI embedder, with the timeouts of the openai package"""
+        if self._http_client is None:
+            with self.lock:
+                if self._http_client is None:
+                    import openai
+                    self._http_client = openai.DefaultHttpxClient(limits=self.limits())
+        return self._http_client
+
+    @property
+    def async_http_client(self):
+        """Async httpx client of the OpenAI embedder, its connections belong to the event loop that opens them"""
+        if self._async_http_client is None:
+            with self.lock:
+                if self._async_http_client is None:
+                    import openai
+                    self._async_http_client = openai.DefaultAsyncHttpxClient(limits=self.limits())
+        return self._async_http_client
+
+    def limits(self):
+        import httpx
+        return httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size,
+                            keepalive_expiry=self.keep_alive)
+
+    def aio(self) -> "AsyncTransport":
+        return AsyncTransport(self.pool_size, self.keep_alive)
+
+    def close(self):
+        with self.lock:
+            if self._credential is not None:
+                self._credential.close()
+            if self._http_client is not None:
+                self._http_client.close()
+            if self._session is not None:
+                self._session.close()
+            self._session = self._credential = self._http_client = self._async_http_client = None
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """Turns on TCP keep-alive probes, an idle pooled connection is not silently dropped by a load balancer
+    (Azure drops idle flows after 4 minutes) and reused dead"""
+
+    def __init__(self, keep_alive: float, **kwargs):
+        self.socket_options = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            self.socket_options += [(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(1, int(keep_alive))),
+                                    (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, int(keep_alive) // 4))]
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = self.socket_options
+        super().init_poolmanager(*args, **kwargs)
+
+
+class AsyncTransport:
+    """The shared connections for async code, an aiohttp session and an async credential that belong to the
+    event loop of the async with block. Needs the aiohttp package.
+
+        async with transport.aio() as aio:
+            container = blob_client.aio_container(aio)
+    """
+
+    def __init__(self, pool_size: int = 64, keep_alive: float = 60.0):
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.session = None
+        self._credential = None
+
+    async def __aenter__(self) -> "AsyncTransport":
+        try:
+            import aiohttp
+        except ImportError as e:
+            raise ImportError("The async clients need the aiohttp package") from e
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=self.keep_alive))
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self._credential is not None:
+            await self._credential.close()
+        await self.session.close()
+
+    def azure_kwargs(self) -> Dict:
+        from azure.core.pipeline.transport import AioHttpTransport
+        return {"transport": AioHttpTransport(session=self.session, session_owner=False)}
+
+    def credential(self):
+        if self._credential is None:
+            from azure.identity.aio import DefaultAzureCredential
+            self._credential = DefaultAzureCredential(**self.azure_kwargs())
+        return self._credential
+
+
+transport = Transport()
+
+
+def transport_from_config(config: Dict) -> Transport:
+    """The transport of the process, with the pool size and keep-alive of the config"""
+    transport.configure(pool_size=config["http_pool_size"], keep_alive=config["http_keep_alive_seconds"])
+    return transport
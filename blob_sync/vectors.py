@@ -0,0 +1,50 @@
+from typing import Dict, List, Tuple
+
+# Significant digits that round-trip a value of the field type, more are dropped from the upload payload
+VECTOR_TYPES = {"single": ("Edm.Single", 9), "half": ("Edm.Half", 5)}
+COMPRESSIONS = {"none": None, "scalar": "scalarQuantization", "binary": "binaryQuantization"}
+# First api version with compression, narrow types and stored, and the one where rescoring options replaced
+# rerankWithOriginalVectors
+COMPRESSION_API_VERSION = "2024-07-01"
+RESCORING_API_VERSION = "2024-11-01"
+
+
+def vector_schema(dimensions: int, vector_type: str = "single", compression: str = "none", stored: bool = True,
+                  oversampling: float = 4.0, api_version: str = "2023-11-01") -> Tuple[Dict, Dict]:
+    """Returns the chunkVector field and the vectorSearch section of the index schema.
+
+    half stores the vectors in 16 bit floats. scalar quantizes them to int8 and binary to one bit per dimension
+    for the graph, the full precision vectors are kept to rescore oversampling times the requested results.
+    Without stored the vectors are not kept for retrieval, they cannot be read back from the index."""
+    if vector_type not in VECTOR_TYPES:
+        raise ValueError(f"Unknown vector type {vector_type}, one of {', '.join(VECTOR_TYPES)}")
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown vector compression {compression}, one of {', '.join(COMPRESSIONS)}")
+    if (vector_type != "single" or COMPRESSIONS[compression] or not stored) and api_version < COMPRESSION_API_VERSION:
+        raise ValueError(f"Vector compression needs api version {COMPRESSION_API_VERSION} or later, not {api_version}")
+    field = {"name": "chunkVector", "type": f"Collection({VECTOR_TYPES[vector_type][0]})", "searchable": "true",
+             "retrievable": "true" if stored else "false", "dimensions": dimensions,
+             "vectorSearchProfile": "default-vector-profile"}
+    if not stored:
+        field["stored"] = False
+    profile = {"name": "default-vector-profile", "algorithm": "hnsw-config-1"}
+    vector_search = {"algorithms": [{"name": "hnsw-config-1", "kind": "hnsw"}], "profiles": [profile]}
+    if COMPRESSIONS[compression]:
+        method = {"name": f"{compression}-compression", "kind": COMPRESSIONS[compression]}
+        if api_version >= RESCORING_API_VERSION:
+            method["rescoringOptions"] = {"enableRescoring": True, "defaultOversampling": oversampling,
+                                          "rescoreStorageMethod": "preserveOriginals"}
+        else:
+            method["rerankWithOriginalVectors"] = True
+            method["defaultOversampling"] = oversampling
+        if compression == "scalar":
+            method["scalarQuantizationParameters"] = {"quantizedDataType": "int8"}
+        vector_search["compressions"] = [method]
+        profile["compression"] = method["name"]
+    return field, vector_search
+
+
+def encode_vector(vector: List[float], vector_type: str = "single") -> List[float]:
+    """Rounds the vector to the precision of the field type, the JSON of the upload carries no extra digits"""
+    digits = f"{{:.{VECTOR_TYPES[vector_type][1]}g}}".format
+    return [float(digits(value)) for value in vector]
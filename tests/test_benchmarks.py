@@ -0,0 +1,66 @@
+import argparse
+from datetime import datetime, timezone
+
+import pytest
+
+from benchmarks.corpus import Corpus
+from benchmarks.fakes import FakeSearchClient
+from benchmarks.run import benchmark_config, index_run, run_scenario, services
+
+
+@pytest.mark.parametrize("snapshot,search", [("off", "fake"), ("memory", "fake"), ("memory", "local")])
+def test_update_scenario_keeps_the_index_consistent(snapshot, search):
+    args = argparse.Namespace(documents=24, pages=3, churn=0.25, snapshot=snapshot, latency_scale=0,
+                              no_throttle=True, seed=3, copies=0.0, search=search)
+    result = run_scenario("update", args)
+    assert result["consistent"]
+    # 6 modified, 2 deleted and 2 added
+    assert result["documents"] == 10
+    assert result["requests"]["openai"]["requests"] > 0
+
+
+
+def test_copies_are_indexed_from_their_source():
+    config = benchmark_config(azure_search_snapshot="off")
+    corpus = Corpus(documents=30, pages=2, seed=5, copy_share=0.4)
+    fakes = services(latency_scale=0, throttle=False)
+    search_client = FakeSearchClient(fakes["search"])
+    initial = index_run(config, corpus, fakes, search_client, measure=False)
+    assert initial["consistent"]
+    # copies of the run wait for the first blob with their content
+    assert initial["dedup"]["copies"] > 0
+
+    now = datetime.now(timezone.utc)
+    for name in sorted(corpus.live())[:3]:
+        corpus.copy(name, now)
+    update = index_run(config, corpus, fakes, search_client, measure=False)
+    assert update["consistent"]
+    assert update["dedup"]["indexed_copies"] == 3
+    # chunks and vectors are read from the index, nothing is analyzed or embedded
+    assert update["requests"]["document_intelligence"]["requests"] == 0
+    assert update["requests"]["openai"]["requests"] == 0
+
+
+def test_copies_are_not_taken_from_documents_rewritten_by_the_run():
+    config = benchmark_config(azure_search_snapshot="off")
+    corpus = Corpus(documents=10, pages=2, seed=5)
+    fakes = services(latency_scale=0, throttle=False)
+    search_client = FakeSearchClient(fakes["search"])
+    index_run(config, corpus, fakes, search_client, measure=False)
+
+    def chunks(name):
+        return sorted(doc["chunk"] for doc in search_client.documents.values() if doc["document_id"] == name)
+
+    # the source is edited in the run that indexes the copy of its old content
+    now = datetime.now(timezone.utc)
+    source = corpus.blobs[sorted(corpus.live())[0]]
+    old_chunks = chunks(source.name)
+    copy = corpus.copy(source.name, now)
+    source.edits[0] = source.edits.get(0, 0) + 1
+    source.last_modified = now
+    corpus.refresh(source)
+    update = index_run(config, corpus, fakes, search_client, measure=False)
+    assert update["consistent"]
+    assert update["dedup"]["indexed_copies"] == 0
+    assert chunks(copy.name) == old_chunks
+    assert chunks(source.name) != old_chunks
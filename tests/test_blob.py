@@ -0,0 +1,70 @@
+import hashlib
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from blob_sync.blob import BlobRecord, BlobWrapper
+
+
+class FakeDownload:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.size = len(data)
+
+    def readinto(self, stream):
+        stream.write(self.data)
+        return self.size
+
+
+def wrapper(data: bytes, spool_max_bytes: int) -> BlobWrapper:
+    blob_wrapper = BlobWrapper.__new__(BlobWrapper)
+    blob_wrapper.max_concurrency = 4
+    blob_wrapper.spool_max_bytes = spool_max_bytes
+    blob_client = SimpleNamespace(download_blob=lambda max_concurrency: FakeDownload(data))
+    blob_wrapper.container = SimpleNamespace(get_blob_client=lambda name: blob_client)
+    return blob_wrapper
+
+
+@pytest.mark.parametrize("spool_max_bytes", [1024, 4])
+def test_download_cleans_up(spool_max_bytes):
+    blob = BlobRecord(name="folder/sub/file.txt")
+    with wrapper(b"hello", spool_max_bytes).download(blob) as content:
+        assert content.read_text() == "hello"
+        assert content.open().read() == b"hello"
+        path = content.path
+        assert os.path.basename(path) == "file.txt"
+        with open(path, "rb") as f:
+            assert f.read() == b"hello"
+    assert not os.path.exists(os.path.dirname(path))
+
+
+def test_small_blob_stays_in_memory():
+    with wrapper(b"hello", 1024).download(BlobRecord(name="file.txt")) as content:
+        assert content.file_path is None
+
+
+def test_prefixes_are_listed_in_parallel():
+    names = ["a/1", "a/2", "b/1", "c/1", "c/2", "c/3"]
+    blob_wrapper = BlobWrapper.__new__(BlobWrapper)
+    blob_wrapper.prefixes = ["a/", "b/", "c/"]
+    blob_wrapper.list_workers = 2
+    blob_wrapper.iter_prefix = lambda prefix: (BlobRecord(name=name) for name in names if name.startswith(prefix))
+    assert sorted(record.name for record in blob_wrapper.iter_blobs()) == names
+
+
+def test_readers_share_the_in_memory_buffer():
+    with wrapper(b"0123456789", 1024).download(BlobRecord(name="file.pdf")) as content:
+        first, second = content.open(), content.open()
+        assert first.read(4) == b"0123"
+        # readers have their own positions over the same memory
+        assert second.read() == b"0123456789"
+        assert first.read() == b"456789"
+        first.seek(-2, os.SEEK_END)
+        assert first.read() == b"89"
+        view = first.getbuffer()
+        content.buffer.getbuffer()[0] = ord("x")
+        assert view[:1].tobytes() == b"x"
+        first.close()
+        second.close()
+        assert content.content_hash() == hashlib.md5(b"x123456789").hexdigest()
@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from benchmarks.corpus import Corpus
+from benchmarks.fakes import FakeSearchClient
+from benchmarks.run import benchmark_config, index_run, services
+from blob_sync.blob import BlobRecord
+from blob_sync.budget import RunBudget, priority_key
+from blob_sync.ratelimit import RateScheduler
+
+
+def test_priority_policies():
+    now = datetime.now(timezone.utc)
+    blobs = [BlobRecord("old-small", now - timedelta(days=2), size=10),
+             BlobRecord("new-large", now, size=1000, priority=1),
+             BlobRecord("old-tagged", now - timedelta(days=3), size=500, priority=5)]
+    order = {policy: [blob.name for blob in sorted(blobs, key=priority_key(policy))]
+             for policy in ("recency", "size", "tag")}
+    assert order == {"recency": ["new-large", "old-small", "old-tagged"],
+                     "size": ["old-small", "old-tagged", "new-large"],
+                     "tag": ["old-tagged", "new-large", "old-small"]}
+
+
+def test_budget_defers_the_rest():
+    scheduler = RateScheduler()
+    budget = RunBudget(scheduler, calls=2)
+    budget.start()
+    deferred = []
+    admitted = []
+    for job in budget.admit(list(range(5)), deferred):
+        admitted.append(job)
+        scheduler.limiter("openai").acquire(tokens=10)
+    assert admitted == [0, 1] and deferred == [2, 3, 4]
+    assert budget.spent()["tokens"] == 20 and budget.exhausted() == "calls"
+    assert RunBudget(scheduler).exhausted() is None
+    stopped = []
+    assert list(RunBudget(scheduler).admit([0, 1, 2], stopped, stop=lambda: True)) == []
+    assert stopped == [0, 1, 2]
+
+
+def test_deferred_blobs_are_carried_over_by_the_journal(tmp_path):
+    config = benchmark_config(azure_search_snapshot="off", journal_path=str(tmp_path / "journal.db"),
+                              run_budget_calls=12, pipeline_download_workers=1, pipeline_analysis_workers=1,
+                              pipeline_embedding_workers=1, pipeline_queue_size=1)
+    corpus = Corpus(documents=20, pages=1, seed=2)
+    fakes = services(latency_scale=0, throttle=False)
+    search_client = FakeSearchClient(fakes["search"])
+    first = index_run(config, corpus, fakes, search_client, measure=False)
+    assert first["budget"]["exhausted"] == "calls" and first["budget"]["deferred"] > 0
+    assert first["documents"] + first["budget"]["deferred"] == 20
+    assert not first["consistent"]
+
+    rest = index_run({**config, "run_budget_calls": 0}, corpus, fakes, search_client, measure=False)
+    assert rest["documents"] == first["budget"]["deferred"]
+    assert rest["consistent"]
+
+
+def test_deferred_blobs_without_journal(tmp_path):
+    config = benchmark_config(azure_search_snapshot="off", journal_path="", run_budget_calls=12)
+    corpus = Corpus(documents=20, pages=1, seed=2)
+    fakes = services(latency_scale=0, throttle=False)
+    search_client = FakeSearchClient(fakes["search"])
+    # the lookup diff would never reach the deferred blobs
+    with pytest.raises(ValueError):
+        index_run(config, corpus, fakes, search_client, measure=False)
+
+    config = {**config, "azure_search_snapshot": "memory", "pipeline_download_workers": 1,
+              "pipeline_analysis_workers": 1, "pipeline_embedding_workers": 1, "pipeline_queue_size": 1}
+    first = index_run(config, corpus, fakes, search_client, measure=False)
+    assert first["budget"]["deferred"] > 0
+    rest = index_run({**config, "run_budget_calls": 0}, corpus, fakes, search_client, measure=False)
+    assert rest["documents"] == first["budget"]["deferred"]
+    assert rest["consistent"]
@@ -0,0 +1,68 @@
+from datetime import datetime, timezone
+
+from benchmarks.corpus import Corpus
+from benchmarks.fakes import FakeSearchClient
+from benchmarks.run import benchmark_config, build, services
+from blob_sync.azure_ai_search import create_md5_hash
+from blob_sync.blob import BlobRecord
+
+
+def indexer_with_fakes():
+    fakes = services(latency_scale=0, throttle=False)
+    search_client = FakeSearchClient(fakes["search"])
+    indexer, _ = build(benchmark_config(), Corpus(documents=1), fakes, search_client)
+    embedded = []
+    embed = indexer.batch_embedder.embed
+
+    def recorded(texts):
+        embedded.extend(texts)
+        return embed(texts)
+
+    indexer.batch_embedder.embed = recorded
+    return indexer, search_client, embedded
+
+
+def write(indexer, item, texts):
+    existing = indexer.chunk_keys([item.name])[item.name]
+    changes = indexer.prepare_changes(item, texts, existing)
+    indexer.write_changes(item.name, changes)
+    indexer.writer.flush()
+    return changes
+
+
+def keys_by_text(search_client, name):
+    return {(doc["chunk"], doc["id"]) for doc in search_client.documents.values() if doc["document_id"] == name}
+
+
+def test_only_changed_chunks_are_rewritten():
+    indexer, search_client, embedded = indexer_with_fakes()
+    item = BlobRecord("report.pdf", datetime(2024, 1, 1, tzinfo=timezone.utc))
+
+    changes = write(indexer, item, ["title", "alpha", "beta", "alpha"])
+    first = keys_by_text(search_client, item.name)
+    # repeated identical chunks get keys of their own
+    assert len({key for _, key in first}) == 4
+    assert changes["orphans"] == [] and changes["unchanged"] == 0
+    assert embedded == ["title", "alpha", "beta", "alpha"]
+
+    # an edit in front shifts the positions, the content keys of the other chunks stay the same
+    embedded.clear()
+    changes = write(indexer, item, ["new title", "beta", "alpha", "gamma"])
+    second = keys_by_text(search_client, item.name)
+    assert {key for text, key in second if text in ("alpha", "beta")} <= {key for _, key in first}
+    # the first chunk is rewritten under its positional key, only the new text is embedded besides it
+    assert ("new title", create_md5_hash(f"{item.name}_0")) in second
+    assert [doc["chunk"] for doc in changes["changed"]] == ["new title", "gamma"]
+    assert embedded == ["new title", "gamma"]
+    assert changes["unchanged"] == 2
+    # the second "alpha" is gone, its key is deleted from the index
+    orphan = first - second - {("title", create_md5_hash(f"{item.name}_0"))}
+    assert [key for _, key in orphan] == changes["orphans"]
+    assert {text for text, _ in orphan} == {"alpha"}
+    assert sorted(text for text, _ in second) == ["alpha", "beta", "gamma", "new title"]
+
+    # unchanged content only rewrites the first chunk, for its dates
+    embedded.clear()
+    changes = write(indexer, item, ["new title", "beta", "alpha", "gamma"])
+    assert embedded == ["new title"] and changes["orphans"] == [] and changes["unchanged"] == 3
+    assert keys_by_text(search_client, item.name) == second
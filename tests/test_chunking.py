@@ -0,0 +1,36 @@
+from blob_sync.chunking import Chunker
+
+
+def words(count: int, word: str = "word") -> str:
+    return " ".join(f"{word}{i}" for i in range(count))
+
+
+def count_words(text: str) -> int:
+    return len(text.split())
+
+
+def test_chunks_are_offsets_into_the_text():
+    text = "\n\n".join(words(30, f"p{paragraph}_") for paragraph in range(10))
+    chunks = list(Chunker(max_tokens=100, overlap_tokens=30, count_tokens=count_words).split(text))
+    assert len(chunks) > 1
+    for chunk in chunks:
+        assert chunk.text == text[chunk.start:chunk.end]
+        assert chunk.tokens <= 100
+    # consecutive chunks share the last paragraph
+    assert chunks[1].start < chunks[0].end
+    assert chunks[-1].end == len(text)
+
+
+def test_long_paragraph_is_split_at_sentences_then_words():
+    text = ". ".join(words(40) for _ in range(5)) + "\n\n" + words(250, "long")
+    chunks = list(Chunker(max_tokens=60, overlap_tokens=0, count_tokens=count_words).split(text))
+    assert all(chunk.tokens <= 60 for chunk in chunks)
+    assert " ".join(chunk.text for chunk in chunks).split() == text.split()
+
+
+def test_markdown_strategy_splits_at_headings_and_pages():
+    text = "# Title\n\nintro\n\n## Part\n\nbody one\n\nbody two\n<!-- PageBreak -->\nnext page\n\n#### Deep\n\nmore"
+    chunks = list(Chunker("markdown", max_tokens=100, count_tokens=count_words).split(text))
+    assert [chunk.text for chunk in chunks] == ["# Title\n\nintro", "## Part\n\nbody one\n\nbody two",
+                                                "next page\n\n#### Deep\n\nmore"]
+    assert [chunk.page for chunk in chunks] == [1, 1, 2]
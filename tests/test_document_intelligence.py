@@ -0,0 +1,48 @@
+from blob_sync.azure_document_intelligence import AzureDocumentIntelligenceMediaHandler, estimate_pdf_pages
+from blob_sync.blob import BlobContent
+from blob_sync.cache import LocalCache
+
+
+def content(name: str, data: bytes) -> BlobContent:
+    blob_content = BlobContent(name)
+    blob_content.spool(len(data), 1024).write(data)
+    return blob_content
+
+
+def test_extraction_is_cached_by_content(tmp_path, monkeypatch):
+    cache = LocalCache(str(tmp_path / "di.sqlite"), max_bytes=1024 * 1024)
+    handler = AzureDocumentIntelligenceMediaHandler("https://example", "key", cache=cache)
+    analyzed = []
+    monkeypatch.setattr(handler, "analyze", lambda source: analyzed.append(source.name) or "# Title\n\nSome text")
+
+    assert [chunk.text for chunk in handler.handle(content("a.pdf", b"%PDF-1"))] == ["# Title\n\nSome text"]
+    # same bytes under another name
+    assert [chunk.text for chunk in handler.handle(content("folder/copy.pdf", b"%PDF-1"))] == \
+           ["# Title\n\nSome text"]
+    handler.handle(content("b.pdf", b"%PDF-2"))
+    assert analyzed == ["a.pdf", "b.pdf"]
+    assert cache.stats["hits"] == 1
+
+
+def test_estimate_pdf_pages():
+    data = b"%PDF-1.7\n1 0 obj << /Type /Pages /Kids [2 0 R 3 0 R 4 0 R] /Count 3 >>\n" + \
+           b"".join(b"%d 0 obj << /Type /Page /Parent 1 0 R >>\n" % i for i in range(2, 5))
+    assert estimate_pdf_pages(content("big.pdf", data)) == 3
+    assert estimate_pdf_pages(content("compressed.pdf", b"%PDF-1.7 /ObjStm")) == 0
+
+
+def test_large_pdf_is_analyzed_in_page_ranges(monkeypatch):
+    handler = AzureDocumentIntelligenceMediaHandler("https://example", "key", page_range_size=10)
+    total_pages = 25
+
+    def analyze_pages(source, first, last):
+        pages = list(range(first, min(last, total_pages) + 1))
+        return "\n<!-- PageBreak -->\n".join(f"page {page}" for page in pages), len(pages)
+
+    monkeypatch.setattr(handler, "analyze_pages", analyze_pages)
+    # the estimate is low, analysis continues while the ranges come back full
+    markdown = handler.analyze_ranges(content("big.pdf", b""), 12)
+    assert [line for line in markdown.split("\n") if line.startswith("page")] == \
+           [f"page {page}" for page in range(1, total_pages + 1)]
+    assert markdown.count("<!-- PageBreak -->") == total_pages - 1
+
@@ -0,0 +1,68 @@
+import asyncio
+
+from blob_sync.cache import LocalCache
+from blob_sync.embedding import BatchedEmbedder
+
+
+class FakeEmbedder:
+    def __init__(self):
+        self.requests = []
+
+    def embed_documents(self, texts, chunk_size=0):
+        self.requests.append(list(texts))
+        return [[float(len(text))] for text in texts]
+
+    async def aembed_documents(self, texts, chunk_size=0):
+        return self.embed_documents(texts, chunk_size)
+
+
+def test_batches_respect_input_count():
+    embedder = BatchedEmbedder(FakeEmbedder(), "text-embedding-ada-002", batch_size=3, batch_tokens=100000)
+    assert embedder.batches(["a"] * 7) == [[0, 1, 2], [3, 4, 5], [6]]
+
+
+def test_batches_respect_token_limit():
+    embedder = BatchedEmbedder(FakeEmbedder(), "text-embedding-ada-002", batch_size=100, batch_tokens=10)
+    embedder.count_tokens = len
+    assert embedder.batches(["aaaa", "aaaa", "aaaa", "a" * 20, "a"]) == [[0, 1], [2], [3], [4]]
+
+
+def test_embed_keeps_order():
+    fake = FakeEmbedder()
+    embedder = BatchedEmbedder(fake, "text-embedding-ada-002", batch_size=2, concurrency=3)
+    texts = ["a" * i for i in range(1, 8)]
+    assert embedder.embed(texts) == [[float(i)] for i in range(1, 8)]
+    assert len(fake.requests) == 4
+
+
+def test_async_embed_keeps_order(tmp_path):
+    fake = FakeEmbedder()
+    cache = LocalCache(str(tmp_path / "embeddings.sqlite"), max_bytes=1024 * 1024)
+    embedder = BatchedEmbedder(fake, "text-embedding-ada-002", batch_size=2, concurrency=3, cache=cache)
+    texts = ["a" * i for i in range(1, 8)]
+    assert asyncio.run(embedder.aembed(texts)) == [[float(i)] for i in range(1, 8)]
+    assert len(fake.requests) == 4
+    assert asyncio.run(embedder.aembed(texts[:2])) == [[1.0], [2.0]]
+    assert len(fake.requests) == 4
+
+
+def test_cache_skips_embedded_texts(tmp_path):
+    cache = LocalCache(str(tmp_path / "embeddings.sqlite"), max_bytes=1024 * 1024)
+    fake = FakeEmbedder()
+    embedder = BatchedEmbedder(fake, "text-embedding-ada-002", cache=cache)
+    assert embedder.embed(["a", "bb", "a"]) == [[1.0], [2.0], [1.0]]
+    assert fake.requests == [["a", "bb"]]
+    assert embedder.embed(["bb", "ccc"]) == [[2.0], [3.0]]
+    assert fake.requests[1:] == [["ccc"]]
+    assert cache.stats == {"hits": 1, "misses": 3, "evictions": 0}
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = LocalCache(str(tmp_path / "cache.sqlite"), max_bytes=100)
+    cache.put("old", b"x" * 40)
+    cache.put("used", b"x" * 40)
+    cache.get("used")
+    cache.put("new", b"x" * 40)
+    assert cache.get("old") is None
+    assert cache.get("used") is not None
+    assert cache.get("new") is not None
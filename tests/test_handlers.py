@@ -0,0 +1,66 @@
+import subprocess
+import sys
+
+import pytest
+
+from blob_sync.blob import BlobContent
+from blob_sync.handlers import MediaHandlerRegistry, TextMediaHandler, html_to_text, parse_routes
+
+CONFIG = {"chunking_strategy": "markdown", "chunk_max_tokens": 500, "chunk_overlap_tokens": 0,
+          "azure_search_embedding_model": "text-embedding-ada-002"}
+
+
+def content(name: str, data: bytes, content_type: str = None) -> BlobContent:
+    blob_content = BlobContent(name, content_type=content_type)
+    blob_content.spool(len(data), 1024).write(data)
+    return blob_content
+
+
+class EchoHandler:
+    created = 0
+
+    def __init__(self, config, cache=None):
+        EchoHandler.created += 1
+
+    def handle(self, source):
+        return [source.name]
+
+
+def test_routes_by_content_type_then_extension():
+    registry = MediaHandlerRegistry(CONFIG, routes=parse_routes("image/png=echo, .EML=echo"), default="pdf")
+    assert registry.route(content("a.txt", b"", "application/octet-stream")) == "text"
+    assert registry.route(content("a.bin", b"", "text/html; charset=utf-8")) == "text"
+    assert registry.route(content("scan", b"", "image/png")) == "echo"
+    assert registry.route(content("mail.eml", b"")) == "echo"
+    assert registry.route(content("a.pdf", b"", "application/pdf")) == "pdf"
+    with pytest.raises(ValueError):
+        parse_routes("image/png")
+
+
+def test_handlers_are_created_once_from_import_strings():
+    EchoHandler.created = 0
+    registry = MediaHandlerRegistry(CONFIG, default=f"{__name__}:EchoHandler")
+    assert registry.handle(content("a.pdf", b"%PDF")) == ["a.pdf"]
+    assert registry.handle(content("b.pdf", b"%PDF")) == ["b.pdf"]
+    assert EchoHandler.created == 1
+    with pytest.raises(ValueError):
+        registry.handler("no-such-handler")
+
+
+def test_text_fast_path_skips_document_intelligence():
+    registry = MediaHandlerRegistry(CONFIG)
+    page = b"<html><head><title>x</title><script>var a = 1;</script></head><body><h1>Intro</h1><p>Hello &amp; " \
+           b"welcome</p><h2>Usage</h2><ul><li>one</li><li>two</li></ul></body></html>"
+    chunks = registry.handle(content("docs/index.html", page, "text/html"))
+    assert [chunk.text for chunk in chunks] == ["# Intro\n\nHello & welcome", "## Usage\n\none\n\ntwo"]
+    assert isinstance(registry.handlers["text"], TextMediaHandler)
+    assert "document_intelligence" not in registry.handlers
+    assert html_to_text("a<br>b") == "a\nb"
+
+
+def test_sync_imports_no_sdk_until_there_is_work():
+    loaded = subprocess.run([sys.executable, "-c", "import sys, blob_sync.sync\n"
+                             "print(' '.join(m for m in ('langchain_core', 'openai', 'azure.ai.documentintelligence', "
+                             "'azure.monitor.opentelemetry.exporter', 'numpy') if m in sys.modules))"],
+                            capture_output=True, text=True, check=True).stdout
+    assert loaded.strip() == ""
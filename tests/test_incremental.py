@@ -0,0 +1,139 @@
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import BlobProperties
+
+from benchmarks.corpus import Corpus
+from benchmarks.fakes import FakeSearchClient
+from benchmarks.run import benchmark_config, build, services
+from blob_sync.incremental import ChangeFeedSource
+from blob_sync.sync import sync
+
+
+class FakeChangeFeed:
+    """Stand-in for ChangeFeedClient, the continuation token is the position in the list of events"""
+
+    def __init__(self, events):
+        self.events = events
+
+    def list_changes(self, start_time=None, results_per_page=None):
+        feed = self
+
+        class Pages:
+            def by_page(self, continuation_token=None):
+                position = int(continuation_token) if continuation_token else 0
+                if start_time and not continuation_token:
+                    position = len([e for e in feed.events if e["eventTime"] < start_time.isoformat()])
+                return Paged([feed.events[position:]], continuation_token=str(len(feed.events)))
+
+        return Pages()
+
+
+class Paged(list):
+    def __init__(self, pages, continuation_token):
+        super().__init__(pages)
+        self.continuation_token = continuation_token
+
+
+class FakeContainer:
+    def __init__(self, blobs):
+        self.blobs = blobs
+
+    def get_blob_client(self, name):
+        def get_blob_properties():
+            if name not in self.blobs:
+                raise ResourceNotFoundError("not found")
+            return BlobProperties(name=name, **{"Last-Modified": self.blobs[name]})
+
+        return SimpleNamespace(get_blob_properties=get_blob_properties)
+
+
+def event(event_type, name, minute, container="files"):
+    return {"eventType": event_type,
+            "eventTime": datetime(2024, 1, 1, 0, minute, tzinfo=timezone.utc).isoformat(),
+            "subject": f"/blobServices/default/containers/{container}/blobs/{name}"}
+
+
+def source(tmp_path, events, blobs):
+    blob_client = SimpleNamespace(container_name="files", container=FakeContainer(blobs), priority_metadata=None)
+    return ChangeFeedSource(FakeChangeFeed(events), blob_client, str(tmp_path / "state.json"),
+                            max_age=timedelta(days=100000))
+
+
+def test_first_run_needs_full_listing(tmp_path):
+    feed = source(tmp_path, [], {})
+    assert feed.changes() is None
+    feed.start()
+    feed.commit()
+    assert source(tmp_path, [], {}).changes() == {"upsert": [], "remove": []}
+
+
+def test_changes_since_cursor(tmp_path):
+    now = datetime(2024, 1, 1, 1, tzinfo=timezone.utc)
+    events = [event("BlobCreated", "old.pdf", 1)]
+    feed = source(tmp_path, events, {"old.pdf": now})
+    feed.next_state = {"cursor": "1", "updated": datetime.now(timezone.utc).isoformat()}
+    feed.commit()
+
+    events += [event("BlobCreated", "new.pdf", 2),
+               event("BlobCreated", "folder/a.pdf", 3),
+               event("BlobDeleted", "folder/a.pdf", 4),
+               event("BlobCreated", "gone.pdf", 5),
+               event("BlobCreated", "other.pdf", 6, container="images")]
+    feed = source(tmp_path, events, {"old.pdf": now, "new.pdf": now})
+    changeset = feed.changes()
+    assert [record.name for record in changeset["upsert"]] == ["new.pdf"]
+    # gone.pdf was created but deleted before the run
+    assert sorted(record.name for record in changeset["remove"]) == ["folder/a.pdf", "gone.pdf"]
+    feed.commit()
+    assert feed.state["cursor"] == "6"
+
+
+def test_stale_cursor_needs_full_listing(tmp_path):
+    feed = source(tmp_path, [], {})
+    feed.next_state = {"cursor": "0", "updated": (datetime.now(timezone.utc) - timedelta(days=30)).isoformat()}
+    feed.commit()
+    feed = source(tmp_path, [], {})
+    feed.max_age = timedelta(days=7)
+    assert feed.changes() is None
+
+
+def test_position_is_kept_when_an_item_fails(tmp_path):
+    config = benchmark_config(incremental_mode="changefeed", azure_search_snapshot="off")
+    corpus = Corpus(documents=5, pages=1, seed=3)
+    fakes = services(latency_scale=0, throttle=False)
+    search_client = FakeSearchClient(fakes["search"])
+    # the oldest blob fails, the lookups must not stop at the newer ones indexed before it
+    names = sorted(corpus.live(), key=lambda name: corpus.live()[name].last_modified)
+    events = [event("BlobCreated", name, minute, container=config["container_name"])
+              for minute, name in enumerate(names)]
+    state_path = str(tmp_path / "state.json")
+
+    def run(failing=None):
+        indexer, blob_client = build(config, corpus, fakes, search_client)
+        indexer.select_index = indexer.create_or_update_index = lambda: None
+        handle = blob_client.media_handler.handle
+
+        def handle_or_fail(source):
+            if getattr(source, "name", source) == failing:
+                raise RuntimeError("analysis failed")
+            return handle(source)
+
+        blob_client.media_handler.handle = handle_or_fail
+        feed = ChangeFeedSource(FakeChangeFeed(events), blob_client, state_path, max_age=timedelta(days=100000))
+        return feed, sync(config, blob_client, indexer, change_feed=feed)
+
+    feed = source(tmp_path, [], {})
+    feed.next_state = {"cursor": "0", "updated": datetime.now(timezone.utc).isoformat()}
+    feed.commit()
+
+    feed, diagnostics = run(failing=names[0])
+    assert diagnostics["incomplete"] == 1
+    assert feed.load_state()["cursor"] == "0"
+
+    feed, diagnostics = run()
+    assert diagnostics["incomplete"] == 0 and diagnostics["counts"]["create"] == 1
+    assert feed.load_state()["cursor"] == str(len(events))
+    indexed = {doc["document_id"] for doc in search_client.search(search_text="*", select=["document_id"])}
+    assert indexed == set(names)
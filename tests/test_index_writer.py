@@ -0,0 +1,101 @@
+import json
+from types import SimpleNamespace
+
+from blob_sync.index_writer import IndexWriter
+
+
+class FakeSearchClient:
+    """Fails the given keys with the given status code the first `times` times they are sent"""
+
+    def __init__(self, failures=None, times=1):
+        self.failures = failures or {}
+        self.times = times
+        self.batches = []
+
+    def index_documents(self, batch):
+        keys = [action_document(action)["id"] for action in batch.actions]
+        self.batches.append(keys)
+        results = []
+        for key in keys:
+            attempts = sum(batch.count(key) for batch in self.batches)
+            status = self.failures.get(key) if attempts <= self.times else None
+            results.append(SimpleNamespace(key=key, succeeded=status is None, status_code=status or 200,
+                                           error_message="boom" if status else None))
+        return results
+
+
+def action_document(action):
+    # the shape of IndexAction differs between the sdk versions
+    return getattr(action, "additional_properties", None) or action.as_dict()
+
+
+def docs(count, prefix="doc"):
+    return [{"id": f"{prefix}{i}", "chunk": "x" * 100} for i in range(count)]
+
+
+def test_flushes_by_document_count():
+    client = FakeSearchClient()
+    writer = IndexWriter(client, max_documents=10)
+    writer.upload(docs(25))
+    writer.flush()
+    assert [len(batch) for batch in client.batches] == [10, 10, 5]
+    assert writer.stats["documents"] == 25
+
+
+def test_flushes_by_payload_size():
+    client = FakeSearchClient()
+    writer = IndexWriter(client, max_bytes=500)
+    writer.upload(docs(10))
+    writer.flush()
+    assert all(len(batch) < 10 for batch in client.batches)
+    assert sum(len(batch) for batch in client.batches) == 10
+
+
+def test_batches_stay_under_max_bytes():
+    client = FakeSearchClient()
+    sent = []
+    index_documents = client.index_documents
+
+    def measure(batch):
+        sent.append(len(json.dumps({"value": [action_document(action) for action in batch.actions]})))
+        return index_documents(batch)
+
+    client.index_documents = measure
+    writer = IndexWriter(client, max_bytes=2000)
+    for i in range(40):
+        writer.upload([{"id": f"doc{i}", "chunk": "x" * (37 * (i % 5)), "chunkVector": [0.125] * (i % 7)}])
+        writer.delete([f"old{i}"])
+    writer.flush()
+    assert len(sent) > 1
+    assert all(size <= 2000 for size in sent)
+    # batches are filled, not flushed early
+    assert all(size > 2000 - 300 for size in sent[:-1])
+    assert writer.stats["documents"] == 80
+
+
+def test_failed_deletes_name_their_document():
+    client = FakeSearchClient(failures={"chunk1": 400})
+    reported = []
+    writer = IndexWriter(client, backoff=0, on_flush=reported.extend)
+    writer.delete(["chunk0", "chunk1"], document_id="a.pdf")
+    writer.delete(["chunk2"])
+    writer.flush()
+    assert reported == [{"id": "chunk1", "document_id": "a.pdf"}]
+
+
+def test_retries_only_failed_keys():
+    client = FakeSearchClient(failures={"doc1": 503, "doc2": 400})
+    writer = IndexWriter(client, backoff=0)
+    writer.upload(docs(3))
+    writer.flush()
+    assert client.batches == [["doc0", "doc1", "doc2"], ["doc1"]]
+    assert writer.stats == {"requests": 2, "documents": 3 - 1, "retries": 1, "failed": 1}
+
+
+def test_same_key_is_sent_once():
+    client = FakeSearchClient()
+    writer = IndexWriter(client)
+    writer.upload(docs(2))
+    writer.upload(docs(2))
+    writer.flush()
+    assert client.batches == [["doc0", "doc1"]]
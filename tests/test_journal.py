@@ -0,0 +1,92 @@
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from benchmarks.corpus import Corpus
+from benchmarks.fakes import FakeSearchClient
+from benchmarks.run import benchmark_config, index_run, services
+from blob_sync.blob import BlobRecord
+from blob_sync.journal import RunJournal
+
+
+def blob(name, etag="1", deleted=False):
+    return BlobRecord(name=name, last_modified=datetime(2024, 1, 2, tzinfo=timezone.utc), etag=etag,
+                      content_md5=b"\x01\x02", deleted=deleted)
+
+
+def test_resume(tmp_path):
+    path = str(tmp_path / "journal.sqlite")
+    journal = RunJournal(path)
+    create, update, remove = journal.start([blob("a.pdf"), blob("b.pdf")], [blob("c.pdf")],
+                                           [blob("d.pdf", etag=None, deleted=True)])
+    assert journal.stats == {"resumed": 0, "skipped": 0}
+    journal.mark(["a.pdf"], "uploaded")
+    journal.mark(["b.pdf"], "embedded")
+    journal.mark(["d.pdf"], "removed")
+    # the run dies here
+    journal.close()
+
+    journal = RunJournal(path)
+    # c.pdf was not listed again, a.pdf changed since it was uploaded
+    create, update, remove = journal.start([blob("a.pdf", etag="2"), blob("e.pdf")], [],
+                                           [blob("d.pdf", etag=None, deleted=True)])
+    assert journal.stats == {"resumed": 2, "skipped": 1}
+    assert [b.name for b in create] == ["a.pdf", "e.pdf"]
+    assert [b.name for b in update] == ["b.pdf", "c.pdf"]
+    assert update[1] == blob("c.pdf")
+    assert remove == []
+
+    journal.mark(["a.pdf", "b.pdf", "c.pdf"], "uploaded")
+    journal.finish()
+    create, update, remove = journal.start([], [], [])
+    # e.pdf never made it to the index
+    assert [b.name for b in update] == ["e.pdf"]
+    journal.close()
+
+
+def test_resume_only_owned_items(tmp_path):
+    journal = RunJournal(str(tmp_path / "journal.sqlite"))
+    journal.start([blob("shard0/a.pdf"), blob("shard1/b.pdf")], [], [])
+    # both shards died before uploading, the next run of shard 0 does not take over the item of shard 1
+    create, update, remove = journal.start([], [], [], owns=lambda name: name.startswith("shard0/"))
+    assert [b.name for b in update] == ["shard0/a.pdf"] and journal.stats["resumed"] == 1
+    create, update, remove = journal.start([], [], [], owns=lambda name: name.startswith("shard1/"))
+    assert [b.name for b in update] == ["shard1/b.pdf"]
+    journal.close()
+
+
+def test_failed_writes_stay_unfinished(tmp_path):
+    config = benchmark_config(azure_search_snapshot="off", journal_path=str(tmp_path / "journal.sqlite"),
+                              azure_search_upload_batch_size=2, pipeline_download_workers=1,
+                              pipeline_analysis_workers=1, pipeline_embedding_workers=1)
+    corpus = Corpus(documents=6, pages=2, seed=4)
+    fakes = services(latency_scale=0, throttle=False)
+    search_client = FakeSearchClient(fakes["search"])
+    index_run(config, corpus, fakes, search_client, measure=False)
+    names = sorted(corpus.live())
+    updated, removed = names[0], names[1]
+    removed_keys = {key for key, doc in search_client.documents.items() if doc["document_id"] == removed}
+    index_documents = search_client.index_documents
+
+    def failing(batch, **kwargs):
+        # the first chunk of the updated blob and the chunks of the removed one are rejected
+        rejected = {action.as_dict()["id"] for action in batch.actions
+                    if action.as_dict()["id"] in removed_keys or
+                    (action.as_dict().get("document_id") == updated and action.as_dict().get("content_md5"))}
+        batch.actions = [action for action in batch.actions if action.as_dict()["id"] not in rejected]
+        results = index_documents(batch, **kwargs)
+        return results + [SimpleNamespace(key=key, succeeded=False, status_code=400, error_message="rejected")
+                          for key in rejected]
+
+    search_client.index_documents = failing
+    now = datetime.now(timezone.utc)
+    corpus.blobs[updated].edits[0] = 1
+    corpus.blobs[updated].last_modified = now
+    corpus.refresh(corpus.blobs[updated])
+    corpus.blobs[removed].deleted = True
+    corpus.blobs[removed].last_modified = now
+    # the updated blob's chunks are split over several flushes, the later ones succeed
+    index_run(config, corpus, fakes, search_client, measure=False)
+
+    journal = RunJournal(config["journal_path"])
+    assert sorted(name for name, in journal.db.execute("SELECT name FROM items")) == sorted([updated, removed])
+    journal.close()
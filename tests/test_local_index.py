@@ -0,0 +1,82 @@
+import asyncio
+
+import numpy as np
+import pytest
+from azure.core.exceptions import ResourceNotFoundError
+from azure.search.documents import IndexDocumentsBatch
+from azure.search.documents.models import VectorizedQuery
+
+from blob_sync.local_index import AsyncLocalSearchClient, LocalSearchClient, LocalVectorStore
+
+
+def chunk(key: str, document_id: str, vector) -> dict:
+    return {"id": key, "document_id": document_id, "chunk": f"text of {key}", "chunkVector": list(vector)}
+
+
+def upload(client: LocalSearchClient, docs=(), deletes=()):
+    batch = IndexDocumentsBatch()
+    batch.add_merge_or_upload_actions(list(docs))
+    batch.add_delete_actions([{"id": key} for key in deletes])
+    return client.index_documents(batch)
+
+
+def test_documents_and_filters(tmp_path):
+    client = LocalSearchClient(LocalVectorStore(str(tmp_path / "index"), dimensions=3))
+    results = upload(client, [chunk("a0", "a.pdf", [1, 0, 0]), chunk("a1", "a.pdf", [0, 1, 0]),
+                              chunk("b0", "it's.md", [0, 0, 1])])
+    assert all(result.succeeded for result in results)
+    upload(client, [{"id": "a0", "last_indexed_date": "2024-01-01T00:00:00.000000Z"}])
+
+    assert client.get_document("a0", selected_fields=["chunk", "last_indexed_date"]) == \
+           {"chunk": "text of a0", "last_indexed_date": "2024-01-01T00:00:00.000000Z"}
+    with pytest.raises(ResourceNotFoundError):
+        client.get_document("missing")
+    found = client.search(select=["id"], filter="search.in(document_id, 'a.pdf|x', '|')")
+    assert sorted(doc["id"] for doc in found) == ["a0", "a1"]
+    found = client.search(select=["id"], filter="document_id eq 'it''s.md' or document_id eq 'x'")
+    assert [doc["id"] for doc in found] == ["b0"]
+    assert [doc["id"] for doc in client.search(select=["id"], filter="id gt 'a0'", order_by=["id asc"], top=1)] == \
+           ["a1"]
+    with pytest.raises(ValueError):
+        list(client.search(filter="chunk eq 'x'"))
+
+
+def test_top_k_and_persistence(tmp_path):
+    rng = np.random.default_rng(1)
+    vectors = rng.normal(size=(3000, 8)).astype(np.float32)
+    store = LocalVectorStore(str(tmp_path / "index"), dimensions=8)
+    client = LocalSearchClient(store)
+    upload(client, [chunk(f"c{i}", f"doc{i % 10}", vector) for i, vector in enumerate(vectors)])
+    upload(client, deletes=["c1", "c2"])
+    store.close()
+
+    client = LocalSearchClient(LocalVectorStore(str(tmp_path / "index"), dimensions=8))
+    query = vectors[1] + vectors[7] * 0.1
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    expected = [f"c{i}" for i in np.argsort(-(normalized @ (query / np.linalg.norm(query)))) if i not in (1, 2)][:5]
+    found = list(client.search(select=["id"],
+                               vector_queries=[VectorizedQuery(vector=query.tolist(), k_nearest_neighbors=5,
+                                                               fields="chunkVector")]))
+    assert [doc["id"] for doc in found] == expected
+    # deleted rows are reused
+    upload(client, [chunk("new", "doc0", vectors[0])])
+    assert client.store.db.execute("SELECT value FROM settings WHERE name = 'rows'").fetchone()[0] == "3000"
+
+    with pytest.raises(ValueError):
+        LocalVectorStore(str(tmp_path / "index"), dimensions=16).open()
+
+
+def test_async_client(tmp_path):
+    client = LocalSearchClient(LocalVectorStore(str(tmp_path / "index"), dimensions=3))
+
+    async def run():
+        async with AsyncLocalSearchClient(client) as aio:
+            batch = IndexDocumentsBatch()
+            batch.add_merge_or_upload_actions([chunk("a0", "a.pdf", [1, 0, 0]), chunk("b0", "b.pdf", [0, 1, 0])])
+            assert all(result.succeeded for result in await aio.index_documents(batch))
+            found = [doc["id"] async for doc in await aio.search(select=["id"], filter="document_id eq 'b.pdf'")]
+            return found, await aio.get_document("a0", selected_fields=["chunk"])
+
+    assert asyncio.run(run()) == (["b0"], {"chunk": "text of a0"})
+    # the store stays open for the indexer
+    assert client.get_document("b0", selected_fields=["document_id"]) == {"document_id": "b.pdf"}
@@ -0,0 +1,46 @@
+import pytest
+from opentelemetry import trace
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from opentelemetry.trace import StatusCode
+
+from blob_sync.otel import Telemetry
+
+exporter = InMemorySpanExporter()
+
+
+@pytest.fixture
+def spans():
+    if not isinstance(trace.get_tracer_provider(), TracerProvider):
+        provider = TracerProvider()
+        provider.add_span_processor(SimpleSpanProcessor(exporter))
+        trace.set_tracer_provider(provider)
+    exporter.clear()
+    yield exporter
+
+
+def test_blob_trace(spans):
+    telemetry = Telemetry()
+    blob = telemetry.start_blob("a.pdf", "create")
+    with telemetry.span("download", parent=blob):
+        with telemetry.span("chunk"):
+            pass
+    with pytest.raises(ValueError):
+        with telemetry.span("analyze", parent=blob):
+            raise ValueError("broken pdf")
+    telemetry.end_blob(blob, ValueError("broken pdf"))
+    with telemetry.span("upload", root=True, documents=3):
+        pass
+    telemetry.payload("upload", 1000)
+
+    finished = {span.name: span for span in spans.get_finished_spans()}
+    assert finished["download"].parent.span_id == finished["blob"].context.span_id
+    assert finished["chunk"].parent.span_id == finished["download"].context.span_id
+    assert finished["analyze"].status.status_code == StatusCode.ERROR
+    assert finished["blob"].status.status_code == StatusCode.ERROR
+    assert finished["upload"].parent is None
+    assert finished["upload"].context.trace_id != finished["blob"].context.trace_id
+    assert telemetry.summary["stages"]["download"]["count"] == 1
+    assert telemetry.summary["stages"]["analyze"]["count"] == 1
+    assert telemetry.summary["bytes"] == {"upload": 1000}
@@ -0,0 +1,45 @@
+import threading
+import time
+
+from blob_sync.pipeline import Pipeline
+
+
+def test_runs_items_through_all_stages():
+    pipeline = Pipeline([("double", lambda x: x * 2, 3), ("inc", lambda x: x + 1, 2)], queue_size=2)
+    results = []
+    pipeline.run(range(20), results.append)
+    assert sorted(results) == [x * 2 + 1 for x in range(20)]
+    assert pipeline.stats["double"]["items"] == 20
+    assert pipeline.stats["inc"]["items"] == 20
+
+
+def test_failed_items_are_dropped():
+    def fail_odd(x):
+        if x % 2:
+            raise ValueError("odd")
+        return x
+
+    pipeline = Pipeline([("even", fail_odd, 2)])
+    results = []
+    pipeline.run(range(10), results.append)
+    assert sorted(results) == [0, 2, 4, 6, 8]
+    assert pipeline.stats["even"]["errors"] == 5
+
+
+def test_stage_workers_run_concurrently():
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def slow(x):
+        with lock:
+            running.append(x)
+            peak.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.remove(x)
+        return x
+
+    pipeline = Pipeline([("slow", slow, 4)])
+    pipeline.run(range(8), lambda x: None)
+    assert max(peak) > 1
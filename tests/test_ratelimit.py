@@ -0,0 +1,95 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+from azure.core.exceptions import HttpResponseError
+
+from blob_sync.ratelimit import RateLimiter, TokenBucket, retry_after
+
+
+def throttled(headers=None):
+    error = HttpResponseError("Too many requests")
+    error.status_code = 429
+    error.response = SimpleNamespace(status_code=429, headers=headers or {})
+    return error
+
+
+def test_retry_after_header():
+    assert retry_after(throttled({"retry-after": "2"})) == 2
+    assert retry_after(throttled({"retry-after-ms": "250", "retry-after": "1"})) == 0.25
+    assert retry_after(throttled()) is None
+
+
+def test_throttled_call_is_retried_and_halves_concurrency():
+    limiter = RateLimiter("test", max_concurrency=8, backoff=0.01)
+    responses = [throttled({"retry-after": "0.05"}), "ok"]
+
+    def call():
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    start = time.monotonic()
+    assert limiter.call(call) == "ok"
+    assert time.monotonic() - start >= 0.05
+    assert limiter.stats["throttled"] == 1
+    assert limiter.stats["retries"] == 1
+    assert limiter.limit < 8
+
+
+def test_other_errors_are_not_retried():
+    limiter = RateLimiter("test")
+    calls = []
+
+    def call():
+        calls.append(1)
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        limiter.call(call)
+    assert len(calls) == 1
+
+
+def test_concurrency_limit():
+    limiter = RateLimiter("test", max_concurrency=2)
+    active = []
+    peak = []
+
+    def call():
+        active.append(1)
+        peak.append(len(active))
+        time.sleep(0.02)
+        active.pop()
+
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        list(executor.map(lambda _: limiter.call(call), range(12)))
+    assert max(peak) <= 2
+    assert limiter.stats["calls"] == 12
+
+
+def test_token_bucket():
+    bucket = TokenBucket(per_minute=600)
+    assert bucket.wait_time(600) == 0
+    bucket.take(600)
+    # 10 tokens per second
+    assert bucket.wait_time(10) == pytest.approx(1, abs=0.05)
+    # larger than the bucket, waits for a full one
+    assert bucket.wait_time(6000) == pytest.approx(60, abs=0.1)
+
+
+def test_async_call_is_retried():
+    limiter = RateLimiter("test", max_concurrency=2, backoff=0.01)
+    responses = [throttled({"retry-after": "0.01"}), "ok"]
+
+    async def call():
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    assert asyncio.run(limiter.acall(call)) == "ok"
+    assert limiter.stats["throttled"] == 1
+    assert limiter.stats["retries"] == 1
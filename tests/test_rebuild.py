@@ -0,0 +1,86 @@
+import os
+from unittest import mock
+
+import pytest
+
+from benchmarks.corpus import Corpus
+from benchmarks.fakes import FakeEmbeddings, FakeSearchClient
+from benchmarks.run import benchmark_config, build, services
+from blob_sync.local_index import LocalIndexer
+
+
+def run(config, blob_client, fakes, **overrides) -> LocalIndexer:
+    with mock.patch.dict(os.environ, {"OPENAI_API_KEY": "test"}):
+        indexer = LocalIndexer({**config, **overrides})
+        indexer.batch_embedder.embedder = FakeEmbeddings(fakes["openai"])
+    indexer.blob_client = blob_client
+    indexer.rebuild_validation_attempts = 1
+    indexer.select_index()
+    indexer.create_or_update_index()
+    if indexer.rebuild == "rollback":
+        return indexer.rollback()
+    indexer.index(changeset={"blobs": blob_client.iter_blobs()})
+    return indexer
+
+
+def documents(indexer: LocalIndexer) -> set:
+    return {doc["document_id"] for doc in indexer.client.search(select=["document_id"])}
+
+
+def test_rebuild_switches_the_alias_and_rolls_back(tmp_path):
+    config = benchmark_config(search_type="LOCAL", local_index_path=str(tmp_path), azure_search_index="legacy",
+                              azure_search_alias="docs", azure_search_snapshot="off")
+    corpus = Corpus(documents=8, pages=2, seed=1)
+    fakes = services(latency_scale=0, throttle=False)
+    _, blob_client = build(config, corpus, fakes, FakeSearchClient(fakes["search"]))
+
+    # before the first rebuild the alias does not exist, runs write to the configured index
+    assert run(config, blob_client, fakes).index_name == "legacy"
+
+    # a blob that fails to be analyzed is missing from the new version, the alias is not switched
+    handle = blob_client.media_handler.handle
+    failing = sorted(corpus.live())[0]
+    blob_client.media_handler.handle = lambda content: [][0] if content.name == failing else handle(content)
+    with pytest.raises(RuntimeError):
+        run(config, blob_client, fakes, azure_search_rebuild="shadow")
+    blob_client.media_handler.handle = handle
+
+    rebuilt = run(config, blob_client, fakes, azure_search_rebuild="shadow")
+    rebuild = rebuilt.diagnostics["rebuild"]
+    assert rebuild["switched"] and rebuild["previous"] == "legacy"
+    assert rebuild["expected"] == rebuild["indexed"] == len(corpus.live())
+    # the failed version is dropped, the legacy index is kept for rollback
+    assert len(rebuild["dropped"]) == 1 and sorted(rebuilt.list_indexes()) == sorted(["legacy", rebuild["index"]])
+    assert rebuilt.diagnostics["counts"]["remove"] == 0
+    assert documents(rebuilt) == set(corpus.live())
+
+    # later runs write to the index the alias points to
+    assert run(config, blob_client, fakes).index_name == rebuild["index"]
+    assert run(config, blob_client, fakes, azure_search_rebuild="rollback")["rollback"]["to"] == "legacy"
+    assert run(config, blob_client, fakes).index_name == "legacy"
+    with pytest.raises(ValueError):
+        LocalIndexer({**config, "azure_search_alias": "", "azure_search_rebuild": "shadow"})
+
+
+def test_rebuild_keeps_the_live_version_and_older_ones(tmp_path):
+    config = benchmark_config(search_type="LOCAL", local_index_path=str(tmp_path), azure_search_index="legacy",
+                              azure_search_alias="docs", azure_search_snapshot="off", azure_search_rebuild_keep=1)
+    corpus = Corpus(documents=3, pages=1, seed=1)
+    fakes = services(latency_scale=0, throttle=False)
+    _, blob_client = build(config, corpus, fakes, FakeSearchClient(fakes["search"]))
+    run(config, blob_client, fakes)
+
+    versions = [run(config, blob_client, fakes, azure_search_rebuild="shadow").index_name for _ in range(3)]
+    assert set(run(config, blob_client, fakes).list_indexes()) == {"legacy", *versions}
+    # the alias already pointed to a version: it stays, with the one version before it
+    rebuilt = run(config, blob_client, fakes, azure_search_rebuild="shadow")
+    assert rebuilt.diagnostics["rebuild"]["previous"] == versions[2]
+    assert rebuilt.diagnostics["rebuild"]["dropped"] == [versions[0]]
+    assert set(rebuilt.list_indexes()) == {"legacy", versions[1], versions[2], rebuilt.index_name}
+
+    # without older versions kept, the one the alias moved away from is still there to roll back to
+    latest = rebuilt.index_name
+    rebuilt = run(config, blob_client, fakes, azure_search_rebuild="shadow", azure_search_rebuild_keep=0)
+    assert sorted(rebuilt.diagnostics["rebuild"]["dropped"]) == [versions[1], versions[2]]
+    assert set(rebuilt.list_indexes()) == {"legacy", latest, rebuilt.index_name}
+    assert run(config, blob_client, fakes, azure_search_rebuild="rollback")["rollback"]["to"] == latest
@@ -0,0 +1,135 @@
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+from azure.core.exceptions import HttpResponseError, ResourceExistsError, ResourceNotFoundError, ServiceRequestError
+
+from blob_sync.sharding import ShardCoordinator, merge_diagnostics, shard_of
+from blob_sync.sync import sync_shards
+
+
+class FakeContainer:
+    """Stand-in for the coordination container, leases never expire. Renewals raise the errors of renew_errors
+    in turn, None renews"""
+
+    def __init__(self, renew_errors=()):
+        self.blobs = {}
+        self.leases = {}
+        self.renew_errors = list(renew_errors)
+        self.renewals = 0
+
+    def create_container(self):
+        raise ResourceExistsError("exists")
+
+    def get_blob_client(self, name):
+        container = self
+
+        class Lease:
+            def renew(self):
+                container.renewals += 1
+                error = container.renew_errors.pop(0) if container.renew_errors else None
+                if error:
+                    raise error
+
+            def release(self):
+                del container.leases[name]
+
+        class Blob:
+            def upload_blob(self, data, overwrite=False, lease=None):
+                if name in container.blobs and not overwrite:
+                    raise ResourceExistsError("exists")
+                if name in container.leases and container.leases[name] is not lease:
+                    raise HttpResponseError("lease id missing")
+                container.blobs[name] = data.encode() if isinstance(data, str) else data
+
+            def download_blob(self):
+                if name not in container.blobs:
+                    raise ResourceNotFoundError("not found")
+                return SimpleNamespace(readall=lambda: container.blobs[name])
+
+            def acquire_lease(self, lease_duration):
+                if name in container.leases:
+                    raise HttpResponseError("lease already present")
+                container.leases[name] = Lease()
+                return container.leases[name]
+
+        return Blob()
+
+
+def test_shard_of():
+    names = [f"folder/doc{i}.pdf" for i in range(4000)]
+    counts = Counter(shard_of(name, 4) for name in names)
+    assert sorted(counts) == [0, 1, 2, 3]
+    assert min(counts.values()) > 800
+    assert shard_of("folder/doc1.pdf", 4) == shard_of("folder/doc1.pdf", 4)
+
+
+def test_claim_and_merge():
+    container = FakeContainer()
+    worker1 = ShardCoordinator(container, count=2, run_id="run1")
+    worker2 = ShardCoordinator(container, count=2, run_id="run1")
+
+    first = worker1.claim()
+    second = worker2.claim()
+    assert {first.shard, second.shard} == {0, 1}
+    # both shards are taken
+    assert worker1.claim() is None
+    assert first.owns("a.pdf") != second.owns("a.pdf")
+
+    first.complete({"counts": {"create": 2, "update": 1}, "journal": None})
+    assert worker1.merge() is None
+    # the other worker died, its lease ran out
+    second.release()
+    third = worker1.claim()
+    assert third.shard == second.shard
+    third.complete({"counts": {"create": 3, "update": 0}, "journal": {"resumed": 1}})
+
+    assert worker2.merge() == {"counts": {"create": 5, "update": 1}, "journal": {"resumed": 1}, "shards": 2}
+    assert worker1.claim() is None
+    # a new run starts over
+    assert ShardCoordinator(container, count=2, run_id="run2").claim() is not None
+
+
+def test_merge_diagnostics():
+    merged = merge_diagnostics([{"stages": {"embed": {"items": 1, "seconds": 0.5}}, "embedding_cache": None},
+                                {"stages": {"embed": {"items": 2, "seconds": 1.0}, "analyze": {"items": 3}},
+                                 "embedding_cache": {"hits": 4}}])
+    assert merged == {"stages": {"embed": {"items": 3, "seconds": 1.5}, "analyze": {"items": 3}},
+                      "embedding_cache": {"hits": 4}}
+
+
+def lease_taken():
+    error = HttpResponseError("lease id mismatch")
+    error.status_code = 409
+    return error
+
+
+def test_transient_renew_failures_are_retried():
+    container = FakeContainer(renew_errors=[ServiceRequestError("connection reset"), HttpResponseError("busy")])
+    shard = ShardCoordinator(container, count=1, run_id="run1", lease_seconds=0.6).claim()
+    while container.renewals < 4:
+        time.sleep(0.05)
+    assert not shard.lost
+    shard.complete({})
+
+    container = FakeContainer(renew_errors=[lease_taken()])
+    shard = ShardCoordinator(container, count=1, run_id="run1", lease_seconds=0.6).claim()
+    shard.renewer.join()
+    assert shard.lost and container.renewals == 1
+
+
+def test_lost_shard_stops_taking_blobs():
+    container = FakeContainer(renew_errors=[lease_taken()])
+    coordinator = ShardCoordinator(container, count=1, run_id="run1", lease_seconds=0.6)
+    config = {"incremental_mode": "off", "azure_search_rebuild": "off", "run_budget_seconds": 0,
+              "run_budget_calls": 0, "run_budget_tokens": 0, "shard_index": 0}
+
+    def index(changeset, owns, stop):
+        # the pipeline asks before every blob
+        while not stop():
+            time.sleep(0.05)
+
+    search = SimpleNamespace(reset=lambda: None, index=index, diagnostics={"counts": {"create": 1}})
+    assert sync_shards(config, SimpleNamespace(iter_blobs=lambda: iter([])), search, coordinator) == {}
+    # the shard is not recorded as done, the worker that took it over does
+    assert coordinator.merge() is None
@@ -0,0 +1,32 @@
+from datetime import datetime, timezone
+
+import pytest
+from blob_sync.blob import BlobRecord
+from blob_sync.snapshot import IndexSnapshot
+
+
+def blob(name, day, deleted=False):
+    return BlobRecord(name=name, last_modified=datetime(2024, 1, day, tzinfo=timezone.utc), deleted=deleted)
+
+
+@pytest.mark.parametrize("on_disk", [False, True])
+def test_diff(on_disk):
+    snapshot = IndexSnapshot(on_disk=on_disk)
+    for chunk in range(3):
+        snapshot.add(f"same{chunk}", "same.pdf", "2024-01-02T00:00:00Z", "2024-01-03T00:00:00.123Z")
+        snapshot.add(f"changed{chunk}", "changed.pdf", "2024-01-02T00:00:00Z", "2024-01-03T00:00:00Z")
+    snapshot.add("deleted0", "deleted.pdf", "2024-01-02T00:00:00Z", "2024-01-03T00:00:00Z")
+    snapshot.add("gone0", "gone.pdf", "2024-01-02T00:00:00Z", "2024-01-03T00:00:00Z")
+    snapshot.add("recreated0", "recreated.pdf", "2024-01-02T00:00:00Z", "2024-01-03T00:00:00Z")
+    assert len(snapshot) == 5
+
+    create, update, remove = snapshot.diff(
+        iter([blob("same.pdf", 2), blob("deleted.pdf", 2, deleted=True), blob("changed.pdf", 5), blob("new.pdf", 5),
+              blob("recreated.pdf", 1, deleted=True), blob("recreated.pdf", 2)]))
+
+    assert [b.name for b in create] == ["new.pdf"]
+    assert [b.name for b in update] == ["changed.pdf"]
+    assert sorted(b.name for b in remove) == ["deleted.pdf", "gone.pdf"]
+    assert snapshot.chunk_keys(["changed.pdf", "new.pdf"]) == {"changed.pdf": ["changed0", "changed1", "changed2"],
+                                                               "new.pdf": []}
+    snapshot.close()
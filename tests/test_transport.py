@@ -0,0 +1,42 @@
+import socket
+import threading
+
+from azure.storage.blob import BlobServiceClient
+
+from blob_sync.transport import KeepAliveAdapter, Transport
+
+
+def test_clients_share_the_session():
+    transport = Transport(pool_size=4, keep_alive=30)
+    kwargs = transport.azure_kwargs()
+    assert kwargs["transport"].session is transport.session
+    assert transport.azure_kwargs()["transport"].session is transport.session
+    client = BlobServiceClient("https://account.blob.core.windows.net", credential="key", **kwargs)
+    assert client._pipeline._transport.session is transport.session
+    transport.close()
+
+
+def test_pool_settings():
+    transport = Transport(pool_size=4, keep_alive=30)
+    adapter = transport.session.get_adapter("https://account.blob.core.windows.net")
+    assert isinstance(adapter, KeepAliveAdapter)
+    assert adapter._pool_maxsize == 4
+    assert (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1) in adapter.poolmanager.connection_pool_kw["socket_options"]
+
+    session = transport.session
+    transport.configure(pool_size=8, keep_alive=30)
+    assert transport.session is session
+    assert session.get_adapter("https://account.blob.core.windows.net")._pool_maxsize == 8
+    assert transport.limits().max_connections == 8
+    transport.close()
+
+
+def test_credential_on_a_fresh_transport():
+    transport = Transport()
+    credentials = []
+    # the first call also creates the session, it must not wait on its own lock
+    thread = threading.Thread(target=lambda: credentials.append(transport.credential()), daemon=True)
+    thread.start()
+    thread.join(timeout=10)
+    assert credentials and credentials[0] is transport.credential()
+    transport.close()
@@ -0,0 +1,43 @@
+import json
+import random
+
+import pytest
+
+from blob_sync.vectors import encode_vector, vector_schema
+
+
+def test_default_schema_is_full_precision():
+    field, vector_search = vector_schema(1536)
+    assert field["type"] == "Collection(Edm.Single)" and field["dimensions"] == 1536
+    assert "stored" not in field
+    assert "compressions" not in vector_search
+
+
+def test_compressed_schema():
+    field, vector_search = vector_schema(256, "half", "scalar", stored=False, oversampling=2,
+                                         api_version="2024-07-01")
+    assert field["type"] == "Collection(Edm.Half)"
+    assert field["stored"] is False and field["retrievable"] == "false"
+    compression = vector_search["compressions"][0]
+    assert compression["kind"] == "scalarQuantization"
+    assert compression["rerankWithOriginalVectors"] and compression["defaultOversampling"] == 2
+    assert vector_search["profiles"][0]["compression"] == compression["name"]
+
+    _, vector_search = vector_schema(256, compression="binary", api_version="2025-09-01")
+    assert vector_search["compressions"][0]["rescoringOptions"]["enableRescoring"]
+
+
+def test_compression_needs_a_recent_api_version():
+    with pytest.raises(ValueError):
+        vector_schema(1536, compression="binary", api_version="2023-11-01")
+    with pytest.raises(ValueError):
+        vector_schema(1536, vector_type="double")
+
+
+def test_encoding_keeps_the_precision_of_the_field():
+    vector = [random.Random(i).gauss(0, 0.05) for i in range(1536)]
+    single = encode_vector(vector, "single")
+    half = encode_vector(vector, "half")
+    assert max(abs(a - b) / abs(a) for a, b in zip(vector, single)) < 1e-8
+    assert max(abs(a - b) / abs(a) for a, b in zip(vector, half)) < 1e-4
+    assert len(json.dumps(half)) < len(json.dumps(single)) < len(json.dumps(vector))